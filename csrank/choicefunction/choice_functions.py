@@ -16,18 +16,54 @@ class ChoiceFunctions(metaclass=ABCMeta):
     def learning_problem(self):
         return CHOICE_FUNCTION
 
-    def predict_for_scores(self, scores, **kwargs):
+    def _pre_fit(self):
+        super()._pre_fit()
+        # Thresholds tuned per size or segment belong to the previous fit.
+        self.thresholds_ = dict()
+        self.thresholds_by_ = None
+
+    def predict(self, X, segments=None, **kwargs):
+        """
+            Predict choices for a given collection of sets of objects (query sets) using the function
+            :meth:`.predict_for_scores`.
+
+            Parameters
+            ----------
+            X : dict or numpy array
+                Dictionary with a mapping from the query set size to numpy arrays or a single numpy array of size:
+                (n_instances, n_objects, n_features)
+            segments : dict or numpy array or None
+                The segment id of every query set, in the same format as X, if the thresholds were tuned per
+                segment (see :meth:`.tune_thresholds`)
+
+            Returns
+            -------
+            Y : dict or numpy array
+                Dictionary with a mapping from the query set size to numpy arrays or a single numpy array containing
+                predicted choice vectors of size:
+                (n_instances, n_objects)
+        """
+        scores = self.predict_scores(X, **kwargs)
+        return self.predict_for_scores(scores, segments=segments, **kwargs)
+
+    def predict_for_scores(self, scores, segments=None, **kwargs):
         """
             Binary choice vector :math:`y` represents the choices amongst the objects in :math:`Q`, such that
             :math:`y(k) = 1` represents that the object :math:`x_k` is chosen and :math:`y(k) = 0` represents it is not
             chosen. Predict choices for the scores for a given collection of sets of objects (query sets).
 
+            If :meth:`.tune_thresholds` was used, the threshold of the query set size or of the segment of each query
+            set is applied, falling back to the global threshold for sizes or segments without an own threshold.
+
             Parameters
             ----------
             scores : dict or numpy array
                 Dictionary with a mapping from query set size to numpy arrays
                 or a single numpy array of size containing scores of each object of size:
                 (n_instances, n_objects)
+            segments : dict or numpy array or None
+                The segment id of every query set, in the same format as the scores, if the thresholds were tuned
+                per segment
 
 
             Returns
@@ -41,27 +77,113 @@ class ChoiceFunctions(metaclass=ABCMeta):
         if isinstance(scores, dict):
             result = dict()
             for n, score in scores.items():
-                result[n] = score > self.threshold_
+                segment = None if segments is None else segments[n]
+                result[n] = score > self._instance_thresholds(score, segment)
                 result[n] = np.array(result[n], dtype=int)
         else:
-            result = scores > self.threshold_
+            result = scores > self._instance_thresholds(scores, segments)
             result = np.array(result, dtype=int)
         return result
 
+    def _instance_thresholds(self, scores, segments):
+        """The threshold of every query set, as an array which broadcasts
+        against the scores."""
+        thresholds = getattr(self, "thresholds_", None)
+        if not thresholds:
+            return self.threshold_
+        if self.thresholds_by_ == "size":
+            return thresholds.get(scores.shape[1], self.threshold_)
+        if segments is None:
+            return self.threshold_
+        keys = np.array(sorted(thresholds))
+        values = np.array([thresholds[key] for key in keys])
+        segments = np.asarray(segments)
+        positions = np.minimum(np.searchsorted(keys, segments), len(keys) - 1)
+        found = keys[positions] == segments
+        return np.where(found, values[positions], self.threshold_)[:, None]
+
+    def tune_thresholds(
+        self, X_val, Y_val, segments=None, min_instances=100, thin_thresholds=1
+    ):
+        """
+            Tune a separate threshold for every query set size or for every segment of query sets, for example
+            users, on validation data. Each threshold maximizes the F1-measure of its query sets. Sizes or segments
+            with less than ``min_instances`` query sets use the global threshold, which is tuned on all query sets.
+
+            Parameters
+            ----------
+            X_val : dict or numpy array
+                Dictionary with a mapping from the query set size to numpy arrays or a single numpy array of size:
+                (n_instances, n_objects, n_features)
+            Y_val : dict or numpy array
+                The choices of the query sets, in the same format as X_val
+            segments : dict or numpy array or None
+                The segment id of every query set, in the same format as X_val. If None, a threshold is tuned for
+                every query set size.
+            min_instances : int
+                Minimal number of query sets of a size or segment to tune an own threshold
+            thin_thresholds: int
+                The number of instances of scores to skip while tuning the threshold
+
+            Returns
+            -------
+            self : ChoiceFunctions
+                The learner with the tuned thresholds
+        """
+        scores = self.predict_scores(X_val)
+        self.threshold_ = self._tune_threshold_for_scores(
+            scores, Y_val, thin_thresholds
+        )
+        if segments is None:
+            self.thresholds_by_ = "size"
+            if not isinstance(scores, dict):
+                scores, Y_val = {scores.shape[1]: scores}, {scores.shape[1]: Y_val}
+            groups = {n: (score, Y_val[n]) for n, score in scores.items()}
+        else:
+            self.thresholds_by_ = "segment"
+            groups = _group_by_segment(scores, Y_val, segments)
+        self.thresholds_ = dict()
+        for key, (score, y) in groups.items():
+            if isinstance(score, dict):
+                n_instances = sum(len(s) for s in score.values())
+            else:
+                n_instances = len(score)
+            if n_instances >= min_instances:
+                self.thresholds_[key] = self._tune_threshold_for_scores(
+                    score, y, thin_thresholds
+                )
+        return self
+
     def _tune_threshold(self, X_val, Y_val, thin_thresholds=1, verbose=0):
         scores = self.predict_scores(X_val)
-        probabilities = np.unique(scores)[::thin_thresholds]
-        threshold = 0.0
-        best = f1_measure(Y_val, scores > threshold)
+        return self._tune_threshold_for_scores(
+            scores, Y_val, thin_thresholds, verbose=verbose
+        )
+
+    def _tune_threshold_for_scores(self, scores, Y_val, thin_thresholds=1, verbose=0):
+        if isinstance(scores, dict):
+            unique_scores = np.unique(
+                np.concatenate([s.ravel() for s in scores.values()])
+            )
+        else:
+            unique_scores = np.unique(scores)
+        # The candidates in the order in which they used to be tried, ties
+        # are resolved in favour of the earlier candidate.
+        candidates = np.concatenate([[0.0], unique_scores[::thin_thresholds]])
+        f1_scores = _sample_f1_for_thresholds(Y_val, scores, candidates)
+        logger.info("Evaluated {} candidate thresholds".format(len(candidates)))
+        # The sweep accumulates rounding errors, so the best candidates are
+        # compared with the exact F1-measure.
+        best_candidates = candidates[f1_scores >= np.max(f1_scores) - 1e-9]
+        threshold, best = best_candidates[0], -np.inf
         try:
-            for i, p in enumerate(probabilities):
-                pred = scores > p
-                f1 = f1_measure(Y_val, pred)
+            for i, p in enumerate(best_candidates):
+                f1 = f1_measure(Y_val, _predict_above(scores, p))
                 if f1 > best:
                     threshold = p
                     best = f1
                 if verbose == 1:
-                    progress_bar(i, len(probabilities), status="Tuning threshold")
+                    progress_bar(i + 1, len(best_candidates), status="Tuning threshold")
         except KeyboardInterrupt:
             logger.info("Keyboard interrupted")
         logger.info(
@@ -69,3 +191,90 @@ class ChoiceFunctions(metaclass=ABCMeta):
             " a micro F1-measure of {:.2f}".format(threshold, best)
         )
         return threshold
+
+
+def _group_by_segment(scores, Y, segments):
+    """Group the scores and choices of the query sets by their segment ids."""
+    if not isinstance(scores, dict):
+        segments = np.asarray(segments)
+        return {
+            segment: (scores[segments == segment], Y[segments == segment])
+            for segment in np.unique(segments).tolist()
+        }
+    segments = {n: np.asarray(segment) for n, segment in segments.items()}
+    groups = dict()
+    for segment in np.unique(np.concatenate(list(segments.values()))).tolist():
+        score_buckets, y_buckets = dict(), dict()
+        for n, score in scores.items():
+            in_segment = segments[n] == segment
+            if np.any(in_segment):
+                score_buckets[n] = score[in_segment]
+                y_buckets[n] = Y[n][in_segment]
+        groups[segment] = (score_buckets, y_buckets)
+    return groups
+
+
+def _predict_above(scores, threshold):
+    if isinstance(scores, dict):
+        return {n: score > threshold for n, score in scores.items()}
+    return scores > threshold
+
+
+def _f1_deltas(Y, scores):
+    """Sort the scores of every instance decreasingly and compute the change of
+    the F1-measure of the instance when the respective object is added to the
+    predicted choices."""
+    Y, scores = np.asarray(Y, dtype=bool), np.asarray(scores)
+    orderings = np.argsort(-scores, axis=1, kind="stable")
+    sorted_scores = np.take_along_axis(scores, orderings, axis=1)
+    chosen = np.take_along_axis(Y, orderings, axis=1)
+    true_positives = np.cumsum(chosen, axis=1)
+    n_predicted = np.arange(1, scores.shape[1] + 1)
+    n_true = true_positives[:, -1:]
+    f1_after = 2.0 * true_positives / (n_true + n_predicted)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f1_before = 2.0 * (true_positives - chosen) / (n_true + n_predicted - 1)
+    f1_before = np.where(n_true + n_predicted - 1 > 0, f1_before, 0.0)
+    return sorted_scores.ravel(), (f1_after - f1_before).ravel()
+
+
+def _sample_f1_for_thresholds(Y, scores, thresholds):
+    """Sample-averaged F1-measure of the predictions ``scores > t`` for every
+    threshold ``t``.
+
+    All scores are sorted once and swept from the highest to the lowest. The
+    F1-measure of an instance only changes when one of its objects is added to
+    the predicted choices, so the total F1-measure after the first ``k``
+    objects is the cumulative sum of these changes. This takes
+    O(N n log(N n)) time for N instances of n objects, independently of the
+    number of thresholds.
+
+    Parameters
+    ----------
+    Y : dict or numpy array
+        The true choices, of size (n_instances, n_objects) or bucketed by the
+        query set size
+    scores : dict or numpy array
+        The predicted scores, in the same format as ``Y``
+    thresholds : numpy array
+        The thresholds to evaluate
+
+    Returns
+    -------
+    f1_scores : numpy array
+        The sample-averaged F1-measure for every threshold
+    """
+    if isinstance(scores, dict):
+        buckets = [_f1_deltas(Y[n], scores[n]) for n in scores]
+        n_instances = sum(len(score) for score in scores.values())
+    else:
+        buckets = [_f1_deltas(Y, scores)]
+        n_instances = len(scores)
+    flat_scores = np.concatenate([bucket[0] for bucket in buckets])
+    deltas = np.concatenate([bucket[1] for bucket in buckets])
+    order = np.argsort(flat_scores, kind="stable")
+    sorted_scores = flat_scores[order]
+    # Total F1-measure if all objects after position i are predicted.
+    f1_sums = np.concatenate([np.cumsum(deltas[order][::-1])[::-1], [0.0]])
+    n_not_above = np.searchsorted(sorted_scores, thresholds, side="right")
+    return f1_sums[n_not_above] / n_instances
@@ -7,6 +7,7 @@ from sklearn.utils import check_random_state
 from csrank.choicefunction.util import BinaryCrossEntropyLikelihood
 from csrank.choicefunction.util import create_weight_dictionary
 from csrank.discretechoice.likelihoods import fit_pymc3_model
+from csrank.discretechoice.likelihoods import shared_data
 from csrank.learner import Learner
 import csrank.theano_util as ttu
 from csrank.util import print_dictionary
@@ -21,7 +22,6 @@ except ImportError:
     raise MissingExtraError("pymc3", "probabilistic")
 
 try:
-    import theano
     from theano import tensor as tt
 except ImportError:
     from csrank.util import MissingExtraError
@@ -116,7 +116,7 @@ class GeneralizedLinearModel(ChoiceFunctions, Learner):
         )
         return configuration
 
-    def construct_model(self, X, Y):
+    def construct_model(self, X, Y, minibatch_size=None, float32=False):
         """
             Constructs the linear logit model which evaluated the utility score as :math:`U(x) = w \\cdot x`, where
             :math:`w` is the weight vector. The probability of choosing the object :math:`x_i` from the query set
@@ -134,6 +134,11 @@ class GeneralizedLinearModel(ChoiceFunctions, Learner):
             Y : numpy array
                 (n_instances, n_objects)
                 Preferences in form of Choices for given objects
+            minibatch_size : int or None
+                If given, the likelihood is evaluated on minibatches of this many instances (only for the
+                **variational** sampler)
+            float32 : bool
+                If True, the features are stored as float32
 
             Returns
             -------
@@ -147,15 +152,18 @@ class GeneralizedLinearModel(ChoiceFunctions, Learner):
         self.trace_ = None
         self.trace_vi_ = None
         with pm.Model() as self.model:
-            self.Xt_ = theano.shared(X)
-            self.Yt_ = theano.shared(Y)
+            self.Xt_, self.Yt_ = shared_data(
+                self, X, Y, minibatch_size=minibatch_size, float32=float32
+            )
             shapes = {"weights": self.n_object_features_fit_}
             # shapes = {'weights': (self.n_object_features_fit_, 3)}
             weights_dict = create_weight_dictionary(self.model_configuration, shapes)
             intercept = pm.Normal("intercept", mu=0, sd=10)
             utility = tt.dot(self.Xt_, weights_dict["weights"]) + intercept
             self.p_ = ttu.sigmoid(utility)
-            BinaryCrossEntropyLikelihood("yl", p=self.p_, observed=self.Yt_)
+            BinaryCrossEntropyLikelihood(
+                "yl", p=self.p_, observed=self.Yt_, total_size=self.total_size_
+            )
         logger.info("Model construction completed")
 
     def _pre_fit(self):
@@ -177,6 +185,12 @@ class GeneralizedLinearModel(ChoiceFunctions, Learner):
             "callbacks": [CheckParametersConvergence()],
         },
         verbose=0,
+        store_draws=False,
+        minibatch_size=None,
+        float32=False,
+        chains=None,
+        cores=None,
+        vi_restarts=1,
         **kwargs,
     ):
         """
@@ -197,12 +211,14 @@ class GeneralizedLinearModel(ChoiceFunctions, Learner):
                 Feature vectors of the objects
             Y : numpy array (n_instances, n_objects)
                 Choices for given objects in the query
-            sampler : {‘variational’, ‘metropolis’, ‘nuts’}, string
+            sampler : {‘variational’, ‘metropolis’, ‘nuts’, ‘map’, ‘mle’}, string
                 The sampler used to estimate the posterior mean and mass matrix from the trace
 
                     * **variational** : Run inference methods to estimate posterior mean and diagonal mass matrix
                     * **metropolis** : Use the MAP as starting point and Metropolis-Hastings sampler
                     * **nuts** : Use the No-U-Turn sampler
+                    * **map** : Maximize the posterior density, i.e. the likelihood penalized by the priors, with L-BFGS-B
+                    * **mle** : Maximize the likelihood with L-BFGS-B
             vi_params : dict
                 The parameters for the **variational** inference method
             draws : int
@@ -218,6 +234,20 @@ class GeneralizedLinearModel(ChoiceFunctions, Learner):
                 The number of instances of scores to skip while tuning the threshold
             verbose : bool
                 Print verbose information
+            store_draws : bool
+                If True, all posterior draws of the parameters are kept as float32 arrays in ``posterior_draws_``
+            minibatch_size : int or None
+                If given, every step of the **variational** inference uses a random minibatch of this many instances
+                instead of all instances, so that its cost does not depend on the size of the data
+            float32 : bool
+                If True, the features are stored as float32, which halves the memory of the data
+            chains : int or None
+                The number of chains of the MCMC samplers, by default between 2 and 4 depending on the available CPUs
+            cores : int or None
+                The number of processes used for the chains and the variational restarts, by default the number of
+                CPUs available to this process, which respects the CPU affinity and the cgroup CPU quota
+            vi_restarts : int
+                The number of independent **variational** fits run in parallel, the one with the best ELBO is kept
             **kwargs :
                 Keyword arguments for the fit function
         """
@@ -228,7 +258,17 @@ class GeneralizedLinearModel(ChoiceFunctions, Learner):
             )
             try:
                 self._fit(
-                    X_train, Y_train, sampler=sampler, vi_params=vi_params, **kwargs
+                    X_train,
+                    Y_train,
+                    sampler=sampler,
+                    vi_params=vi_params,
+                    store_draws=store_draws,
+                    minibatch_size=minibatch_size,
+                    float32=float32,
+                    chains=chains,
+                    cores=cores,
+                    vi_restarts=vi_restarts,
+                    **kwargs,
                 )
             finally:
                 logger.info(
@@ -242,7 +282,6 @@ class GeneralizedLinearModel(ChoiceFunctions, Learner):
                 X,
                 Y,
                 sampler=sampler,
-                sample_params={"tune": 2, "draws": 2, "chains": 4, "njobs": 8},
                 vi_params={
                     "n": 20000,
                     "method": "advi",
@@ -253,6 +292,12 @@ class GeneralizedLinearModel(ChoiceFunctions, Learner):
                     ],
                     "draws": 500,
                 },
+                store_draws=store_draws,
+                minibatch_size=minibatch_size,
+                float32=float32,
+                chains=chains,
+                cores=cores,
+                vi_restarts=vi_restarts,
                 **kwargs,
             )
             self.threshold_ = 0.5
@@ -270,18 +315,30 @@ class GeneralizedLinearModel(ChoiceFunctions, Learner):
             "method": "advi",
             "callbacks": [CheckParametersConvergence()],
         },
+        store_draws=False,
+        minibatch_size=None,
+        float32=False,
+        chains=None,
+        cores=None,
+        vi_restarts=1,
         **kwargs,
     ):
         _n_instances, self.n_objects_fit_, self.n_object_features_fit_ = X.shape
-        self.construct_model(X, Y)
-        fit_pymc3_model(self, sampler, draws, tune, vi_params, **kwargs)
+        self.construct_model(X, Y, minibatch_size=minibatch_size, float32=float32)
+        fit_pymc3_model(
+            self,
+            sampler,
+            draws,
+            tune,
+            vi_params,
+            store_draws=store_draws,
+            chains=chains,
+            cores=cores,
+            vi_restarts=vi_restarts,
+            **kwargs,
+        )
 
     def _predict_scores_fixed(self, X, **kwargs):
-        d = dict(pm.summary(self.trace_)["mean"])
-        intercept = 0.0
-        weights = np.array(
-            [d["weights[{}]".format(i)] for i in range(self.n_object_features_fit_)]
-        )
-        if "intercept" in d:
-            intercept = intercept + d["intercept"]
+        weights = self.posterior_means_["weights"]
+        intercept = self.posterior_means_.get("intercept", 0.0)
         return np.dot(X, weights) + intercept
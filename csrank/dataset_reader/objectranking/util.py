@@ -105,17 +105,44 @@ def generate_complete_pairwise_dataset(X, Y):
 
 
 def complete_linear_regression_dataset(X, rankings):
-    X1 = []
-    Y_single = []
-    for features, rank in zip(X, rankings):
-        X1.extend(features)
-        min_rank = np.min(rank, axis=0)
-        max_rank = np.max(rank, axis=0)
-        norm_ranks = (rank - min_rank + 1) / (max_rank - min_rank + 1)
-        Y_single.extend(norm_ranks)
-    X1 = np.array(X1)
-    Y_single = np.array(Y_single)
-    return X1, Y_single
+    """
+        Generates the regression dataset used by :class:`ExpectedRankRegression` from the given rankings. Every
+        object becomes one sample and its target is the rank normalized per query set by the minimum and maximum
+        rank, i.e. :math:`r(x_k) = \\frac{\\pi(k) - \\min \\pi + 1}{\\max \\pi - \\min \\pi + 1}`.
+
+        Parameters
+        ----------
+        X : dict or numpy array
+            Dictionary with a mapping from query set size to numpy arrays or a single numpy array of size:
+            (n_instances, n_objects, n_features)
+        rankings : dict or numpy array
+            Dictionary with a mapping from query set size to numpy arrays or a single numpy array of size:
+            (n_instances, n_objects)
+
+        Returns
+        -------
+        x_train: array-like, shape (n_samples, n_features)
+            The feature vectors of all objects with n_samples=:math:`n_{instances} \\cdot n_{objects}`. This is a view
+            on X whenever X is a contiguous numpy array.
+        y_train: array-like, shape (n_samples)
+            The normalized ranks of all objects.
+    """
+    if isinstance(X, dict):
+        buckets = [
+            complete_linear_regression_dataset(X[n], rankings[n]) for n in X.keys()
+        ]
+        x_train = np.concatenate([x for x, _ in buckets], axis=0)
+        y_train = np.concatenate([y for _, y in buckets], axis=0)
+        return x_train, y_train
+    X = np.asarray(X)
+    rankings = np.asarray(rankings)
+    n_instances, n_objects, n_features = X.shape
+    min_rank = np.min(rankings, axis=1, keepdims=True)
+    max_rank = np.max(rankings, axis=1, keepdims=True)
+    norm_ranks = (rankings - min_rank + 1) / (max_rank - min_rank + 1)
+    x_train = X.reshape(n_instances * n_objects, n_features)
+    y_train = norm_ranks.reshape(n_instances * n_objects)
+    return x_train, y_train
 
 
 def sub_sampling_rankings(Xt, Yt, n_objects=5):
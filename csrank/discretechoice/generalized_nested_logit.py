@@ -1,4 +1,3 @@
-from itertools import product
 import logging
 
 import numpy as np
@@ -13,6 +12,7 @@ from .likelihoods import create_weight_dictionary
 from .likelihoods import fit_pymc3_model
 from .likelihoods import likelihood_dict
 from .likelihoods import LogLikelihood
+from .likelihoods import shared_data
 
 try:
     import pymc3 as pm
@@ -23,7 +23,6 @@ except ImportError:
     raise MissingExtraError("pymc3", "probabilistic")
 
 try:
-    import theano
     from theano import tensor as tt
 except ImportError:
     from csrank.util import MissingExtraError
@@ -195,40 +194,24 @@ class GeneralizedNestedLogitModel(DiscreteObjectChooser, Learner):
                 Choice probabilities :math:`P_i` of the objects :math:`x_i \\in Q` in the query sets
 
         """
-        n_nests = self.n_nests
-        n_instances, n_objects = utility.shape
-        pik = tt.zeros((n_instances, n_objects, n_nests))
-        sum_per_nest = tt.zeros((n_instances, n_nests))
-        for i in range(n_nests):
-            uti = (utility + tt.log(alpha_ik[:, :, i])) * 1 / lambda_k[i]
-            sum_n = ttu.logsumexp(uti)
-            pik = tt.set_subtensor(pik[:, :, i], tt.exp(uti - sum_n))
-            sum_per_nest = tt.set_subtensor(
-                sum_per_nest[:, i], sum_n[:, 0] * lambda_k[i]
-            )
-        pnk = tt.exp(sum_per_nest - ttu.logsumexp(sum_per_nest))
-        pnk = pnk[:, None, :]
-        p = pik * pnk
-        p = p.sum(axis=2)
+        # The (scaled) utilities of all objects in all nests, with the nests
+        # along the last axis.
+        uti = (utility[:, :, None] + tt.log(alpha_ik)) / lambda_k
+        sum_n = ttu.logsumexp(uti, axis=1)
+        sum_per_nest = sum_n[:, 0, :] * lambda_k
+        log_pnk = sum_per_nest - ttu.logsumexp(sum_per_nest)
+        p = tt.exp(uti - sum_n + log_pnk[:, None, :]).sum(axis=2)
         return p
 
     def _get_probabilities_np(self, utility, lambda_k, alpha_ik):
-        n_nests = self.n_nests
-        n_instances, n_objects = utility.shape
-        pik = np.zeros((n_instances, n_objects, n_nests))
-        sum_per_nest_x = np.zeros((n_instances, n_nests))
-        for i in range(n_nests):
-            uti = (utility + np.log(alpha_ik[:, :, i])) * 1 / lambda_k[i]
-            sum_n = npu.logsumexp(uti)
-            pik[:, :, i] = np.exp(uti - sum_n)
-            sum_per_nest_x[:, i] = sum_n[:, 0] * lambda_k[i]
-        pnk = np.exp(sum_per_nest_x - npu.logsumexp(sum_per_nest_x))
-        pnk = pnk[:, None, :]
-        p = pik * pnk
-        p = p.sum(axis=2)
+        uti = (utility[:, :, None] + np.log(alpha_ik)) / lambda_k
+        sum_n = npu.logsumexp(uti, axis=1)
+        sum_per_nest = sum_n[:, 0, :] * lambda_k
+        log_pnk = sum_per_nest - npu.logsumexp(sum_per_nest)
+        p = np.exp(uti - sum_n + log_pnk[:, None, :]).sum(axis=2)
         return p
 
-    def construct_model(self, X, Y):
+    def construct_model(self, X, Y, minibatch_size=None, float32=False):
         """
             Constructs the nested logit model by applying priors on weight vectors **weights** and **weights_k** as per
             :meth:`model_configuration`. Then we apply a uniform prior to the :math:`\\lambda s`, i.e.
@@ -243,6 +226,11 @@ class GeneralizedNestedLogitModel(DiscreteObjectChooser, Learner):
             Y : numpy array
                 (n_instances, n_objects)
                 Preferences in the form of discrete choices for given objects
+            minibatch_size : int or None
+                If given, the likelihood is evaluated on minibatches of this many instances (only for the
+                **variational** sampler)
+            float32 : bool
+                If True, the features are stored as float32
 
             Returns
             -------
@@ -253,15 +241,16 @@ class GeneralizedNestedLogitModel(DiscreteObjectChooser, Learner):
         self.random_state_ = check_random_state(self.random_state)
         self.loss_function_ = likelihood_dict.get(self.loss_function, None)
         self.threshold_ = 43e5
-        if np.prod(X.shape) > self.threshold_:
+        if minibatch_size is None and np.prod(X.shape) > self.threshold_:
             upper_bound = int(self.threshold_ / np.prod(X.shape[1:]))
             indices = self.random_state_.choice(X.shape[0], upper_bound, replace=False)
             X = X[indices, :, :]
             Y = Y[indices, :]
         logger.info("Train Set instances {} objects {} features {}".format(*X.shape))
         with pm.Model() as self.model:
-            self.Xt_ = theano.shared(X)
-            self.Yt_ = theano.shared(Y)
+            self.Xt_, self.Yt_ = shared_data(
+                self, X, Y, minibatch_size=minibatch_size, float32=float32
+            )
             shapes = {
                 "weights": self.n_object_features_fit_,
                 "weights_ik": (self.n_object_features_fit_, self.n_nests),
@@ -274,7 +263,11 @@ class GeneralizedNestedLogitModel(DiscreteObjectChooser, Learner):
             lambda_k = pm.Uniform("lambda_k", self.alpha, 1.0, shape=self.n_nests)
             self.p_ = self.get_probabilities(utility, lambda_k, alpha_ik)
             LogLikelihood(
-                "yl", loss_func=self.loss_function_, p=self.p_, observed=self.Yt_
+                "yl",
+                loss_func=self.loss_function_,
+                p=self.p_,
+                observed=self.Yt_,
+                total_size=self.total_size_,
             )
         logger.info("Model construction completed")
 
@@ -290,6 +283,12 @@ class GeneralizedNestedLogitModel(DiscreteObjectChooser, Learner):
             "method": "advi",
             "callbacks": [CheckParametersConvergence()],
         },
+        store_draws=False,
+        minibatch_size=None,
+        float32=False,
+        chains=None,
+        cores=None,
+        vi_restarts=1,
         **kwargs,
     ):
         """
@@ -310,12 +309,14 @@ class GeneralizedNestedLogitModel(DiscreteObjectChooser, Learner):
                 Feature vectors of the objects
             Y : numpy array (n_instances, n_objects)
                 Choices for given objects in the query
-            sampler : {‘variational’, ‘metropolis’, ‘nuts’}, string
+            sampler : {‘variational’, ‘metropolis’, ‘nuts’, ‘map’, ‘mle’}, string
                 The sampler used to estimate the posterior mean and mass matrix from the trace
 
                     * **variational** : Run inference methods to estimate posterior mean and diagonal mass matrix
                     * **metropolis** : Use the MAP as starting point and Metropolis-Hastings sampler
                     * **nuts** : Use the No-U-Turn sampler
+                    * **map** : Maximize the posterior density, i.e. the likelihood penalized by the priors, with L-BFGS-B
+                    * **mle** : Maximize the likelihood with L-BFGS-B
             vi_params : dict
                 The parameters for the **variational** inference method
             draws : int
@@ -325,8 +326,23 @@ class GeneralizedNestedLogitModel(DiscreteObjectChooser, Learner):
                 the step sizes, scalings or similar during tuning. Tuning samples will be drawn in addition
                 to the number specified in the `draws` argument, and will be discarded unless
                 `discard_tuned_samples` is set to False.
+            store_draws : bool
+                If True, all posterior draws of the parameters are kept as float32 arrays in ``posterior_draws_``
+            minibatch_size : int or None
+                If given, every step of the **variational** inference uses a random minibatch of this many instances
+                instead of all instances, so that its cost does not depend on the size of the data
+            float32 : bool
+                If True, the features are stored as float32, which halves the memory of the data
+            chains : int or None
+                The number of chains of the MCMC samplers, by default between 2 and 4 depending on the available CPUs
+            cores : int or None
+                The number of processes used for the chains and the variational restarts, by default the number of
+                CPUs available to this process, which respects the CPU affinity and the cgroup CPU quota
+            vi_restarts : int
+                The number of independent **variational** fits run in parallel, the one with the best ELBO is kept
             **kwargs :
-                Keyword arguments for the fit function of :meth:`pymc3.fit`or :meth:`pymc3.sample`
+                Keyword arguments for the fit function of :meth:`pymc3.fit`or :meth:`pymc3.sample`, or options of
+                L-BFGS-B for **map** and **mle**
         """
         self._pre_fit()
         _n_instances, self.n_objects_fit_, self.n_object_features_fit_ = X.shape
@@ -335,24 +351,25 @@ class GeneralizedNestedLogitModel(DiscreteObjectChooser, Learner):
             # before (moved out of __init__). The `n_objects` summand probably
             # should be removed.
             self.n_nests = self.n_objects_fit_ + int(self.n_objects_fit_ / 2)
-        self.construct_model(X, Y)
-        fit_pymc3_model(self, sampler, draws, tune, vi_params, **kwargs)
+        self.construct_model(X, Y, minibatch_size=minibatch_size, float32=float32)
+        fit_pymc3_model(
+            self,
+            sampler,
+            draws,
+            tune,
+            vi_params,
+            store_draws=store_draws,
+            chains=chains,
+            cores=cores,
+            vi_restarts=vi_restarts,
+            **kwargs,
+        )
         return self
 
     def _predict_scores_fixed(self, X, **kwargs):
-        mean_trace = dict(pm.summary(self.trace_)["mean"])
-        weights = np.array(
-            [
-                mean_trace["weights[{}]".format(i)]
-                for i in range(self.n_object_features_fit_)
-            ]
-        )
-        lambda_k = np.array(
-            [mean_trace["lambda_k[{}]".format(i)] for i in range(self.n_nests)]
-        )
-        weights_ik = np.zeros((self.n_object_features_fit_, self.n_nests))
-        for i, k in product(range(self.n_object_features_fit_), range(self.n_nests)):
-            weights_ik[i][k] = mean_trace["weights_ik[{},{}]".format(i, k)]
+        weights = self.posterior_means_["weights"]
+        lambda_k = self.posterior_means_["lambda_k"]
+        weights_ik = self.posterior_means_["weights_ik"]
         alpha_ik = np.dot(X, weights_ik)
         alpha_ik = npu.softmax(alpha_ik, axis=2)
         utility = np.dot(X, weights)
@@ -1,12 +1,20 @@
 import copy
 import logging
 
+from joblib import delayed
+from joblib import Parallel
+import numpy as np
+from scipy.optimize import minimize
+from sklearn.utils import check_random_state
+
 from csrank.theano_util import normalize
+from csrank.util import available_cpus
 
 try:
     import pymc3 as pm
     from pymc3 import Discrete
     from pymc3.distributions.dist_math import bound
+    from pymc3.util import is_transformed_name
     from pymc3.variational.callbacks import CheckParametersConvergence
 except ImportError:
     from csrank.util import MissingExtraError
@@ -104,22 +112,264 @@ def create_weight_dictionary(model_args, shapes):
     return weights_dict
 
 
-def fit_pymc3_model(self, sampler, draws, tune, vi_params, **kwargs):
-    callbacks = vi_params.get("callbacks", [])
-    for i, c in enumerate(callbacks):
-        if isinstance(c, CheckParametersConvergence):
-            params = c.__dict__
-            params.pop("_diff")
-            params.pop("prev")
-            params.pop("ord")
-            params["diff"] = "absolute"
-            callbacks[i] = CheckParametersConvergence(**params)
+def shared_data(self, *arrays, minibatch_size=None, float32=False):
+    """Wrap the training data into theano variables for the pymc3 model.
+
+    Parameters
+    ----------
+    *arrays : numpy arrays
+        The data, with the instances along the first axis
+    minibatch_size : int or None
+        If given, every variable is a :class:`pymc3.Minibatch` which draws
+        this many instances in every evaluation, the same ones from all
+        arrays. The size of the full data is stored in ``self.total_size_``,
+        which has to be passed as ``total_size`` to the observed likelihood
+        so that it is scaled correctly. This can only be used by the
+        variational sampler.
+    float32 : bool
+        If True, floating point data is stored as float32, which halves its
+        memory.
+
+    Returns
+    -------
+    variables : list of theano variables
+        The data variables in the order of the arrays
+    """
+    self.minibatch_size_ = minibatch_size
+    self.total_size_ = None
+    dtypes = [
+        "float32" if float32 and np.issubdtype(a.dtype, np.floating) else None
+        for a in arrays
+    ]
+    if minibatch_size is None:
+        return [
+            theano.shared(a if dtype is None else a.astype(dtype))
+            for a, dtype in zip(arrays, dtypes)
+        ]
+    self.total_size_ = len(arrays[0])
+    # Equal seeds draw the same instances from all arrays.
+    random_seed = check_random_state(getattr(self, "random_state_", None)).randint(
+        2 ** 30
+    )
+    return [
+        pm.Minibatch(a, batch_size=minibatch_size, dtype=dtype, random_seed=random_seed)
+        for a, dtype in zip(arrays, dtypes)
+    ]
+
+
+def store_posterior(self, store_draws=False):
+    """Extract the posterior of the fitted parameters from ``self.trace_``.
+
+    The posterior means of all (untransformed) variables are stored in
+    ``self.posterior_means_`` as arrays of the shape of the variable, so that
+    predictions do not need to summarize the trace again.
+
+    Parameters
+    ----------
+    store_draws : bool
+        If True, all draws are additionally stored in
+        ``self.posterior_draws_`` as float32 arrays, with the draws along the
+        first axis. Otherwise ``self.posterior_draws_`` is set to None, so
+        that no draws of a previous fit are kept.
+    """
+    varnames = [name for name in self.trace_.varnames if not is_transformed_name(name)]
+    draws = {name: self.trace_.get_values(name, combine=True) for name in varnames}
+    self.posterior_means_ = {
+        name: np.mean(values, axis=0) for name, values in draws.items()
+    }
+    if store_draws:
+        self.posterior_draws_ = {
+            name: values.astype(np.float32) for name, values in draws.items()
+        }
+    else:
+        self.posterior_draws_ = None
+
+
+def fit_point_estimate(self, sampler, store_draws=False, **options):
+    """Fit the parameters of ``self.model`` by maximizing its log-probability.
+
+    The log-probability and its gradient with respect to all free variables
+    are compiled once into a single theano function, which is then optimized
+    with L-BFGS-B. Bounded variables are optimized in the unconstrained space
+    of their pymc3 transformation. The point estimate is stored in
+    ``self.posterior_means_`` (and as a single draw in
+    ``self.posterior_draws_`` if ``store_draws`` is set), so that it can be
+    used by the same prediction code as a posterior.
+
+    Parameters
+    ----------
+    sampler : {'map', 'mle'}
+        With 'map' the log-posterior, i.e. the log-likelihood with the log
+        of the priors as penalties, is maximized. With 'mle' only the
+        log-likelihood of the observed choices is maximized.
+    store_draws : bool
+        If True, also store the point estimate in ``self.posterior_draws_``
+    **options
+        Options for the L-BFGS-B method of :func:`scipy.optimize.minimize`,
+        such as ``maxiter``
+    """
+    model = self.model
+    cost = model.logpt if sampler == "map" else model.datalogpt
+    free_vars = model.free_RVs
+    grads = tt.grad(cost, free_vars, disconnected_inputs="ignore")
+    function = theano.function(free_vars, [cost] + grads, allow_input_downcast=True)
+
+    start = model.test_point
+    shapes = [np.shape(start[var.name]) for var in free_vars]
+    splits = np.cumsum([int(np.prod(shape)) for shape in shapes])[:-1]
+
+    def unflatten(x):
+        return [part.reshape(shape) for part, shape in zip(np.split(x, splits), shapes)]
+
+    def negative_cost(x):
+        value, *gradients = function(*unflatten(x))
+        gradient = np.concatenate([np.ravel(g) for g in gradients])
+        return -float(value), -gradient.astype(np.float64)
+
+    x0 = np.concatenate([np.ravel(start[var.name]) for var in free_vars])
+    result = minimize(negative_cost, x0, jac=True, method="L-BFGS-B", options=options)
+    if not result.success:
+        logger.warning("L-BFGS-B did not converge: {}".format(result.message))
+    self.optimization_result_ = result
+
+    point = dict(zip([var.name for var in free_vars], unflatten(result.x)))
+    outputs = [var for var in model.unobserved_RVs if not is_transformed_name(var.name)]
+    values = model.fastfn(outputs)(point)
+    self.posterior_means_ = {
+        var.name: np.asarray(value) for var, value in zip(outputs, values)
+    }
+    if store_draws:
+        self.posterior_draws_ = {
+            name: value[None].astype(np.float32)
+            for name, value in self.posterior_means_.items()
+        }
+    else:
+        self.posterior_draws_ = None
+
+
+def _absolute_convergence(callbacks):
+    """New copies of the callbacks, in which parameter convergence is checked on absolute differences."""
+    return [
+        CheckParametersConvergence(
+            every=c.every, tolerance=c.tolerance, diff="absolute"
+        )
+        if isinstance(c, CheckParametersConvergence)
+        else c
+        for c in callbacks
+    ]
+
+
+def _fit_vi(model, vi_params, random_seed):
+    """Run :func:`pymc3.fit` for ``model`` with the given seed (also in a worker process)."""
+    with model:
+        return pm.fit(random_seed=random_seed, **vi_params)
+
+
+def _final_loss(approximation):
+    """The negative ELBO at the end of a variational fit.
+
+    It is averaged over the last tenth of the iterations, since the single
+    estimates are noisy.
+    """
+    hist = approximation.hist
+    return np.mean(hist[-max(1, len(hist) // 10) :])
+
+
+def fit_pymc3_model(
+    self,
+    sampler,
+    draws,
+    tune,
+    vi_params,
+    store_draws=False,
+    chains=None,
+    cores=None,
+    vi_restarts=1,
+    **kwargs,
+):
+    """Fit ``self.model`` with the given sampler and store the posterior.
+
+    Parameters
+    ----------
+    sampler : {'variational', 'metropolis', 'nuts', 'map', 'mle'}
+        The sampler, see the fit methods of the learners
+    draws : int
+        The number of samples to draw
+    tune : int
+        The number of tuning iterations of the MCMC samplers
+    vi_params : dict
+        The parameters of :func:`pymc3.fit` for the **variational** sampler,
+        they are not modified
+    store_draws : bool
+        If True, all posterior draws are kept in ``self.posterior_draws_``
+    chains : int or None
+        The number of MCMC chains, by default between 2 and 4 depending on
+        the available CPUs
+    cores : int or None
+        The number of processes used for the chains and the variational
+        restarts, by default the number of CPUs available to this process
+        (see :func:`csrank.util.available_cpus`)
+    vi_restarts : int
+        The number of independent variational fits, started from different
+        points with different seeds. The fit with the best ELBO is kept.
+    **kwargs
+        Keyword arguments of :func:`pymc3.sample`, or options of L-BFGS-B
+        for 'map' and 'mle'
+    """
+    minibatches = getattr(self, "minibatch_size_", None) is not None
+    if minibatches and sampler != "variational":
+        raise ValueError(
+            "Minibatches can only be used with the variational sampler, not {}".format(
+                sampler
+            )
+        )
+    if sampler in ("map", "mle"):
+        fit_point_estimate(self, sampler, store_draws=store_draws, **kwargs)
+        return
+    if cores is None:
+        cores = available_cpus()
+    if chains is None:
+        chains = max(2, min(cores, 4))
+    # Never use more processes than there are chains to sample.
+    sample_cores = max(1, min(chains, cores))
     if sampler == "variational":
         with self.model:
             try:
-                self.trace_ = pm.sample(chains=2, cores=8, tune=5, draws=5)
-                vi_params["start"] = self.trace_[-1]
-                self.trace_vi_ = pm.fit(**vi_params)
+                starts = [vi_params.get("start", None)]
+                if not minibatches:
+                    # A few NUTS draws on the full data are the starting points
+                    # of the variational fits.
+                    self.trace_ = pm.sample(
+                        chains=chains, cores=sample_cores, tune=5, draws=5
+                    )
+                    starts = [
+                        self.trace_.point(-1, chain=chain)
+                        for chain in self.trace_.chains
+                    ]
+                random_state = check_random_state(getattr(self, "random_state_", None))
+                seeds = random_state.randint(np.iinfo(np.int32).max, size=vi_restarts)
+                # Every fit gets its own copy of the (stateful) convergence
+                # callbacks, the passed vi_params are not modified.
+                fit_params = [
+                    dict(
+                        vi_params,
+                        start=starts[i % len(starts)],
+                        callbacks=_absolute_convergence(vi_params.get("callbacks", [])),
+                    )
+                    for i in range(vi_restarts)
+                ]
+                n_jobs = min(vi_restarts, cores)
+                if n_jobs == 1:
+                    approximations = [
+                        _fit_vi(self.model, params, seed)
+                        for params, seed in zip(fit_params, seeds)
+                    ]
+                else:
+                    approximations = Parallel(n_jobs=n_jobs)(
+                        delayed(_fit_vi)(self.model, params, seed)
+                        for params, seed in zip(fit_params, seeds)
+                    )
+                self.trace_vi_ = min(approximations, key=_final_loss)
                 self.trace_ = self.trace_vi_.sample(draws=draws)
             except Exception as e:
                 if hasattr(e, "message"):
@@ -128,6 +378,8 @@ def fit_pymc3_model(self, sampler, draws, tune, vi_params, **kwargs):
                     message = e
                 logger.error(message)
                 self.trace_vi_ = None
+                if minibatches:
+                    raise
         if self.trace_vi_ is None and self.trace_ is None:
             with self.model:
                 logger.info(
@@ -135,15 +387,15 @@ def fit_pymc3_model(self, sampler, draws, tune, vi_params, **kwargs):
                         draws
                     )
                 )
-                self.trace = pm.sample(
-                    chains=1, cores=4, tune=20, draws=20, step=pm.NUTS()
+                self.trace_ = pm.sample(
+                    chains=1, cores=1, tune=20, draws=20, step=pm.NUTS()
                 )
     elif sampler == "metropolis":
         with self.model:
             start = pm.find_MAP()
             self.trace_ = pm.sample(
-                chains=2,
-                cores=8,
+                chains=chains,
+                cores=sample_cores,
                 tune=tune,
                 draws=draws,
                 **kwargs,
@@ -153,5 +405,11 @@ def fit_pymc3_model(self, sampler, draws, tune, vi_params, **kwargs):
     else:
         with self.model:
             self.trace_ = pm.sample(
-                chains=2, cores=8, tune=tune, draws=draws, **kwargs, step=pm.NUTS()
+                chains=chains,
+                cores=sample_cores,
+                tune=tune,
+                draws=draws,
+                **kwargs,
+                step=pm.NUTS(),
             )
+    store_posterior(self, store_draws=store_draws)
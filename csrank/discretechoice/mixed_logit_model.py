@@ -1,7 +1,10 @@
-from itertools import product
 import logging
 
+from joblib import delayed
+from joblib import Parallel
 import numpy as np
+from scipy.optimize import minimize
+from sklearn.utils import check_random_state
 
 from csrank.learner import Learner
 import csrank.numpy_util as npu
@@ -12,6 +15,7 @@ from .likelihoods import create_weight_dictionary
 from .likelihoods import fit_pymc3_model
 from .likelihoods import likelihood_dict
 from .likelihoods import LogLikelihood
+from .likelihoods import shared_data
 
 try:
     import pymc3 as pm
@@ -22,7 +26,6 @@ except ImportError:
     raise MissingExtraError("pymc3", "probabilistic")
 
 try:
-    import theano
     from theano import tensor as tt
 except ImportError:
     from csrank.util import MissingExtraError
@@ -32,8 +35,133 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+def _mixture_probabilities(X, weights, class_probabilities=None):
+    """Choice probabilities averaged over all weight vectors.
+
+    Parameters
+    ----------
+    X : numpy array (n_instances, n_objects, n_features)
+        Feature vectors of the objects
+    weights : numpy array (n_draws, n_features, n_mixtures)
+        Weight vectors of every mixture for every draw
+    class_probabilities : numpy array (n_mixtures,) or None
+        The share of every mixture, if None all mixtures are weighted equally
+
+    Returns
+    -------
+    p : numpy array (n_instances, n_objects)
+        The (weighted) mean of the softmax of the utilities over all draws and
+        mixtures
+    """
+    n_draws, n_features, n_mixtures = weights.shape
+    if class_probabilities is None:
+        class_probabilities = np.full(n_mixtures, 1.0 / n_mixtures)
+    # The utilities of all draws and mixtures with a single product
+    # (n_instances, n_objects, n_draws * n_mixtures).
+    utility = np.dot(X, weights.transpose(1, 0, 2).reshape(n_features, -1))
+    p = npu.softmax(utility, axis=1).reshape(utility.shape[:2] + (n_draws, n_mixtures))
+    return np.mean(np.dot(p, class_probabilities), axis=2)
+
+
+def _class_log_likelihoods(X, Y, weights):
+    """Log-likelihood of every choice under the logit model of every class.
+
+    Returns
+    -------
+    log_likelihoods : numpy array (n_instances, n_mixtures)
+        The log-probability of the chosen object under every class
+    p : numpy array (n_instances, n_objects, n_mixtures)
+        The choice probabilities of every class
+    """
+    utility = np.dot(X, weights)
+    log_p = utility - npu.logsumexp(utility, axis=1)
+    return np.sum(Y[:, :, None] * log_p, axis=1), np.exp(log_p)
+
+
+def _e_step(X, Y, weights, class_probabilities):
+    """Posterior class memberships of the instances and the log-likelihood."""
+    class_ll, _ = _class_log_likelihoods(X, Y, weights)
+    joint = class_ll + np.log(class_probabilities)
+    marginal = npu.logsumexp(joint, axis=1)
+    return np.exp(joint - marginal), np.sum(marginal)
+
+
+def _fit_latent_class(X, Y, n_mixtures, max_iter, tol, random_state):
+    """Fit a latent class logit model with one run of the EM algorithm.
+
+    The E-step computes the responsibilities (posterior class memberships) of
+    all classes for all instances at once. The M-step updates the class shares in closed form and the
+    weights of all classes with L-BFGS-B, maximizing the sum of the
+    log-likelihoods of the classes weighted by the responsibilities. Since
+    this objective is separable over the classes, all classes are fitted in a
+    single optimization.
+
+    Parameters
+    ----------
+    X : numpy array (n_instances, n_objects, n_features)
+        Feature vectors of the objects
+    Y : numpy array (n_instances, n_objects)
+        Choices for given objects in the query
+    n_mixtures : int
+        The number of latent classes
+    max_iter : int
+        The maximum number of EM iterations
+    tol : float
+        The EM iterations stop once the relative improvement of the
+        log-likelihood is below this tolerance
+    random_state : int, RandomState instance or None
+        Seed of the pseudo-random generator for the initial weights
+
+    Returns
+    -------
+    weights : numpy array (n_features, n_mixtures)
+        The weight vectors of the classes
+    class_probabilities : numpy array (n_mixtures,)
+        The shares of the classes
+    log_likelihood : float
+        The log-likelihood of the choices
+    n_iter : int
+        The number of EM iterations run
+    converged : bool
+        Whether the tolerance was reached before ``max_iter``
+    """
+    random_state = check_random_state(random_state)
+    n_features = X.shape[2]
+    weights = random_state.normal(size=(n_features, n_mixtures))
+    class_probabilities = np.full(n_mixtures, 1.0 / n_mixtures)
+    responsibilities, log_likelihood = _e_step(X, Y, weights, class_probabilities)
+    converged = False
+    n_iter = 0
+    while n_iter < max_iter and not converged:
+        n_iter += 1
+        class_probabilities = np.mean(responsibilities, axis=0)
+
+        def negative_log_likelihood(w):
+            w = w.reshape(n_features, n_mixtures)
+            class_ll, p = _class_log_likelihoods(X, Y, w)
+            residuals = responsibilities[:, None, :] * (Y[:, :, None] - p)
+            gradient = np.einsum("nof,nor->fr", X, residuals)
+            return -np.sum(responsibilities * class_ll), -gradient.ravel()
+
+        result = minimize(
+            negative_log_likelihood, weights.ravel(), jac=True, method="L-BFGS-B"
+        )
+        weights = result.x.reshape(n_features, n_mixtures)
+        previous = log_likelihood
+        responsibilities, log_likelihood = _e_step(X, Y, weights, class_probabilities)
+        converged = log_likelihood - previous <= tol * np.abs(log_likelihood)
+    return weights, class_probabilities, log_likelihood, n_iter, converged
+
+
 class MixedLogitModel(DiscreteObjectChooser, Learner):
-    def __init__(self, n_mixtures=4, loss_function="", regularization="l2", **kwargs):
+    def __init__(
+        self,
+        n_mixtures=4,
+        loss_function="",
+        regularization="l2",
+        random_state=None,
+        **kwargs,
+    ):
         """
             Create an instance of the Mixed Logit model for learning the discrete choice function. In this model we
             assume weights of this model to be random due to which this model can learn different variations in choices
@@ -81,6 +209,7 @@ class MixedLogitModel(DiscreteObjectChooser, Learner):
             )
         self.regularization = regularization
         self.n_mixtures = n_mixtures
+        self.random_state = random_state
 
     @property
     def model_configuration(self):
@@ -126,7 +255,7 @@ class MixedLogitModel(DiscreteObjectChooser, Learner):
             )
         return self.config_
 
-    def construct_model(self, X, Y):
+    def construct_model(self, X, Y, minibatch_size=None, float32=False):
         """
             Constructs the mixed logit model by applying priors on weight vectors **weights** as per
             :meth:`model_configuration`. The probability of choosing the object :math:`x_i` from the query set
@@ -144,26 +273,40 @@ class MixedLogitModel(DiscreteObjectChooser, Learner):
             Y : numpy array
                 (n_instances, n_objects)
                 Preferences in the form of discrete choices for given objects
+            minibatch_size : int or None
+                If given, the likelihood is evaluated on minibatches of this many instances (only for the
+                **variational** sampler)
+            float32 : bool
+                If True, the features are stored as float32
 
             Returns
             -------
              model : pymc3 Model :class:`pm.Model`
         """
         self.trace_ = None
-        self.trace_vi = None
+        self.trace_vi_ = None
         self.loss_function_ = likelihood_dict.get(self.loss_function, None)
         with pm.Model() as self.model:
-            self.Xt_ = theano.shared(X)
-            self.Yt_ = theano.shared(Y)
+            self.Xt_, self.Yt_ = shared_data(
+                self, X, Y, minibatch_size=minibatch_size, float32=float32
+            )
             shapes = {"weights": (self.n_object_features_fit_, self.n_mixtures)}
             weights_dict = create_weight_dictionary(self.model_configuration, shapes)
             utility = tt.dot(self.Xt_, weights_dict["weights"])
             self.p_ = tt.mean(ttu.softmax(utility, axis=1), axis=2)
             LogLikelihood(
-                "yl", loss_func=self.loss_function_, p=self.p_, observed=self.Yt_
+                "yl",
+                loss_func=self.loss_function_,
+                p=self.p_,
+                observed=self.Yt_,
+                total_size=self.total_size_,
             )
         logger.info("Model construction completed")
 
+    def _pre_fit(self):
+        super()._pre_fit()
+        self.random_state_ = check_random_state(self.random_state)
+
     def fit(
         self,
         X,
@@ -176,6 +319,13 @@ class MixedLogitModel(DiscreteObjectChooser, Learner):
             "method": "advi",
             "callbacks": [CheckParametersConvergence()],
         },
+        store_draws=False,
+        minibatch_size=None,
+        float32=False,
+        chains=None,
+        cores=None,
+        vi_restarts=1,
+        em_params=None,
         **kwargs,
     ):
         """
@@ -196,12 +346,16 @@ class MixedLogitModel(DiscreteObjectChooser, Learner):
                 Feature vectors of the objects
             Y : numpy array (n_instances, n_objects)
                 Choices for given objects in the query
-            sampler : {‘variational’, ‘metropolis’, ‘nuts’}, string
+            sampler : {‘variational’, ‘metropolis’, ‘nuts’, ‘map’, ‘mle’, ‘em’}, string
                 The sampler used to estimate the posterior mean and mass matrix from the trace
 
                     * **variational** : Run inference methods to estimate posterior mean and diagonal mass matrix
                     * **metropolis** : Use the MAP as starting point and Metropolis-Hastings sampler
                     * **nuts** : Use the No-U-Turn sampler
+                    * **map** : Maximize the posterior density, i.e. the likelihood penalized by the priors, with L-BFGS-B
+                    * **mle** : Maximize the likelihood with L-BFGS-B
+                    * **em** : Fit a latent class logit model, in which every instance belongs to one of the mixtures
+                      with a learned share, with the EM algorithm (see :meth:`fit_em`). No pymc3 model is constructed.
             vi_params : dict
                 The parameters for the **variational** inference method
             draws : int
@@ -211,20 +365,200 @@ class MixedLogitModel(DiscreteObjectChooser, Learner):
                 the step sizes, scalings or similar during tuning. Tuning samples will be drawn in addition
                 to the number specified in the `draws` argument, and will be discarded unless
                 `discard_tuned_samples` is set to False.
+            store_draws : bool
+                If True, all posterior draws of the parameters are kept as float32 arrays in ``posterior_draws_``
+            minibatch_size : int or None
+                If given, every step of the **variational** inference uses a random minibatch of this many instances
+                instead of all instances, so that its cost does not depend on the size of the data
+            float32 : bool
+                If True, the features are stored as float32, which halves the memory of the data
+            chains : int or None
+                The number of chains of the MCMC samplers, by default between 2 and 4 depending on the available CPUs
+            cores : int or None
+                The number of processes used for the chains and the variational restarts, by default the number of
+                CPUs available to this process, which respects the CPU affinity and the cgroup CPU quota
+            vi_restarts : int
+                The number of independent **variational** fits run in parallel, the one with the best ELBO is kept
+            em_params : dict or None
+                The parameters of :meth:`fit_em` for the **em** sampler, which default to
+                ``{"n_restarts": 1, "max_iter": 100, "tol": 1e-6}``
             **kwargs :
-                Keyword arguments for the fit function of :meth:`pymc3.fit`or :meth:`pymc3.sample`
+                Keyword arguments for the fit function of :meth:`pymc3.fit`or :meth:`pymc3.sample`, or options of
+                L-BFGS-B for **map** and **mle**
+        """
+        if sampler == "em":
+            em_params = dict(
+                {"n_restarts": 1, "max_iter": 100, "tol": 1e-6}, **(em_params or {})
+            )
+            return self.fit_em(X, Y, store_draws=store_draws, **em_params)
+        self._pre_fit()
+        _n_instances, self.n_objects_fit_, self.n_object_features_fit_ = X.shape
+        self.construct_model(X, Y, minibatch_size=minibatch_size, float32=float32)
+        fit_pymc3_model(
+            self,
+            sampler,
+            draws,
+            tune,
+            vi_params,
+            store_draws=store_draws,
+            chains=chains,
+            cores=cores,
+            vi_restarts=vi_restarts,
+            **kwargs,
+        )
+        return self
+
+    def fit_em(
+        self,
+        X,
+        Y,
+        n_restarts=1,
+        max_iter=100,
+        tol=1e-6,
+        n_jobs=None,
+        store_draws=False,
+    ):
+        """
+            Fit the mixtures as a latent class logit model with the EM algorithm. Each instance is assumed to belong
+            to one of the :math:`R` classes with probability :math:`\\pi_r`, so that
+
+            .. math::
+
+                P(x_i \\lvert Q) = \\sum_{r=1}^R \\pi_r \\frac{exp(U_r(x_i))}{\\sum_{x_j \\in Q} exp(U_r(x_j))}
+
+            The E-step computes the posterior class memberships of all instances, the M-step updates the class shares
+            and fits the weight vectors of all classes as weighted multinomial logit models with L-BFGS-B. Since EM
+            only finds a local maximum of the likelihood, it can be restarted from several random initial weights,
+            keeping the fit with the highest likelihood.
+
+            The weights are stored in ``posterior_means_["weights"]`` and the class shares in
+            ``posterior_means_["class_probabilities"]``, so that the same prediction code as for the pymc3 fits
+            is used.
+
+            Parameters
+            ----------
+            X : numpy array (n_instances, n_objects, n_features)
+                Feature vectors of the objects
+            Y : numpy array (n_instances, n_objects)
+                Choices for given objects in the query
+            n_restarts : int
+                The number of runs of EM from random initial weights
+            max_iter : int
+                The maximum number of EM iterations of each run
+            tol : float
+                A run stops once the relative improvement of the log-likelihood is below this tolerance
+            n_jobs : int or None
+                Number of processes the restarts are run in (see :class:`joblib.Parallel`)
+            store_draws : bool
+                If True, also store the estimate as a single draw in ``posterior_draws_``
         """
         self._pre_fit()
         _n_instances, self.n_objects_fit_, self.n_object_features_fit_ = X.shape
-        self.construct_model(X, Y)
-        fit_pymc3_model(self, sampler, draws, tune, vi_params, **kwargs)
+        self.trace_ = None
+        seeds = self.random_state_.randint(np.iinfo(np.int32).max, size=n_restarts)
+        fit_args = (X, Y, self.n_mixtures, max_iter, tol)
+        if n_jobs is None or n_jobs == 1:
+            runs = [_fit_latent_class(*fit_args, seed) for seed in seeds]
+        else:
+            runs = Parallel(n_jobs=n_jobs)(
+                delayed(_fit_latent_class)(*fit_args, seed) for seed in seeds
+            )
+        weights, class_probabilities, log_likelihood, n_iter, converged = max(
+            runs, key=lambda run: run[2]
+        )
+        if not converged:
+            logger.warning("EM did not converge in {} iterations".format(max_iter))
+        self.log_likelihood_ = log_likelihood
+        self.n_iter_ = n_iter
+        self.converged_ = converged
+        self.posterior_means_ = {
+            "weights": weights,
+            "class_probabilities": class_probabilities,
+        }
+        if store_draws:
+            self.posterior_draws_ = {
+                name: value[None].astype(np.float32)
+                for name, value in self.posterior_means_.items()
+            }
+        else:
+            self.posterior_draws_ = None
         return self
 
-    def _predict_scores_fixed(self, X, **kwargs):
-        summary = dict(pm.summary(self.trace_)["mean"])
-        weights = np.zeros((self.n_object_features_fit_, self.n_mixtures))
-        for i, k in product(range(self.n_object_features_fit_), range(self.n_mixtures)):
-            weights[i][k] = summary["weights[{},{}]".format(i, k)]
-        utility = np.dot(X, weights)
-        p = np.mean(npu.softmax(utility, axis=1), axis=2)
-        return p
+    def _weight_draws(self, n_draws, random_state=None):
+        """Return ``n_draws`` random posterior draws of the weights (or all if there are fewer)."""
+        if getattr(self, "posterior_draws_", None) is not None:
+            draws = self.posterior_draws_["weights"]
+        elif getattr(self, "trace_", None) is not None:
+            draws = self.trace_["weights"]
+        else:
+            raise ValueError(
+                "No posterior draws of the weights are available, fit with store_draws=True."
+            )
+        if n_draws < len(draws):
+            random_state = check_random_state(random_state)
+            draws = draws[random_state.choice(len(draws), n_draws, replace=False)]
+        return draws
+
+    def predict_scores(
+        self,
+        X,
+        n_draws=None,
+        random_state=None,
+        n_jobs=None,
+        block_size=10 ** 7,
+        **kwargs,
+    ):
+        """
+            Predict the choice probabilities for each object in the collection of set of objects called a query
+            set. By default these are the probabilities for the posterior mean of the weights. If ``n_draws`` is
+            given, the probabilities are instead integrated over that many posterior draws of the weights, which
+            are evaluated together in batches of instances.
+
+            Parameters
+            ----------
+            X : dict or numpy array
+                Dictionary with a mapping from query set size to numpy arrays or a single numpy array of size:
+                (n_instances, n_objects, n_features)
+            n_draws : int or None
+                Number of random posterior draws to average the probabilities over. If there are fewer draws,
+                all are used. Uses the draws stored with ``fit(..., store_draws=True)`` or the trace.
+            random_state : int, RandomState instance or None
+                Seed of the pseudo-random generator selecting the draws
+            n_jobs : int or None
+                Number of jobs used to process the batches of instances (see :class:`joblib.Parallel`)
+            block_size : int
+                Maximal number of utilities (instances times objects times draws times mixtures) that are
+                computed at once, this bounds the memory
+
+            Returns
+            -------
+            Y : dict or numpy array
+                Dictionary with a mapping from query set size to numpy arrays or a single numpy array of size:
+                (n_instances, n_objects)
+        """
+        if n_draws is None:
+            weights = self.posterior_means_["weights"][None]
+        else:
+            weights = self._weight_draws(n_draws, random_state=random_state)
+        return super().predict_scores(
+            X, weights=weights, n_jobs=n_jobs, block_size=block_size, **kwargs
+        )
+
+    def _predict_scores_fixed(
+        self, X, weights=None, n_jobs=None, block_size=10 ** 7, **kwargs
+    ):
+        if weights is None:
+            weights = self.posterior_means_["weights"][None]
+        n_instances, n_objects, _ = X.shape
+        chunk_size = max(
+            1, block_size // (n_objects * weights.shape[0] * self.n_mixtures)
+        )
+        chunks = [X[i : i + chunk_size] for i in range(0, n_instances, chunk_size)]
+        shares = self.posterior_means_.get("class_probabilities")
+        if n_jobs is None or n_jobs == 1:
+            p = [_mixture_probabilities(x, weights, shares) for x in chunks]
+        else:
+            p = Parallel(n_jobs=n_jobs)(
+                delayed(_mixture_probabilities)(x, weights, shares) for x in chunks
+            )
+        return np.concatenate(p)
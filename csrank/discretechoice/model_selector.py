@@ -1,10 +1,18 @@
 from abc import ABCMeta
 from itertools import product
 import logging
+import os
 import pickle as pk
+import re
+import tempfile
 
+from joblib import delayed
+from joblib import Parallel
 import numpy as np
 
+from csrank.util import create_dir_recursively
+from .likelihoods import _final_loss
+
 try:
     import pymc3 as pm
 except ImportError:
@@ -15,6 +23,72 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+def _dump_atomic(obj, file_path):
+    """Pickle ``obj`` to a temporary file next to ``file_path`` and move it there.
+
+    Since the move is atomic, ``file_path`` either does not exist or contains
+    the complete result, even if the process is killed while writing.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pk.dump(obj, f)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def summarize_learner(learner):
+    """A compact summary of a fitted pymc3 learner to compare the priors.
+
+    Instead of the model and the whole trace only the posterior means, the
+    ELBO of the variational fit and the WAIC of the trace are kept.
+
+    Parameters
+    ----------
+    learner : Learner
+        A learner fitted with :func:`fit_pymc3_model`
+
+    Returns
+    -------
+    summary : dict
+        The ``posterior_means``, the ``elbo`` (None if the variational
+        sampler was not used), the ``waic`` (None if there is no trace or
+        it cannot be computed) and the ``error``, which is None for a
+        successful fit
+    """
+    trace_vi = getattr(learner, "trace_vi_", None)
+    trace = getattr(learner, "trace_", None)
+    waic = None
+    if trace is not None:
+        try:
+            waic = pm.waic(trace, learner.model)
+        except Exception as e:
+            logger.warning("Could not compute the WAIC: {}".format(e))
+    return {
+        "posterior_means": learner.posterior_means_,
+        "elbo": None if trace_vi is None else -_final_loss(trace_vi),
+        "waic": waic,
+        "error": None,
+    }
+
+
+def _failure_summary(error):
+    """The summary stored instead of :func:`summarize_learner` if the fit failed."""
+    return {
+        "posterior_means": None,
+        "elbo": None,
+        "waic": None,
+        "error": "{}: {}".format(type(error).__name__, error),
+    }
+
+
+def _load_summary(file_path):
+    with open(file_path, "rb") as f:
+        return pk.load(f)
+
+
 class ModelSelector(metaclass=ABCMeta):
     def __init__(
         self,
@@ -57,64 +131,146 @@ class ModelSelector(metaclass=ABCMeta):
         self.model_path = model_path
         self.models = dict()
 
-    def fit(self, X, Y):
-        self._pre_fit()
-        model_args = dict()
-        for param_key in self.parameter_keys:
-            model_args[param_key] = self.uniform_prior
-        logger.info("Uniform Prior")
-        self.model_params["model_args"] = model_args
-        key = "{}_uniform_prior".format(self.parameter_keys)
-        self.fit_learner(X, Y, key)
+    def grid(self):
+        """The prior combinations to be evaluated.
+
+        Returns
+        -------
+        grid : list of (str, dict)
+            The key and the ``model_args`` of every prior combination
+        """
+        model_args = {
+            param_key: self.uniform_prior for param_key in self.parameter_keys
+        }
+        grid = [("{}_uniform_prior".format(self.parameter_keys), model_args)]
         for j, param in enumerate(self.parameters):
-            logger.info("mu: {}, sd/b: {}".format(*self.parameter_ind[j]))
+            mu, sd = self.parameter_ind[j]
             if len(self.parameter_keys) == 2:
                 for i1, i2 in product(self.prior_indices, self.prior_indices):
                     prior1 = self.priors[i1]
                     prior2 = self.priors[i2]
-                    logger.info("Priors {}, {}".format(i1, i2))
-                    model_args = dict()
-                    k1 = list(prior1[1].keys())
-                    k2 = list(prior2[1].keys())
-                    prior1[1] = dict(zip(k1, param))
-                    prior2[1] = dict(zip(k2, param))
-                    model_args[self.parameter_keys[0]] = prior1
-                    model_args[self.parameter_keys[1]] = prior2
+                    model_args = {
+                        self.parameter_keys[0]: [
+                            prior1[0],
+                            dict(zip(prior1[1].keys(), param)),
+                        ],
+                        self.parameter_keys[1]: [
+                            prior2[0],
+                            dict(zip(prior2[1].keys(), param)),
+                        ],
+                    }
                     key = "{}_{}_{}_{}_mu_{}_sd_{}".format(
-                        self.parameter_keys[0],
-                        i1,
-                        self.parameter_keys[1],
-                        i2,
-                        self.parameter_ind[j][0],
-                        self.parameter_ind[j][1],
+                        self.parameter_keys[0], i1, self.parameter_keys[1], i2, mu, sd,
                     )
-                    self.model_params["model_args"] = model_args
-                    self.fit_learner(X, Y, key)
+                    grid.append((key, model_args))
             else:
                 for i, prior in enumerate(self.priors):
-                    logger.info("Prior {}".format(i))
-                    model_args = dict()
-                    k1 = list(prior[1].keys())
-                    prior[1] = dict(zip(k1, param))
-                    model_args[self.parameter_keys[0]] = prior
-                    self.model_params["model_args"] = model_args
-                    key = "{}_{}_mu_{}_sd_{}".format(
-                        self.parameter_keys[0],
-                        i,
-                        self.parameter_ind[j][0],
-                        self.parameter_ind[j][1],
-                    )
-                    self.fit_learner(X, Y, key)
+                    model_args = {
+                        self.parameter_keys[0]: [
+                            prior[0],
+                            dict(zip(prior[1].keys(), param)),
+                        ]
+                    }
+                    key = "{}_{}_mu_{}_sd_{}".format(self.parameter_keys[0], i, mu, sd)
+                    grid.append((key, model_args))
+        return grid
+
+    def result_path(self, key):
+        """The file the summary of the fit for the given key is stored in.
+
+        Characters of the key which are not usable in a file name, like the
+        brackets and quotes of the uniform prior key, are replaced.
+        """
+        file_name = re.sub(r"[\W_]+", "_", key).strip("_")
+        return os.path.join(self.model_path, "{}.pkl".format(file_name))
+
+    def fit(self, X, Y, n_jobs=None, skip_failed=False):
+        """
+            Fit the learner for every prior combination of :meth:`grid`. The summary of every fit (see
+            :func:`summarize_learner`) is written to its own file in the directory ``model_path``, as soon as the
+            fit is done. If a fit fails, a summary with the ``error`` is written instead. Combinations for which
+            such a file already exists are not fitted again, so that an interrupted run can be resumed, except for
+            failed combinations unless ``skip_failed`` is set. Afterwards all summaries, including the failed ones,
+            are available in ``models``.
+
+            Parameters
+            ----------
+            X : numpy array (n_instances, n_objects, n_features)
+                Feature vectors of the objects
+            Y : numpy array (n_instances, n_objects)
+                Choices for given objects in the query
+            n_jobs : int or None
+                Number of processes the prior combinations are fitted in (see :class:`joblib.Parallel`)
+            skip_failed : bool
+                If True, combinations whose stored summary has an ``error`` are not fitted again
+
+            Raises
+            ------
+            ValueError
+                If ``model_path`` is a file, like the single pickle file older versions wrote all models to
+        """
+        if os.path.isfile(self.model_path):
+            raise ValueError(
+                "model_path {} is a file, but it has to be the directory the result of every prior "
+                "combination is stored in.".format(self.model_path)
+            )
+        create_dir_recursively(self.model_path)
+        grid = self.grid()
+        todo = []
+        for key, model_args in grid:
+            path = self.result_path(key)
+            if not os.path.exists(path) or (
+                not skip_failed and _load_summary(path).get("error") is not None
+            ):
+                todo.append((key, model_args))
+        logger.info("Fitting {} of {} prior combinations".format(len(todo), len(grid)))
+        if n_jobs is None or n_jobs == 1:
+            for key, model_args in todo:
+                self.fit_learner(X, Y, key, model_args)
+        else:
+            Parallel(n_jobs=n_jobs)(
+                delayed(self.fit_learner)(X, Y, key, model_args)
+                for key, model_args in todo
+            )
+        self.models = dict()
+        for key, _ in grid:
+            if os.path.exists(self.result_path(key)):
+                self.models[key] = _load_summary(self.result_path(key))
+        failed = [
+            key
+            for key, summary in self.models.items()
+            if summary.get("error") is not None
+        ]
+        if failed:
+            logger.warning(
+                "{} of {} prior combinations failed: {}".format(
+                    len(failed), len(grid), ", ".join(failed)
+                )
+            )
         return self
 
-    def fit_learner(self, X, Y, key):
-        learner = self.learner_cls(**self.model_params)
+    def fit_learner(self, X, Y, key, model_args):
+        """
+            Fit the learner with the given priors and store its summary in :meth:`result_path`. Errors are logged
+            and stored as a summary with the ``error``, so that they show up in ``models``.
+
+            Parameters
+            ----------
+            X : numpy array (n_instances, n_objects, n_features)
+                Feature vectors of the objects
+            Y : numpy array (n_instances, n_objects)
+                Choices for given objects in the query
+            key : str
+                The key of the prior combination
+            model_args : dict
+                The priors of the parameters
+        """
+        logger.info("Fitting priors key {}".format(key))
+        learner = self.learner_cls(**dict(self.model_params, model_args=model_args))
         try:
             learner.fit(X, Y, **self.fit_params)
-            self.models[key] = {"model": learner.model, "trace": learner.trace}
+            _dump_atomic(summarize_learner(learner), self.result_path(key))
             logger.info("Model done for priors key {}".format(key))
-            f = open(self.model_path, "wb")
-            pk.dump(self.models, f)
-            f.close()
         except Exception as e:
             logger.error("Error for parameters {}: {}".format(key, e))
+            _dump_atomic(_failure_summary(e), self.result_path(key))
@@ -10,6 +10,7 @@ from .likelihoods import create_weight_dictionary
 from .likelihoods import fit_pymc3_model
 from .likelihoods import likelihood_dict
 from .likelihoods import LogLikelihood
+from .likelihoods import shared_data
 
 try:
     import pymc3 as pm
@@ -20,7 +21,6 @@ except ImportError:
     raise MissingExtraError("pymc3", "probabilistic")
 
 try:
-    import theano
     from theano import tensor as tt
 except ImportError:
     from csrank.util import MissingExtraError
@@ -117,7 +117,7 @@ class MultinomialLogitModel(DiscreteObjectChooser, Learner):
             )
         return self.config_
 
-    def construct_model(self, X, Y):
+    def construct_model(self, X, Y, minibatch_size=None, float32=False):
         """
             Constructs the multinomial logit model which evaluated the utility score as :math:`U(x) = w \\cdot x`, where
             :math:`w` is the weight vector. The probability of choosing the object :math:`x_i` from the query set
@@ -135,6 +135,11 @@ class MultinomialLogitModel(DiscreteObjectChooser, Learner):
             Y : numpy array
                 (n_instances, n_objects)
                 Preferences in the form of discrete choices for given objects
+            minibatch_size : int or None
+                If given, the likelihood is evaluated on minibatches of this many instances (only for the
+                **variational** sampler)
+            float32 : bool
+                If True, the features are stored as float32
 
             Returns
             -------
@@ -149,8 +154,9 @@ class MultinomialLogitModel(DiscreteObjectChooser, Learner):
         )
         self.loss_function_ = likelihood_dict.get(self.loss_function, None)
         with pm.Model() as self.model:
-            self.Xt_ = theano.shared(X)
-            self.Yt_ = theano.shared(Y)
+            self.Xt_, self.Yt_ = shared_data(
+                self, X, Y, minibatch_size=minibatch_size, float32=float32
+            )
             shapes = {"weights": self.n_object_features_fit_}
             # shapes = {'weights': (self.n_object_features_fit_, 3)}
             weights_dict = create_weight_dictionary(self.model_configuration, shapes)
@@ -159,7 +165,11 @@ class MultinomialLogitModel(DiscreteObjectChooser, Learner):
             self.p_ = ttu.softmax(utility, axis=1)
 
             LogLikelihood(
-                "yl", loss_func=self.loss_function_, p=self.p_, observed=self.Yt_
+                "yl",
+                loss_func=self.loss_function_,
+                p=self.p_,
+                observed=self.Yt_,
+                total_size=self.total_size_,
             )
         logger.info("Model construction completed")
 
@@ -175,6 +185,12 @@ class MultinomialLogitModel(DiscreteObjectChooser, Learner):
             "method": "advi",
             "callbacks": [CheckParametersConvergence()],
         },
+        store_draws=False,
+        minibatch_size=None,
+        float32=False,
+        chains=None,
+        cores=None,
+        vi_restarts=1,
         **kwargs,
     ):
         """
@@ -195,12 +211,14 @@ class MultinomialLogitModel(DiscreteObjectChooser, Learner):
                 Feature vectors of the objects
             Y : numpy array (n_instances, n_objects)
                 Choices for given objects in the query
-            sampler : {‘variational’, ‘metropolis’, ‘nuts’}, string
+            sampler : {‘variational’, ‘metropolis’, ‘nuts’, ‘map’, ‘mle’}, string
                 The sampler used to estimate the posterior mean and mass matrix from the trace
 
                     * **variational** : Run inference methods to estimate posterior mean and diagonal mass matrix
                     * **metropolis** : Use the MAP as starting point and Metropolis-Hastings sampler
                     * **nuts** : Use the No-U-Turn sampler
+                    * **map** : Maximize the posterior density, i.e. the likelihood penalized by the priors, with L-BFGS-B
+                    * **mle** : Maximize the likelihood with L-BFGS-B
             vi_params : dict
                 The parameters for the **variational** inference method
             draws : int
@@ -210,21 +228,42 @@ class MultinomialLogitModel(DiscreteObjectChooser, Learner):
                 the step sizes, scalings or similar during tuning. Tuning samples will be drawn in addition
                 to the number specified in the `draws` argument, and will be discarded unless
                 `discard_tuned_samples` is set to False.
+            store_draws : bool
+                If True, all posterior draws of the parameters are kept as float32 arrays in ``posterior_draws_``
+            minibatch_size : int or None
+                If given, every step of the **variational** inference uses a random minibatch of this many instances
+                instead of all instances, so that its cost does not depend on the size of the data
+            float32 : bool
+                If True, the features are stored as float32, which halves the memory of the data
+            chains : int or None
+                The number of chains of the MCMC samplers, by default between 2 and 4 depending on the available CPUs
+            cores : int or None
+                The number of processes used for the chains and the variational restarts, by default the number of
+                CPUs available to this process, which respects the CPU affinity and the cgroup CPU quota
+            vi_restarts : int
+                The number of independent **variational** fits run in parallel, the one with the best ELBO is kept
             **kwargs :
-                Keyword arguments for the fit function of :meth:`pymc3.fit`or :meth:`pymc3.sample`
+                Keyword arguments for the fit function of :meth:`pymc3.fit`or :meth:`pymc3.sample`, or options of
+                L-BFGS-B for **map** and **mle**
         """
         self._pre_fit()
         _n_instances, self.n_objects_fit_, self.n_object_features_fit_ = X.shape
-        self.construct_model(X, Y)
-        fit_pymc3_model(self, sampler, draws, tune, vi_params, **kwargs)
+        self.construct_model(X, Y, minibatch_size=minibatch_size, float32=float32)
+        fit_pymc3_model(
+            self,
+            sampler,
+            draws,
+            tune,
+            vi_params,
+            store_draws=store_draws,
+            chains=chains,
+            cores=cores,
+            vi_restarts=vi_restarts,
+            **kwargs,
+        )
         return self
 
     def _predict_scores_fixed(self, X, **kwargs):
-        d = dict(pm.summary(self.trace_)["mean"])
-        intercept = 0.0
-        weights = np.array(
-            [d["weights[{}]".format(i)] for i in range(self.n_object_features_fit_)]
-        )
-        if "intercept" in d:
-            intercept = intercept + d["intercept"]
+        weights = self.posterior_means_["weights"]
+        intercept = self.posterior_means_.get("intercept", 0.0)
         return np.dot(X, weights) + intercept
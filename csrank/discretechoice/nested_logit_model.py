@@ -13,6 +13,7 @@ from csrank.util import print_dictionary
 from .discrete_choice import DiscreteObjectChooser
 from .likelihoods import likelihood_dict
 from .likelihoods import LogLikelihood
+from .likelihoods import shared_data
 
 try:
     import pymc3 as pm
@@ -23,7 +24,6 @@ except ImportError:
     raise MissingExtraError("pymc3", "probabilistic")
 
 try:
-    import theano
     from theano import tensor as tt
 except ImportError:
     from csrank.util import MissingExtraError
@@ -193,14 +193,13 @@ class NestedLogitModel(DiscreteObjectChooser, Learner):
         Yn = np.array(Yn)
         return Yn
 
+    def _nest_indicators(self):
+        """One-hot encoding (n_instances, n_objects, n_nests) of the nests of the objects."""
+        return tt.eq(self.y_nests_[:, :, None], tt.arange(self.n_nests))
+
     def _eval_utility(self, weights):
-        utility = tt.zeros(tuple(self.y_nests_.shape))
-        for i in range(self.n_nests):
-            rows, cols = tt.eq(self.y_nests_, i).nonzero()
-            utility = tt.set_subtensor(
-                utility[rows, cols], tt.dot(self.Xt_[rows, cols], weights[i])
-            )
-        return utility
+        nests = self._nest_indicators()
+        return tt.sum(nests * tt.dot(self.Xt_, weights.T), axis=2)
 
     def get_probabilities(self, utility, lambda_k, utility_k):
         """
@@ -236,54 +235,32 @@ class NestedLogitModel(DiscreteObjectChooser, Learner):
                 Choice probabilities :math:`P_i` of the objects :math:`x_i \\in Q` in the query sets
 
         """
-        n_instances, n_objects = self.y_nests_.shape
-        pni_k = tt.zeros((n_instances, n_objects))
-        ivm = tt.zeros((n_instances, self.n_nests))
-        for i in range(self.n_nests):
-            rows, cols = tt.neq(self.y_nests_, i).nonzero()
-            sub_tensor = tt.set_subtensor(utility[rows, cols], -1e50)
-            ink = ttu.logsumexp(sub_tensor)
-            rows, cols = tt.eq(self.y_nests_, i).nonzero()
-            pni_k = tt.set_subtensor(
-                pni_k[rows, cols], tt.exp(sub_tensor - ink)[rows, cols]
-            )
-            ivm = tt.set_subtensor(ivm[:, i], lambda_k[i] * ink[:, 0] + utility_k[i])
-        pk = tt.exp(ivm - ttu.logsumexp(ivm))
-        pn_k = tt.zeros((n_instances, n_objects))
-        for i in range(self.n_nests):
-            rows, cols = tt.eq(self.y_nests_, i).nonzero()
-            p = tt.ones((n_instances, n_objects)) * pk[:, i][:, None]
-            pn_k = tt.set_subtensor(pn_k[rows, cols], p[rows, cols])
-        p = pni_k * pn_k
+        nests = self._nest_indicators()
+        # Log-sum-exp over the objects of every nest, the inclusive values are
+        # lambda_k times these. Objects of other nests are masked out.
+        masked = tt.switch(nests, utility[:, :, None], -1e50)
+        ink = ttu.logsumexp(masked, axis=1)
+        ivm = lambda_k * ink[:, 0, :] + utility_k
+        log_pk = ivm - ttu.logsumexp(ivm)
+        # log P_i = Y_i - I_k + log P(B_k) for the nest B_k of every object
+        nest_term = tt.sum(nests * (ink - log_pk[:, None, :]), axis=2)
+        p = tt.exp(utility - nest_term)
         return p
 
     def _eval_utility_np(self, x_t, y_nests, weights):
-        utility = np.zeros(tuple(y_nests.shape))
-        for i in range(self.n_nests):
-            rows, cols = np.where(y_nests == i)
-            utility[rows, cols] = np.dot(x_t[rows, cols], weights[i])
-        return utility
+        return np.einsum("ijk,ijk->ij", x_t, weights[y_nests])
 
     def _get_probabilities_np(self, Y_n, utility, lambda_k, utility_k):
-        n_instances, n_objects = Y_n.shape
-        pni_k = np.zeros((n_instances, n_objects))
-        ivm = np.zeros((n_instances, self.n_nests))
-        for i in range(self.n_nests):
-            sub_tensor = np.copy(utility)
-            sub_tensor[np.where(Y_n != i)] = -1e50
-            ink = npu.logsumexp(sub_tensor)
-            pni_k[np.where(Y_n == i)] = np.exp(sub_tensor - ink)[np.where(Y_n == i)]
-            ivm[:, i] = lambda_k[i] * ink[:, 0] + utility_k[i]
-        pk = np.exp(ivm - npu.logsumexp(ivm))
-        pn_k = np.zeros((n_instances, n_objects))
-        for i in range(self.n_nests):
-            rows, cols = np.where(Y_n == i)
-            p = np.ones((n_instances, n_objects)) * pk[:, i][:, None]
-            pn_k[rows, cols] = p[rows, cols]
-        p = pni_k * pn_k
+        nests = Y_n[:, :, None] == np.arange(self.n_nests)
+        masked = np.where(nests, utility[:, :, None], -1e50)
+        ink = npu.logsumexp(masked, axis=1)[:, 0]
+        ivm = lambda_k * ink + utility_k
+        log_pk = ivm - npu.logsumexp(ivm)
+        nest_term = np.take_along_axis(ink - log_pk, Y_n, axis=1)
+        p = np.exp(utility - nest_term)
         return p
 
-    def construct_model(self, X, Y):
+    def construct_model(self, X, Y, minibatch_size=None, float32=False):
         """
             Constructs the nested logit model by applying priors on weight vectors **weights** and **weights_k** as per
             :meth:`model_configuration`. Then we apply a uniform prior to the :math:`\\lambda s`, i.e.
@@ -298,6 +275,11 @@ class NestedLogitModel(DiscreteObjectChooser, Learner):
             Y : numpy array
                 (n_instances, n_objects)
                 Preferences in the form of discrete choices for given objects
+            minibatch_size : int or None
+                If given, the likelihood is evaluated on minibatches of this many instances (only for the
+                **variational** sampler)
+            float32 : bool
+                If True, the features are stored as float32
 
             Returns
             -------
@@ -307,7 +289,7 @@ class NestedLogitModel(DiscreteObjectChooser, Learner):
         self.threshold_ = 5e6
         self.trace_ = None
         self.trace_vi_ = None
-        if np.prod(X.shape) > self.threshold_:
+        if minibatch_size is None and np.prod(X.shape) > self.threshold_:
             upper_bound = int(self.threshold_ / np.prod(X.shape[1:]))
             indices = self.random_state_.choice(X.shape[0], upper_bound, replace=False)
             X = X[indices, :, :]
@@ -315,9 +297,9 @@ class NestedLogitModel(DiscreteObjectChooser, Learner):
         logger.info("Train Set instances {} objects {} features {}".format(*X.shape))
         y_nests = self.create_nests(X)
         with pm.Model() as self.model:
-            self.Xt_ = theano.shared(X)
-            self.Yt_ = theano.shared(Y)
-            self.y_nests_ = theano.shared(y_nests)
+            self.Xt_, self.Yt_, self.y_nests_ = shared_data(
+                self, X, Y, y_nests, minibatch_size=minibatch_size, float32=float32
+            )
             shapes = {
                 "weights": self.n_object_features_fit_,
                 "weights_k": self.n_object_features_fit_,
@@ -331,7 +313,11 @@ class NestedLogitModel(DiscreteObjectChooser, Learner):
             self.p_ = self.get_probabilities(utility, lambda_k, utility_k)
 
             LogLikelihood(
-                "yl", loss_func=self.loss_function_, p=self.p_, observed=self.Yt_
+                "yl",
+                loss_func=self.loss_function_,
+                p=self.p_,
+                observed=self.Yt_,
+                total_size=self.total_size_,
             )
         logger.info("Model construction completed")
 
@@ -347,6 +333,12 @@ class NestedLogitModel(DiscreteObjectChooser, Learner):
             "method": "advi",
             "callbacks": [CheckParametersConvergence()],
         },
+        store_draws=False,
+        minibatch_size=None,
+        float32=False,
+        chains=None,
+        cores=None,
+        vi_restarts=1,
         **kwargs,
     ):
         """
@@ -367,12 +359,14 @@ class NestedLogitModel(DiscreteObjectChooser, Learner):
                 Feature vectors of the objects
             Y : numpy array (n_instances, n_objects)
                 Choices for given objects in the query
-            sampler : {‘variational’, ‘metropolis’, ‘nuts’}, string
+            sampler : {‘variational’, ‘metropolis’, ‘nuts’, ‘map’, ‘mle’}, string
                 The sampler used to estimate the posterior mean and mass matrix from the trace
 
                     * **variational** : Run inference methods to estimate posterior mean and diagonal mass matrix
                     * **metropolis** : Use the MAP as starting point and Metropolis-Hastings sampler
                     * **nuts** : Use the No-U-Turn sampler
+                    * **map** : Maximize the posterior density, i.e. the likelihood penalized by the priors, with L-BFGS-B
+                    * **mle** : Maximize the likelihood with L-BFGS-B
             vi_params : dict
                 The parameters for the **variational** inference method
             draws : int
@@ -382,36 +376,49 @@ class NestedLogitModel(DiscreteObjectChooser, Learner):
                 the step sizes, scalings or similar during tuning. Tuning samples will be drawn in addition
                 to the number specified in the `draws` argument, and will be discarded unless
                 `discard_tuned_samples` is set to False.
+            store_draws : bool
+                If True, all posterior draws of the parameters are kept as float32 arrays in ``posterior_draws_``
+            minibatch_size : int or None
+                If given, every step of the **variational** inference uses a random minibatch of this many instances
+                instead of all instances, so that its cost does not depend on the size of the data
+            float32 : bool
+                If True, the features are stored as float32, which halves the memory of the data
+            chains : int or None
+                The number of chains of the MCMC samplers, by default between 2 and 4 depending on the available CPUs
+            cores : int or None
+                The number of processes used for the chains and the variational restarts, by default the number of
+                CPUs available to this process, which respects the CPU affinity and the cgroup CPU quota
+            vi_restarts : int
+                The number of independent **variational** fits run in parallel, the one with the best ELBO is kept
             **kwargs :
-                Keyword arguments for the fit function of :meth:`pymc3.fit`or :meth:`pymc3.sample`
+                Keyword arguments for the fit function of :meth:`pymc3.fit`or :meth:`pymc3.sample`, or options of
+                L-BFGS-B for **map** and **mle**
         """
         self._pre_fit()
         _n_instances, self.n_objects_fit_, self.n_object_features_fit_ = X.shape
         if self.n_nests is None:
             self.n_nests = int(self.n_objects_fit_ / 2)
         self.random_state_ = check_random_state(self.random_state)
-        self.construct_model(X, Y)
-        fit_pymc3_model(self, sampler, draws, tune, vi_params, **kwargs)
+        self.construct_model(X, Y, minibatch_size=minibatch_size, float32=float32)
+        fit_pymc3_model(
+            self,
+            sampler,
+            draws,
+            tune,
+            vi_params,
+            store_draws=store_draws,
+            chains=chains,
+            cores=cores,
+            vi_restarts=vi_restarts,
+            **kwargs,
+        )
         return self
 
     def _predict_scores_fixed(self, X, **kwargs):
         y_nests = self.create_nests(X)
-        mean_trace = dict(pm.summary(self.trace_)["mean"])
-        weights = np.array(
-            [
-                mean_trace["weights[{}]".format(i)]
-                for i in range(self.n_object_features_fit_)
-            ]
-        )
-        weights_k = np.array(
-            [
-                mean_trace["weights_k[{}]".format(i)]
-                for i in range(self.n_object_features_fit_)
-            ]
-        )
-        lambda_k = np.array(
-            [mean_trace["lambda_k[{}]".format(i)] for i in range(self.n_nests)]
-        )
+        weights = self.posterior_means_["weights"]
+        weights_k = self.posterior_means_["weights_k"]
+        lambda_k = self.posterior_means_["lambda_k"]
         weights = weights / lambda_k[:, None]
         utility_k = np.dot(self.features_nests_, weights_k)
         utility = self._eval_utility_np(X, y_nests, weights)
@@ -13,6 +13,7 @@ from .likelihoods import create_weight_dictionary
 from .likelihoods import fit_pymc3_model
 from .likelihoods import likelihood_dict
 from .likelihoods import LogLikelihood
+from .likelihoods import shared_data
 
 try:
     import pymc3 as pm
@@ -23,7 +24,6 @@ except ImportError:
     raise MissingExtraError("pymc3", "probabilistic")
 
 try:
-    import theano
     from theano import tensor as tt
 except ImportError:
     from csrank.util import MissingExtraError
@@ -182,59 +182,37 @@ class PairedCombinatorialLogit(DiscreteObjectChooser, Learner):
                 Choice probabilities :math:`P_i` of the objects :math:`x_i \\in Q` in the query sets
 
         """
-        n_objects = self.n_objects_fit_
-        nests_indices = self.nests_indices
         n_nests = self.n_nests
-        lambdas = tt.ones((n_objects, n_objects), dtype=np.float)
-        for i, p in enumerate(nests_indices):
-            r = [p[0], p[1]]
-            c = [p[1], p[0]]
-            lambdas = tt.set_subtensor(lambdas[r, c], lambda_k[i])
-        uti_per_nest = tt.transpose(utility[:, None, :] / lambdas, (0, 2, 1))
-        ind = np.array([[[i1, i2], [i2, i1]] for i1, i2 in nests_indices])
-        ind = ind.reshape(2 * n_nests, 2)
-        x = uti_per_nest[:, ind[:, 0], ind[:, 1]].reshape((-1, 2))
-        log_sum_exp_nest = ttu.logsumexp(x).reshape((-1, n_nests))
-        pnk = tt.exp(
-            log_sum_exp_nest * lambda_k - ttu.logsumexp(log_sum_exp_nest * lambda_k)
+        scaled = utility[:, self.nests_indices.ravel()].reshape((-1, n_nests, 2))
+        scaled = scaled / lambda_k[None, :, None]
+        lse = ttu.logsumexp(scaled, axis=2)
+        nest_values = lse[:, :, 0] * lambda_k
+        log_pnk = nest_values - ttu.logsumexp(nest_values)
+        p_in_nest = tt.exp(scaled - lse + log_pnk[:, :, None])
+        # Sum up the probabilities within the nests for every object, the
+        # increments of repeated indices accumulate.
+        p = tt.zeros((self.n_objects_fit_, utility.shape[0]))
+        p = tt.inc_subtensor(
+            p[self.nests_indices.ravel()], p_in_nest.reshape((-1, 2 * n_nests)).T
         )
-        p = tt.zeros(tuple(utility.shape), dtype=float)
-        for i in range(n_nests):
-            i1, i2 = nests_indices[i]
-            x1 = tt.exp(uti_per_nest[:, i1, i2] - log_sum_exp_nest[:, i]) * pnk[:, i]
-            x2 = np.exp(uti_per_nest[:, i2, i1] - log_sum_exp_nest[:, i]) * pnk[:, i]
-            p = tt.set_subtensor(p[:, i1], p[:, i1] + x1)
-            p = tt.set_subtensor(p[:, i2], p[:, i2] + x2)
-        return p
+        return p.T
 
     def _get_probabilities_np(self, utility, lambda_k):
-        n_objects = self.n_objects_fit_
-        nests_indices = self.nests_indices
         n_nests = self.n_nests
-        temp_lambdas = np.ones((n_objects, n_objects), lambda_k.dtype)
-        temp_lambdas[nests_indices[:, 0], nests_indices[:, 1]] = temp_lambdas.T[
-            nests_indices[:, 0], nests_indices[:, 1]
-        ] = lambda_k
-        uti_per_nest = np.transpose((utility[:, None] / temp_lambdas), (0, 2, 1))
-        ind = np.array([[[i1, i2], [i2, i1]] for i1, i2 in nests_indices])
-        ind = ind.reshape(2 * n_nests, 2)
-        x = uti_per_nest[:, ind[:, 0], ind[:, 1]].reshape(-1, 2)
-        log_sum_exp_nest = npu.logsumexp(x).reshape(-1, n_nests)
-        pnk = np.exp(
-            log_sum_exp_nest * lambda_k - npu.logsumexp(log_sum_exp_nest * lambda_k)
+        scaled = utility[:, self.nests_indices] / lambda_k[:, None]
+        lse = npu.logsumexp(scaled, axis=2)
+        nest_values = lse[:, :, 0] * lambda_k
+        log_pnk = nest_values - npu.logsumexp(nest_values)
+        p_in_nest = np.exp(scaled - lse + log_pnk[:, :, None])
+        p = np.zeros((utility.shape[0], self.n_objects_fit_))
+        np.add.at(
+            p,
+            (slice(None), self.nests_indices.ravel()),
+            p_in_nest.reshape(-1, 2 * n_nests),
         )
-        p = np.zeros(tuple(utility.shape), dtype=float)
-        for i in range(n_nests):
-            i1, i2 = nests_indices[i]
-            p[:, i1] += (
-                np.exp(uti_per_nest[:, i1, i2] - log_sum_exp_nest[:, i]) * pnk[:, i]
-            )
-            p[:, i2] += (
-                np.exp(uti_per_nest[:, i2, i1] - log_sum_exp_nest[:, i]) * pnk[:, i]
-            )
         return p
 
-    def construct_model(self, X, Y):
+    def construct_model(self, X, Y, minibatch_size=None, float32=False):
         """
             Constructs the nested logit model by applying priors on weight vectors **weights** as per :meth:`model_configuration`.
             Then we apply a uniform prior to the :math:`\\lambda s`, i.e. :math:`\\lambda s \\sim Uniform(\\text{alpha}, 1.0)`.
@@ -249,6 +227,11 @@ class PairedCombinatorialLogit(DiscreteObjectChooser, Learner):
             Y : numpy array
                 (n_instances, n_objects)
                 Preferences in the form of discrete choices for given objects
+            minibatch_size : int or None
+                If given, the likelihood is evaluated on minibatches of this many instances (only for the
+                **variational** sampler)
+            float32 : bool
+                If True, the features are stored as float32
 
             Returns
             -------
@@ -258,15 +241,20 @@ class PairedCombinatorialLogit(DiscreteObjectChooser, Learner):
         self.trace_vi_ = None
         self.loss_function_ = likelihood_dict.get(self.loss_function, None)
         with pm.Model() as self.model:
-            self.Xt_ = theano.shared(X)
-            self.Yt_ = theano.shared(Y)
+            self.Xt_, self.Yt_ = shared_data(
+                self, X, Y, minibatch_size=minibatch_size, float32=float32
+            )
             shapes = {"weights": self.n_object_features_fit_}
             weights_dict = create_weight_dictionary(self.model_configuration, shapes)
             lambda_k = pm.Uniform("lambda_k", self.alpha, 1.0, shape=self.n_nests)
             utility = tt.dot(self.Xt_, weights_dict["weights"])
             self.p_ = self.get_probabilities(utility, lambda_k)
             LogLikelihood(
-                "yl", loss_func=self.loss_function_, p=self.p_, observed=self.Yt_
+                "yl",
+                loss_func=self.loss_function_,
+                p=self.p_,
+                observed=self.Yt_,
+                total_size=self.total_size_,
             )
         logger.info("Model construction completed")
 
@@ -286,6 +274,12 @@ class PairedCombinatorialLogit(DiscreteObjectChooser, Learner):
             "method": "advi",
             "callbacks": [CheckParametersConvergence()],
         },
+        store_draws=False,
+        minibatch_size=None,
+        float32=False,
+        chains=None,
+        cores=None,
+        vi_restarts=1,
         **kwargs,
     ):
         """
@@ -306,12 +300,14 @@ class PairedCombinatorialLogit(DiscreteObjectChooser, Learner):
                Feature vectors of the objects
            Y : numpy array (n_instances, n_objects)
                Choices for given objects in the query
-           sampler : {‘variational’, ‘metropolis’, ‘nuts’}, string
+           sampler : {‘variational’, ‘metropolis’, ‘nuts’, ‘map’, ‘mle’}, string
                The sampler used to estimate the posterior mean and mass matrix from the trace
 
                    * **variational** : Run inference methods to estimate posterior mean and diagonal mass matrix
                    * **metropolis** : Use the MAP as starting point and Metropolis-Hastings sampler
                    * **nuts** : Use the No-U-Turn sampler
+                   * **map** : Maximize the posterior density, i.e. the likelihood penalized by the priors, with L-BFGS-B
+                   * **mle** : Maximize the likelihood with L-BFGS-B
            vi_params : dict
                The parameters for the **variational** inference method
            draws : int
@@ -321,8 +317,23 @@ class PairedCombinatorialLogit(DiscreteObjectChooser, Learner):
                the step sizes, scalings or similar during tuning. Tuning samples will be drawn in addition
                to the number specified in the `draws` argument, and will be discarded unless
                `discard_tuned_samples` is set to False.
+           store_draws : bool
+               If True, all posterior draws of the parameters are kept as float32 arrays in ``posterior_draws_``
+           minibatch_size : int or None
+               If given, every step of the **variational** inference uses a random minibatch of this many instances
+               instead of all instances, so that its cost does not depend on the size of the data
+           float32 : bool
+               If True, the features are stored as float32, which halves the memory of the data
+           chains : int or None
+               The number of chains of the MCMC samplers, by default between 2 and 4 depending on the available CPUs
+           cores : int or None
+               The number of processes used for the chains and the variational restarts, by default the number of
+               CPUs available to this process, which respects the CPU affinity and the cgroup CPU quota
+           vi_restarts : int
+               The number of independent **variational** fits run in parallel, the one with the best ELBO is kept
            **kwargs :
-               Keyword arguments for the fit function of :meth:`pymc3.fit`or :meth:`pymc3.sample`
+               Keyword arguments for the fit function of :meth:`pymc3.fit`or :meth:`pymc3.sample`, or options of
+               L-BFGS-B for **map** and **mle**
        """
         self._pre_fit()
         _n_instances, self.n_objects_fit_, self.n_object_features_fit_ = X.shape
@@ -330,21 +341,24 @@ class PairedCombinatorialLogit(DiscreteObjectChooser, Learner):
             list(combinations(np.arange(self.n_objects_fit_), 2))
         )
         self.n_nests = len(self.nests_indices)
-        self.construct_model(X, Y)
-        fit_pymc3_model(self, sampler, draws, tune, vi_params, **kwargs)
+        self.construct_model(X, Y, minibatch_size=minibatch_size, float32=float32)
+        fit_pymc3_model(
+            self,
+            sampler,
+            draws,
+            tune,
+            vi_params,
+            store_draws=store_draws,
+            chains=chains,
+            cores=cores,
+            vi_restarts=vi_restarts,
+            **kwargs,
+        )
         return self
 
     def _predict_scores_fixed(self, X, **kwargs):
-        mean_trace = dict(pm.summary(self.trace_)["mean"])
-        weights = np.array(
-            [
-                mean_trace["weights[{}]".format(i)]
-                for i in range(self.n_object_features_fit_)
-            ]
-        )
-        lambda_k = np.array(
-            [mean_trace["lambda_k[{}]".format(i)] for i in range(self.n_nests)]
-        )
+        weights = self.posterior_means_["weights"]
+        lambda_k = self.posterior_means_["lambda_k"]
         utility = np.dot(X, weights)
         p = self._get_probabilities_np(utility, lambda_k)
         return p
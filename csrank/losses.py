@@ -1,13 +1,18 @@
 from keras import backend as K
+import numpy as np
 import tensorflow as tf
 
 from csrank.tensorflow_util import tensorify
 
 __all__ = [
     "hinged_rank_loss",
+    "hinged_rank_loss_tiled",
     "make_smooth_ndcg_loss",
     "smooth_rank_loss",
+    "smooth_rank_loss_tiled",
     "plackett_luce_loss",
+    "make_topk_plackett_luce_loss",
+    "make_lambdarank_loss",
 ]
 
 
@@ -39,6 +44,155 @@ def smooth_rank_loss(y_true, y_pred):
     return result / K.sum(mask, axis=(1, 2))
 
 
+def _hinge(diff):
+    return K.maximum(1 - diff, 0), -K.cast(K.greater(1 - diff, 0), "float32")
+
+
+def _exp_negative(diff):
+    exped = K.exp(-diff)
+    return exped, -exped
+
+
+def _tiled_pairwise_sum(y_true, y_pred, pair_function, tile):
+    """Sum a function of the score differences over all ordered pairs in tiles.
+
+    For every instance this computes the sum of ``pair_function(s_i - s_j)``
+    over all pairs of objects where ``i`` is ranked before ``j``, together
+    with the number of those pairs. Only ``tile`` rows of the pairwise
+    matrices are materialized at once and the gradient with respect to the
+    scores is accumulated tile by tile as well, so neither pass needs
+    memory quadratic in the number of objects.
+
+    Parameters
+    ----------
+    y_true : tensor, shape (n_instances, n_objects)
+        The true rankings
+    y_pred : tensor, shape (n_instances, n_objects)
+        The predicted scores
+    pair_function : function
+        Maps the score differences to a tuple of the pairwise values and
+        their derivative with respect to the difference
+    tile : int
+        Number of objects (rows of the pairwise matrices) per tile
+
+    Returns
+    -------
+    (total, count) : tuple of tensors, shape (n_instances,)
+    """
+    y_true = K.cast(y_true, "float32")
+    n_objects = tf.shape(y_true)[1]
+    n_tiles = (n_objects + tile - 1) // tile
+
+    def tile_block(t, s):
+        start = t * tile
+        size = tf.minimum(tile, n_objects - start)
+        y_i = y_true[:, start : start + size]
+        s_i = s[:, start : start + size]
+        mask = K.cast(K.greater(y_true[:, None] - y_i[:, :, None], 0), "float32")
+        diff = s_i[:, :, None] - s[:, None]
+        return start, size, mask, diff
+
+    @tf.custom_gradient
+    def pairwise_sum(s):
+        def forward(t, total, count):
+            _, _, mask, diff = tile_block(t, s)
+            value, _ = pair_function(diff)
+            total += K.sum(mask * value, axis=(1, 2))
+            count += K.sum(mask, axis=(1, 2))
+            return t + 1, total, count
+
+        zeros = tf.zeros_like(s[:, 0])
+        _, total, count = tf.while_loop(
+            lambda t, *_: t < n_tiles,
+            forward,
+            [tf.constant(0), zeros, zeros],
+            parallel_iterations=1,
+        )
+
+        def grad(d_total, d_count=None):
+            def backward(t, d_s):
+                start, size, mask, diff = tile_block(t, s)
+                _, derivative = pair_function(diff)
+                weighted = mask * derivative
+                rows = tf.pad(
+                    K.sum(weighted, axis=2),
+                    [[0, 0], [start, n_objects - start - size]],
+                )
+                return t + 1, d_s + rows - K.sum(weighted, axis=1)
+
+            _, d_s = tf.while_loop(
+                lambda t, _: t < n_tiles,
+                backward,
+                [tf.constant(0), tf.zeros_like(s)],
+                parallel_iterations=1,
+            )
+            return d_total[:, None] * d_s
+
+        return (total, count), grad
+
+    return pairwise_sum(K.cast(y_pred, "float32"))
+
+
+def hinged_rank_loss_tiled(tile=64):
+    """Create a memory-bounded version of :func:`hinged_rank_loss`.
+
+    The pairwise hinge terms are computed in tiles of ``tile`` objects,
+    which reduces the memory needed from quadratic to linear in the number
+    of objects (for a fixed tile size). The gradient is computed tile by tile
+    as well, with ``tf.custom_gradient``.
+
+    The pairwise terms are summed in float32 in a different order than in
+    :func:`hinged_rank_loss`, so values and gradients only agree up to this
+    rounding, i.e. to about five decimal places for losses of order one.
+
+    Parameters
+    ----------
+    tile : int
+        Number of objects for which the pairwise terms are computed at once
+
+    Returns
+    -------
+    loss : function
+        Keras loss function of ``y_true`` and ``y_pred``
+    """
+
+    @identifiable
+    def hinged_rank_loss(y_true, y_pred):
+        y_true, y_pred = tensorify(y_true), tensorify(y_pred)
+        total, count = _tiled_pairwise_sum(y_true, y_pred, _hinge, tile)
+        return total / count
+
+    return hinged_rank_loss
+
+
+def smooth_rank_loss_tiled(tile=64):
+    """Create a memory-bounded version of :func:`smooth_rank_loss`.
+
+    The pairwise terms are computed in tiles like in
+    :func:`hinged_rank_loss_tiled`. Values and gradients agree with
+    :func:`smooth_rank_loss` up to the rounding of the float32 summation
+    order, i.e. to about five decimal places for losses of order one.
+
+    Parameters
+    ----------
+    tile : int
+        Number of objects for which the pairwise terms are computed at once
+
+    Returns
+    -------
+    loss : function
+        Keras loss function of ``y_true`` and ``y_pred``
+    """
+
+    @identifiable
+    def smooth_rank_loss(y_true, y_pred):
+        y_true, y_pred = tensorify(y_true), tensorify(y_pred)
+        total, count = _tiled_pairwise_sum(y_true, y_pred, _exp_negative, tile)
+        return total / count
+
+    return smooth_rank_loss
+
+
 @identifiable
 def plackett_luce_loss(y_true, s_pred):
     y_true = tf.cast(y_true, dtype="int32")
@@ -49,12 +203,181 @@ def plackett_luce_loss(y_true, s_pred):
         tf.where(tf.is_finite(raw_max), raw_max, tf.zeros_like(raw_max))
     )
     exped = tf.exp(tf.subtract(s_pred, max_elem))
-    masks = tf.greater_equal(y_true, tf.range(m)[:, None, None])
-    tri = exped * tf.cast(masks, tf.float32)
-    lse = tf.reduce_sum(tf.log(tf.reduce_sum(tri, axis=2)), axis=0)
+
+    # Sort the scores by the true ranking (lowest rank first). The sum over
+    # all objects which are not ranked before position j is then the
+    # reverse cumulative sum, which avoids materializing a mask per
+    # position.
+    _, orderings = tf.nn.top_k(-y_true, k=m)
+    row_ind = tf.cumsum(tf.ones_like(orderings), axis=0) - 1
+    full_indices = tf.stack([row_ind, orderings], axis=-1)
+    exped_sorted = tf.gather_nd(exped, full_indices)
+    remaining = tf.cumsum(exped_sorted, axis=1, reverse=True)
+
+    lse = tf.reduce_sum(tf.log(remaining), axis=1)
     return lse - tf.reduce_sum(s_pred, axis=1)
 
 
+def make_topk_plackett_luce_loss(k=1, alpha=0.0):
+    """Create a masked top-k Plackett-Luce loss over complete lists.
+
+    The returned loss is the negative log-likelihood of the top-``k``
+    positions of the true ranking under the Plackett-Luce model, where the
+    normalization at every position runs over all objects that are not yet
+    ranked, including the ones outside of the top-``k``. Objects with a
+    negative rank are treated as padding and ignored, which allows training
+    on padded lists of variable length. Lists shorter than ``k`` only
+    contribute the positions they contain.
+
+    Parameters
+    ----------
+    k : int
+        Number of top positions of the ranking to include in the likelihood.
+    alpha : float
+        Strength of an optional L2 penalty on the scores of the (unpadded)
+        objects, which makes the scores identifiable like the penalty of
+        :func:`identifiable` (which uses 1e-4). With the default of 0 the loss
+        is exactly the negative top-k Plackett-Luce log-likelihood.
+
+    Returns
+    -------
+    loss : function
+        Keras loss function of ``y_true`` (rankings, padded with -1) and
+        ``s_pred`` (scores) of shape (n_instances, n_objects).
+    """
+
+    def topk_plackett_luce_loss(y_true, s_pred):
+        y_true = tf.cast(y_true, dtype="int32")
+        s_pred = tf.cast(s_pred, dtype="float32")
+        valid = tf.greater_equal(y_true, 0)
+        valid_f = tf.cast(valid, tf.float32)
+        s_valid = tf.where(valid, s_pred, tf.zeros_like(s_pred))
+
+        raw_max = tf.reduce_max(
+            tf.where(valid, s_pred, tf.fill(tf.shape(s_pred), -np.inf)),
+            axis=1,
+            keepdims=True,
+        )
+        max_elem = tf.stop_gradient(
+            tf.where(tf.is_finite(raw_max), raw_max, tf.zeros_like(raw_max))
+        )
+        exped = tf.exp(s_valid - max_elem) * valid_f
+
+        # (k, n_instances, n_objects); padded objects have rank -1 and are
+        # therefore never part of a risk set.
+        positions = tf.range(k)[:, None, None]
+        risk_sets = tf.cast(tf.greater_equal(y_true, positions), tf.float32)
+        chosen = tf.cast(tf.equal(y_true, positions), tf.float32)
+        present = tf.greater(tf.reduce_sum(chosen, axis=2), 0)
+
+        denominator = tf.reduce_sum(exped * risk_sets, axis=2)
+        denominator = tf.where(present, denominator, tf.ones_like(denominator))
+        lse = tf.log(denominator) + tf.transpose(max_elem)
+        chosen_scores = tf.reduce_sum(s_valid * chosen, axis=2)
+        nll = tf.reduce_sum(
+            tf.where(present, lse - chosen_scores, tf.zeros_like(lse)), axis=0
+        )
+        if alpha:
+            nll += alpha * tf.reduce_sum(tf.square(s_valid), axis=1)
+        return nll
+
+    return topk_plackett_luce_loss
+
+
+def make_lambdarank_loss(k=None, sigma=1.0):
+    """Create the LambdaRank loss for optimizing the nDCG at ``k``.
+
+    The loss is the RankNet cross entropy of every pair of objects with
+    different relevance, weighted by the absolute change of the nDCG@k when
+    swapping the two objects in the currently predicted ranking. The
+    relevance of an object is derived from its rank exactly as in
+    :func:`csrank.metrics.make_ndcg_at_k_loss`, i.e. the ranks are normalized
+    by the largest rank in the batch. The gradient with respect to
+    the scores is given directly by the lambdas
+
+    .. math::
+        \\lambda_{ij} = -\\sigma \\lvert \\Delta \\mathrm{nDCG}_{ij} \\rvert
+        \\frac{1}{1 + e^{\\sigma (s_i - s_j)}} \\enspace ,
+
+    for :math:`x_i` more relevant than :math:`x_j`, which are accumulated per
+    object with scatter-adds. Swapping two objects which are both predicted
+    outside of the top-``k`` does not change the nDCG@k, so only pairs
+    involving one of the predicted top-``k`` objects are formed. This needs
+    time and memory in :math:`O(n \\cdot k)` per instance instead of
+    :math:`O(n^2)`.
+
+    Parameters
+    ----------
+    k : int or None
+        Truncation level of the nDCG. If None, the complete ranking is used.
+    sigma : float
+        Steepness of the pairwise logistic function
+
+    Returns
+    -------
+    loss : function
+        Keras loss function of ``y_true`` (rankings) and ``y_pred`` (scores)
+        of shape (n_instances, n_objects)
+    """
+
+    def lambdarank_loss(y_true, y_pred):
+        y_true = K.cast(y_true, "float32")
+        n_objects = tf.shape(y_true)[1]
+        n_top = n_objects if k is None else tf.minimum(k, n_objects)
+
+        # The relevance is normalized by the largest rank of the whole batch,
+        # exactly as in the nDCG metric.
+        max_rank = K.max(y_true)
+        max_rank = tf.where(max_rank > 0, max_rank, tf.ones_like(max_rank))
+        gains = K.pow(2.0, (max_rank - y_true) / max_rank) - 1.0
+        discount = 1.0 / (K.log(K.cast(tf.range(n_top), "float32") + 2.0) / np.log(2.0))
+        ideal_gains, _ = tf.nn.top_k(gains, n_top)
+        idcg = K.sum(ideal_gains * discount, axis=1)
+        idcg = tf.where(idcg > 0, idcg, tf.ones_like(idcg))
+
+        @tf.custom_gradient
+        def lambdarank(s):
+            # Objects which are predicted in the top-k and their positions. All
+            # other objects get the position n_top, which has a discount of 0.
+            _, top = tf.nn.top_k(tf.stop_gradient(s), n_top)
+            row_ind = tf.cumsum(tf.ones_like(top), axis=0) - 1
+            top_indices = tf.stack([row_ind, top], axis=-1)
+            top_positions = tf.range(n_top)[None] + tf.zeros_like(top)
+            positions = n_top - tf.scatter_nd(
+                top_indices, n_top - top_positions, tf.shape(s)
+            )
+            padded_discount = tf.concat([discount, [0.0]], axis=0)
+            discount_all = tf.gather(padded_discount, positions)
+
+            # Pairs (top-k object at position p, any object at a later
+            # position), each unordered pair is contained exactly once.
+            include = K.cast(positions[:, None] > top_positions[:, :, None], "float32")
+            gains_top = tf.gather_nd(gains, top_indices)
+            s_top = tf.gather_nd(s, top_indices)
+            gain_diff = gains_top[:, :, None] - gains[:, None]
+            delta_ndcg = (
+                include
+                * K.abs(gain_diff)
+                * K.abs(discount[None, :, None] - discount_all[:, None])
+                / idcg[:, None, None]
+            )
+            sign = tf.sign(gain_diff)
+            margin = sigma * sign * (s_top[:, :, None] - s[:, None])
+            cost = K.sum(delta_ndcg * tf.nn.softplus(-margin), axis=(1, 2))
+
+            def grad(d_cost):
+                lambdas = -sigma * sign * delta_ndcg * tf.sigmoid(-margin)
+                lambdas = d_cost[:, None, None] * lambdas
+                d_top = tf.scatter_nd(top_indices, K.sum(lambdas, axis=2), tf.shape(s))
+                return d_top - K.sum(lambdas, axis=1)
+
+            return cost, grad
+
+        return lambdarank(K.cast(y_pred, "float32"))
+
+    return lambdarank_loss
+
+
 def make_smooth_ndcg_loss(y_true, y_pred):
     y_true, y_pred = tensorify(y_true), tensorify(y_pred)
     n_objects = K.max(y_true) + 1.0
@@ -49,6 +49,8 @@ from keras import backend as K
 import numpy as np
 import tensorflow as tf
 
+from csrank.metrics_np import err_np
+from csrank.metrics_np import zero_one_accuracy_np
 from csrank.tensorflow_util import get_instances_objects
 from csrank.tensorflow_util import scores_to_rankings
 from csrank.tensorflow_util import tensorify
@@ -66,6 +68,23 @@ __all__ = [
 ]
 
 
+def _numpy_twin(twin):
+    """Record the NumPy implementation computing the same value as a metric.
+
+    :func:`csrank.tensorflow_util.get_mean_loss` evaluates the twin instead of
+    building a graph when it is called with arrays. Only implementations that
+    agree exactly (including ties) are registered. The rank losses are not,
+    since they take the number of objects from the largest rank in the batch,
+    which differs from the number of columns for tied rankings.
+    """
+
+    def decorator(metric):
+        metric.numpy_twin = twin
+        return metric
+
+    return decorator
+
+
 def zero_one_rank_loss(y_true, y_pred):
     y_true, y_pred = tensorify(y_true), tensorify(y_pred)
     mask = K.greater(y_true[:, None] - y_true[:, :, None], 0)
@@ -86,6 +105,7 @@ def zero_one_rank_loss(y_true, y_pred):
     return K.mean(result)
 
 
+@_numpy_twin(zero_one_accuracy_np)
 def zero_one_accuracy(y_true, y_pred):
     y_true, y_pred = tensorify(y_true), tensorify(y_pred)
     n_instances, n_objects = get_instances_objects(y_true)
@@ -288,6 +308,7 @@ def relevance_gain(grading, max_grade):
     return (2 ** inverse_grading - 1) / (2 ** tf.cast(max_grade, tf.float32))
 
 
+@_numpy_twin(err_np)
 def err(y_true, y_pred, utility_function=None, probability_mapping=None):
     """Computes the Expected Reciprocal Rank or any Cascade Metric.
 
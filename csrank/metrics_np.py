@@ -1,16 +1,37 @@
+"""Plain numpy versions of the metrics.
+
+All metrics also accept variadic data in the format returned by
+``predict_scores`` for variadic input, i.e. dicts mapping the number of
+objects to the arrays of the instances with that many objects. Alternatively
+a padded array can be passed together with the ``lengths`` keyword argument,
+which holds the number of objects of every instance. The metric is then
+evaluated vectorized within every bucket and its values are averaged over all
+instances on which it is defined.
+
+With ``per_instance=True`` the metrics return the value of every instance
+(NaN where the metric is undefined) instead of the mean, see for example
+:func:`bootstrap`.
+"""
+from abc import ABCMeta
+from abc import abstractmethod
+import copy
 from functools import partial
+from functools import wraps
 
+from joblib import delayed
+from joblib import Parallel
 import numpy as np
 from scipy.stats import spearmanr
-from sklearn.metrics import average_precision_score
 from sklearn.metrics import f1_score
 from sklearn.metrics import hamming_loss
 from sklearn.metrics import precision_score
 from sklearn.metrics import recall_score
-from sklearn.metrics import roc_auc_score
 from sklearn.metrics import zero_one_loss
+from sklearn.utils import check_random_state
 
+from csrank.numpy_util import rankings_for_sorted_scores
 from csrank.numpy_util import scores_to_rankings
+from csrank.numpy_util import tied_run_bounds
 
 __all__ = [
     "spearman_correlation_for_scores_np",
@@ -31,112 +52,390 @@ __all__ = [
     "topk_categorical_accuracy_np",
     "categorical_accuracy_np",
     "make_ndcg_at_k_loss_np",
+    "evaluate",
+    "MetricAccumulator",
+    "SpearmanCorrelationAccumulator",
+    "KendallTauAccumulator",
+    "ZeroOneRankLossAccumulator",
+    "ZeroOneAccuracyAccumulator",
+    "NDCGAccumulator",
+    "ERRAccumulator",
+    "CategoricalAccuracyAccumulator",
+    "TopKCategoricalAccuracyAccumulator",
+    "F1MeasureAccumulator",
+    "PrecisionAccumulator",
+    "RecallAccumulator",
+    "SubsetZeroOneLossAccumulator",
+    "HammingLossAccumulator",
+    "InstanceInformednessAccumulator",
+    "AUCAccumulator",
+    "AveragePrecisionAccumulator",
+    "accumulate",
+    "bootstrap",
 ]
 
 
-def spearman_correlation_for_scores_np(y_true, s_pred):
-    y_pred = scores_to_rankings(s_pred)
-    rho = []
+def _split_padded(y_true, y_pred, lengths):
+    """Split padded arrays into dicts of buckets of equally sized instances."""
+    lengths = np.asarray(lengths)
+    y_true_buckets, y_pred_buckets = dict(), dict()
+    for n_objects in np.unique(lengths):
+        in_bucket = lengths == n_objects
+        y_true_buckets[n_objects] = y_true[in_bucket, :n_objects]
+        y_pred_buckets[n_objects] = y_pred[in_bucket, :n_objects]
+    return y_true_buckets, y_pred_buckets
+
+
+def _per_instance_values(function, y_true, y_pred, lengths, *args, **kwargs):
+    """Apply a per-instance function to a fixed size, bucketed or padded
+    input. The values of padded input are returned in the original order."""
+    if lengths is not None:
+        lengths = np.asarray(lengths)
+        values = np.empty(len(lengths))
+        for n_objects in np.unique(lengths):
+            in_bucket = lengths == n_objects
+            values[in_bucket] = function(
+                y_true[in_bucket, :n_objects],
+                y_pred[in_bucket, :n_objects],
+                *args,
+                **kwargs,
+            )
+        return values
+    if isinstance(y_true, dict):
+        return np.concatenate(
+            [
+                _per_instance_values(
+                    function, y_true[n], y_pred[n], None, *args, **kwargs
+                )
+                for n in y_true
+            ]
+        )
+    values = function(np.asarray(y_true), np.asarray(y_pred), *args, **kwargs)
+    return np.asarray(values, dtype=float)
+
+
+def _accepts_buckets(instance_values):
+    """Let a metric accept dicts of buckets or padded arrays plus lengths and
+    add the ``per_instance`` mode.
+
+    Parameters
+    ----------
+    instance_values : function
+        Computes the values of the metric for every instance of fixed size
+        arrays, NaN where the metric is undefined. It gets the same arguments
+        as the metric.
+    """
+
+    def decorator(metric):
+        @wraps(metric)
+        def wrapper(y_true, y_pred, *args, lengths=None, per_instance=False, **kwargs):
+            if per_instance:
+                return _per_instance_values(
+                    instance_values, y_true, y_pred, lengths, *args, **kwargs
+                )
+            if lengths is None and not isinstance(y_true, dict):
+                return metric(y_true, y_pred, *args, **kwargs)
+            values = _per_instance_values(
+                instance_values, y_true, y_pred, lengths, *args, **kwargs
+            )
+            return np.nanmean(values) if np.any(~np.isnan(values)) else np.nan
+
+        return wrapper
+
+    return decorator
+
+
+def _spearman_per_instance(y_true, y_pred, has_ties=None):
+    """Spearman correlation of every instance, NaN for instances with ties."""
     n_objects = y_true.shape[1]
     denominator = n_objects * (n_objects ** 2 - 1)
+    rho = 1 - (6 * np.sum((y_true - y_pred) ** 2, axis=1) / denominator)
+    if has_ties is None:
+        sorted_pred = np.sort(y_pred, axis=1)
+        has_ties = np.any(sorted_pred[:, 1:] == sorted_pred[:, :-1], axis=1)
+    return np.where(has_ties, np.nan, rho)
 
-    for r1, r2 in zip(y_true, y_pred):
-        if len(np.unique(r2)) == len(r2):
-            s = 1 - (6 * np.sum((r1 - r2) ** 2) / denominator)
-            rho.append(s)
-        else:
-            rho.append(np.nan)
-    return np.nanmean(np.array(rho))
 
+def _spearman_for_scores_per_instance(y_true, s_pred):
+    return _spearman_per_instance(y_true, scores_to_rankings(s_pred))
 
-def spearman_correlation_for_scores_scipy(y_true, s_pred):
+
+@_accepts_buckets(_spearman_for_scores_per_instance)
+def spearman_correlation_for_scores_np(y_true, s_pred):
+    return np.nanmean(_spearman_for_scores_per_instance(y_true, s_pred))
+
+
+def _spearman_scipy_per_instance(y_true, s_pred):
     y_pred = scores_to_rankings(s_pred)
     rho = []
     for r1, r2 in zip(y_true, y_pred):
         s = spearmanr(r1, r2)[0]
         rho.append(s)
-    return np.nanmean(np.array(rho))
+    return np.array(rho)
 
 
+@_accepts_buckets(_spearman_scipy_per_instance)
+def spearman_correlation_for_scores_scipy(y_true, s_pred):
+    return np.nanmean(_spearman_scipy_per_instance(y_true, s_pred))
+
+
+def _kendalls_tau_per_instance(y_true, s_pred, **kwargs):
+    return 1.0 - 2.0 * _zero_one_rank_loss_per_instance(y_true, s_pred, **kwargs)
+
+
+@_accepts_buckets(_kendalls_tau_per_instance)
 def kendalls_tau_for_scores_np(y_true, s_pred):
     return 1.0 - 2.0 * zero_one_rank_loss_for_scores_ties_np(y_true, s_pred)
 
 
+def _zero_one_accuracy_per_instance(y_true, y_pred):
+    return np.all(np.equal(y_true, y_pred), axis=1)
+
+
+def _zero_one_accuracy_for_scores_per_instance(y_true, s_pred):
+    return _zero_one_accuracy_per_instance(y_true, scores_to_rankings(s_pred))
+
+
+@_accepts_buckets(_zero_one_accuracy_for_scores_per_instance)
 def zero_one_accuracy_for_scores_np(y_true, s_pred):
-    y_pred = scores_to_rankings(s_pred)
-    acc = np.sum(np.all(np.equal(y_true, y_pred), axis=1)) / y_pred.shape[0]
-    return acc
+    return np.mean(_zero_one_accuracy_for_scores_per_instance(y_true, s_pred))
 
 
+@_accepts_buckets(_zero_one_accuracy_per_instance)
 def zero_one_accuracy_np(y_true, y_pred):
-    acc = np.sum(np.all(np.equal(y_true, y_pred), axis=1)) / y_pred.shape[0]
-    return acc
+    return np.mean(_zero_one_accuracy_per_instance(y_true, y_pred))
+
+
+def _ndcg_at_k(y_true, top_p, k):
+    """nDCG@k of every instance given the indices of the top-k predictions."""
+    n_instances, n_objects = y_true.shape
+    relevance = np.power(2.0, ((n_objects - y_true) * 60) / n_objects) - 1.0
+
+    log_term = np.log(np.arange(k, dtype="float32") + 2.0) / np.log(2.0)
+
+    # Calculate ideal dcg:
+    toprel = np.sort(relevance, axis=1)[:, ::-1][:, :k]
+    idcg = np.sum(toprel / log_term, axis=-1, keepdims=True)
+
+    # Calculate actual dcg:
+    pred_rel = relevance[np.arange(n_instances)[:, None], top_p]
+    pred_rel = np.sum(pred_rel / log_term, axis=-1, keepdims=True)
+    gain = pred_rel / idcg
+    return gain
 
 
 def make_ndcg_at_k_loss_np(k=5):
-    def ndcg(y_true, y_pred):
+    def ndcg_per_instance(y_true, y_pred):
         n_instances, n_objects = y_true.shape
-        relevance = np.power(2.0, ((n_objects - y_true) * 60) / n_objects) - 1.0
         relevance_pred = np.power(2.0, ((n_objects - y_pred) * 60) / n_objects) - 1.0
+        top_p = np.argsort(relevance_pred, axis=1)[:, ::-1][:, :k]
+        return _ndcg_at_k(y_true, top_p, k)[:, 0]
 
-        log_term = np.log(np.arange(k, dtype="float32") + 2.0) / np.log(2.0)
+    @_accepts_buckets(ndcg_per_instance)
+    def ndcg(y_true, y_pred):
+        return np.mean(ndcg_per_instance(y_true, y_pred))
 
-        # Calculate ideal dcg:
-        top_t = np.argsort(relevance, axis=1)[:, ::-1][:, :k]
-        toprel = relevance[np.arange(n_instances)[:, None], top_t]
-        idcg = np.sum(toprel / log_term, axis=-1, keepdims=True)
+    return ndcg
 
-        # Calculate actual dcg:
-        top_p = np.argsort(relevance_pred, axis=1)[:, ::-1][:, :k]
-        pred_rel = relevance[np.arange(n_instances)[:, None], top_p]
-        pred_rel = np.sum(pred_rel / log_term, axis=-1, keepdims=True)
-        gain = pred_rel / idcg
-        return gain
 
-    return ndcg
+def _count_inversions(a):
+    """Count the inversions of every row of an integer array.
 
+    This is a bottom-up merge sort which is vectorized over the rows and
+    all blocks of a level. The stable sort of two sorted runs is a linear
+    merge, so a row of length n needs O(n log n) time and O(n) memory.
+    """
+    n_instances, n_objects = a.shape
+    size = 1 << max(n_objects - 1, 0).bit_length()
+    if size > n_objects:
+        # Padding with larger values at the end does not add inversions.
+        fill = np.full((n_instances, size - n_objects), a.max(initial=0) + 1)
+        a = np.concatenate([a, fill], axis=1)
+    inversions = np.zeros(n_instances, dtype=np.int64)
+    width = 1
+    while width < size:
+        blocks = a.reshape(n_instances, size // (2 * width), 2 * width)
+        order = np.argsort(blocks, axis=2, kind="stable")
+        # Left elements precede equal right elements in the merged order, so
+        # every right element is inverted with the left elements after it.
+        is_right = order >= width
+        right_before = np.cumsum(is_right, axis=2) - 1
+        left_before = np.arange(2 * width) - right_before
+        inversions += np.sum(np.where(is_right, width - left_before, 0), axis=(1, 2))
+        a = np.take_along_axis(blocks, order, axis=2).reshape(n_instances, size)
+        width *= 2
+    return inversions
 
-def zero_one_rank_loss_for_scores_ties_np(y_true, s_pred):
-    n_objects = y_true.shape[1]
-    mask = np.greater(y_true[:, None] - y_true[:, :, None], 0).astype(float)
-    mask2 = np.greater(s_pred[:, None] - s_pred[:, :, None], 0).astype(float)
-    mask3 = np.equal(s_pred[:, None] - s_pred[:, :, None], 0).astype(float)
 
-    # Calculate Transpositions
-    transpositions = np.logical_and(mask, mask2)
-    x = (np.sum(mask3, axis=(1, 2)) - n_objects).astype(float) / 4.0
-    transpositions = np.sum(transpositions, axis=(1, 2)).astype(float)
-    transpositions += x
+def _discordant_pairs_ties(y_true, s_pred, orderings=None, sorted_scores=None):
+    """Number of discordant pairs plus half of the pairs tied in s_pred.
+
+    Uses Knight's algorithm: the objects are sorted by their true rank (and
+    by decreasing score for equal ranks, so that pairs tied in y_true are
+    never discordant) and the pairs which are still in increasing score
+    order are counted with a merge sort. The argsort of the scores and the
+    sorted scores can be passed in if they are already known.
+    """
+    n_instances, n_objects = s_pred.shape
+    if orderings is None:
+        orderings = np.argsort(s_pred, axis=1)
+        sorted_scores = np.take_along_axis(s_pred, orderings, axis=1)
+    new_run = np.ones_like(sorted_scores, dtype=bool)
+    new_run[:, 1:] = sorted_scores[:, 1:] != sorted_scores[:, :-1]
+    positions = np.arange(n_objects)
+    run_start = np.maximum.accumulate(np.where(new_run, positions, 0), axis=1)
+    ties = np.sum(positions - run_start, axis=1)
+
+    # Dense ranks of the scores, decreasing in the score.
+    dense = np.cumsum(new_run, axis=1) - 1
+    score_rank = np.empty_like(dense)
+    np.put_along_axis(score_rank, orderings, dense.max() - dense, 1)
+    order = np.lexsort((-s_pred, y_true), axis=-1)
+    discordant = _count_inversions(np.take_along_axis(score_rank, order, axis=1))
+    return discordant + ties / 2.0
+
+
+def _zero_one_rank_loss_per_instance(y_true, s_pred, n_jobs=None, chunk_size=10000):
+    y_true, s_pred = np.asarray(y_true), np.asarray(s_pred)
+    n_objects = y_true.shape[1]
+    chunks = [
+        (y_true[i : i + chunk_size], s_pred[i : i + chunk_size])
+        for i in range(0, y_true.shape[0], chunk_size)
+    ]
+    if n_jobs is None or n_jobs == 1:
+        transpositions = [_discordant_pairs_ties(y, s) for y, s in chunks]
+    else:
+        transpositions = Parallel(n_jobs=n_jobs)(
+            delayed(_discordant_pairs_ties)(y, s) for y, s in chunks
+        )
+    transpositions = np.concatenate(transpositions)
 
     denominator = n_objects * (n_objects - 1.0) / 2.0
-    result = transpositions / denominator
-    return np.mean(result)
+    return transpositions / denominator
+
 
+@_accepts_buckets(_zero_one_rank_loss_per_instance)
+def zero_one_rank_loss_for_scores_ties_np(
+    y_true, s_pred, n_jobs=None, chunk_size=10000
+):
+    """Fraction of discordant pairs between the rankings and the scores.
 
+    Pairs of objects with tied scores count as half a mistake. The pairs
+    are counted with Knight's O(n log n) algorithm, vectorized over chunks
+    of ``chunk_size`` instances which can be processed in parallel.
+
+    Parameters
+    ----------
+    y_true : array-like, shape (n_instances, n_objects)
+        The true rankings
+    s_pred : array-like, shape (n_instances, n_objects)
+        The predicted scores
+    n_jobs : int or None
+        Number of jobs used to process the chunks (see :class:`joblib.Parallel`)
+    chunk_size : int
+        Number of instances which are processed at once
+
+    Returns
+    -------
+    loss : float
+        The mean fraction of discordant pairs
+    """
+    return np.mean(
+        _zero_one_rank_loss_per_instance(
+            y_true, s_pred, n_jobs=n_jobs, chunk_size=chunk_size
+        )
+    )
+
+
+@_accepts_buckets(_zero_one_rank_loss_per_instance)
 def zero_one_rank_loss_for_scores_np(y_true, s_pred):
     return zero_one_rank_loss_for_scores_ties_np(y_true, s_pred)
 
 
-def auc_score(y_true, s_pred):
-    idx = np.where(
-        (y_true.sum(axis=1) != y_true.shape[-1] - 1)
-        & (y_true.sum(axis=1) != y_true.shape[-1])
-        & (y_true.sum(axis=1) != 1)
-        & (y_true.sum(axis=1) != 0)
-    )[0]
-    if len(idx) > 1:
-        auc = roc_auc_score(y_true[idx], s_pred[idx], average="samples")
-    elif len(idx) == 1:
-        auc = roc_auc_score(y_true[idx][0], s_pred[idx][0])
-    else:
-        auc = np.nan
+def _auc_instances(y_true):
+    """Instances with at least two positive and two negative objects."""
+    n_positives = np.sum(y_true, axis=1)
+    n_objects = y_true.shape[-1]
+    return np.where((n_positives > 1) & (n_positives < n_objects - 1))[0]
+
+
+def _sorted_labels(y_true, s_pred):
+    """Labels sorted by increasing score and the tied runs of the scores."""
+    orderings = np.argsort(s_pred, axis=1)
+    sorted_scores = np.take_along_axis(s_pred, orderings, axis=1)
+    labels = np.take_along_axis(np.asarray(y_true, dtype=bool), orderings, axis=1)
+    first, last = tied_run_bounds(sorted_scores)
+    return labels, first, last
+
+
+def _auc_per_instance(y_true, s_pred):
+    """Area under the ROC curve of every instance, computed with the
+    Mann-Whitney U statistic. Tied scores get the average of their ranks.
+    Instances with less than two positive or negative objects get NaN."""
+    y_true, s_pred = np.asarray(y_true), np.asarray(s_pred)
+    labels, first, last = _sorted_labels(y_true, s_pred)
+    n_positives = np.sum(labels, axis=1)
+    n_negatives = labels.shape[1] - n_positives
+    average_rank = (first + last + 2) / 2.0
+    rank_sum = np.sum(np.where(labels, average_rank, 0.0), axis=1)
+    u_statistic = rank_sum - n_positives * (n_positives + 1) / 2.0
+    auc = np.full(labels.shape[0], np.nan)
+    defined = _auc_instances(y_true)
+    auc[defined] = u_statistic[defined] / (n_positives * n_negatives)[defined]
     return auc
 
 
+def _average_precision_per_instance(y_true, s_pred):
+    """Average precision of every instance. All objects with tied scores are
+    predicted at the same threshold. Instances without positive objects get
+    NaN, as with scikit-learn's ``average_precision_score`` (0.23), so that
+    their mean over all instances is NaN as well."""
+    labels, first, _ = _sorted_labels(np.asarray(y_true), np.asarray(s_pred))
+    n_objects = labels.shape[1]
+    # Walk through the objects by decreasing score, every threshold includes
+    # the complete run of tied scores.
+    labels = labels[:, ::-1]
+    threshold_end = n_objects - 1 - first[:, ::-1]
+    true_positives = np.cumsum(labels, axis=1)
+    precision = np.take_along_axis(true_positives, threshold_end, axis=1) / (
+        threshold_end + 1.0
+    )
+    n_positives = true_positives[:, -1]
+    precision_sum = np.sum(np.where(labels, precision, 0.0), axis=1)
+    return np.where(n_positives > 0, precision_sum / np.maximum(n_positives, 1), np.nan)
+
+
+@_accepts_buckets(_auc_per_instance)
+def auc_score(y_true, s_pred):
+    return np.nanmean(_auc_per_instance(y_true, s_pred))
+
+
+@_accepts_buckets(_average_precision_per_instance)
 def average_precision(y_true, s_pred):
-    return average_precision_score(y_true, s_pred, average="samples")
+    return np.mean(_average_precision_per_instance(y_true, s_pred))
+
+
+def _true_positives(y_true, y_pred):
+    """Number of true positives, positives and predicted positives."""
+    y_true, y_pred = np.asarray(y_true, dtype=bool), np.asarray(y_pred, dtype=bool)
+    tp = np.sum(y_true & y_pred, axis=1)
+    return tp, np.sum(y_true, axis=1), np.sum(y_pred, axis=1)
 
 
+def _safe_divide(numerator, denominator):
+    """Elementwise division which is 0 where the denominator is 0, as in
+    scikit-learn."""
+    return np.where(denominator > 0, numerator / np.maximum(denominator, 1), 0.0)
+
+
+def _informedness_per_instance(y_true, y_pred):
+    tp, cp, _ = _true_positives(y_true, y_pred)
+    tn, cn, _ = _true_positives(np.logical_not(y_true), np.logical_not(y_pred))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return tp / cp + tn / cn - 1
+
+
+@_accepts_buckets(_informedness_per_instance)
 def instance_informedness(y_true, y_pred):
     tp = np.logical_and(y_true, y_pred).sum(axis=1)
     tn = np.logical_and(np.logical_not(y_true), np.logical_not(y_pred)).sum(axis=1)
@@ -145,43 +444,79 @@ def instance_informedness(y_true, y_pred):
     return np.nanmean(tp / cp + tn / cn - 1)
 
 
+def _f1_per_instance(y_true, y_pred):
+    tp, n_true, n_pred = _true_positives(y_true, y_pred)
+    return _safe_divide(2.0 * tp, n_true + n_pred)
+
+
+@_accepts_buckets(_f1_per_instance)
 def f1_measure(y_true, y_pred):
     return f1_score(y_true, y_pred, average="samples")
 
 
+def _precision_per_instance(y_true, y_pred):
+    tp, _, n_pred = _true_positives(y_true, y_pred)
+    return _safe_divide(tp, n_pred)
+
+
+@_accepts_buckets(_precision_per_instance)
 def precision(y_true, y_pred):
     return precision_score(y_true, y_pred, average="samples")
 
 
+def _recall_per_instance(y_true, y_pred):
+    tp, n_true, _ = _true_positives(y_true, y_pred)
+    return _safe_divide(tp, n_true)
+
+
+@_accepts_buckets(_recall_per_instance)
 def recall(y_true, y_pred):
     return recall_score(y_true, y_pred, average="samples")
 
 
+def _subset_01_loss_per_instance(y_true, y_pred):
+    return np.any(np.not_equal(y_true, y_pred), axis=1)
+
+
+@_accepts_buckets(_subset_01_loss_per_instance)
 def subset_01_loss(y_true, y_pred):
     return zero_one_loss(y_true, y_pred)
 
 
+def _hamming_per_instance(y_true, y_pred):
+    return np.mean(np.not_equal(y_true, y_pred), axis=1)
+
+
+@_accepts_buckets(_hamming_per_instance)
 def hamming(y_true, y_pred):
     return hamming_loss(y_true, y_pred)
 
 
+def _topk_hits(y_true, top_k):
+    """Whether the chosen object of every instance is in its top-k."""
+    return np.any(top_k == np.argmax(y_true, axis=1)[:, None], axis=1)
+
+
 def topk_categorical_accuracy_np(k=5):
+    def topk_acc_per_instance(y_true, y_pred):
+        return _topk_hits(y_true, y_pred.argsort(axis=1)[:, -k:])
+
+    @_accepts_buckets(topk_acc_per_instance)
     def topk_acc(y_true, y_pred):
-        topK = y_pred.argsort(axis=1)[:, -k:][:, ::-1]
-        accuracies = np.zeros_like(y_true, dtype=bool)
-        y_true = np.argmax(y_true, axis=1)
-        for i, top in enumerate(topK):
-            accuracies[i] = y_true[i] in top
-        return np.mean(accuracies)
+        return np.mean(topk_acc_per_instance(y_true, y_pred))
 
     return topk_acc
 
 
-def categorical_accuracy_np(y_true, y_pred):
+def _categorical_accuracy_per_instance(y_true, y_pred):
     y_true = np.argmax(y_true, axis=1)
     choices = np.argmax(y_pred, axis=1)
-    accuracies = np.equal(y_true, choices)
-    return np.mean(accuracies)
+    return np.equal(y_true, choices)
+
+
+@_accepts_buckets(_categorical_accuracy_per_instance)
+def categorical_accuracy_np(y_true, y_pred):
+    return np.mean(_categorical_accuracy_per_instance(y_true, y_pred))
 
 
 def relevance_gain_np(grading, max_grade):
@@ -191,14 +526,16 @@ def relevance_gain_np(grading, max_grade):
     return (2 ** inverse_grading - 1) / (2 ** max_grade)
 
 
-def err_np(y_true, y_pred, utility_function=None, probability_mapping=None):
-    """Plain python version of `err`, see the documentation of that
-    function for details.
-    """
+def _err_per_instance(y_true, y_pred, utility_function=None, probability_mapping=None):
+    """Expected reciprocal rank of every instance, see :func:`err_np`."""
     if probability_mapping is None:
         # assume y_true is a ranking, use relevance gain
         max_grade = np.max(y_true)
-        probability_mapping = partial(relevance_gain_np, max_grade=max_grade)
+        satisfied_probs = relevance_gain_np(np.asarray(y_true), max_grade=max_grade)
+    else:
+        satisfied_probs = np.reshape(
+            list(map(probability_mapping, y_true.flatten())), np.shape(y_true)
+        )
     if utility_function is None:
 
         def reciprocal_rank(rank):
@@ -208,10 +545,6 @@ def err_np(y_true, y_pred, utility_function=None, probability_mapping=None):
 
     ninstances, nobjects = np.shape(y_pred)
 
-    satisfied_probs = np.reshape(
-        list(map(probability_mapping, y_true.flatten())), np.shape(y_true)
-    )
-
     # sort satisfied probabilities according to the predicted ranking
     # black magic invocation to reorder each row
     row_indices = np.arange(ninstances).reshape(-1, 1)
@@ -234,5 +567,655 @@ def err_np(y_true, y_pred, utility_function=None, probability_mapping=None):
 
     discount_at_rank = not_yet_satisfied_at_rank * utilities
     discounted_document_values = satisfied_at_rank * discount_at_rank
-    results = np.sum(discounted_document_values, axis=1)
+    return np.sum(discounted_document_values, axis=1)
+
+
+@_accepts_buckets(_err_per_instance)
+def err_np(y_true, y_pred, utility_function=None, probability_mapping=None):
+    """Plain python version of `err`, see the documentation of that
+    function for details.
+    """
+    results = _err_per_instance(
+        y_true,
+        y_pred,
+        utility_function=utility_function,
+        probability_mapping=probability_mapping,
+    )
     return np.average(results)
+
+
+class _SharedScoreStatistics(object):
+    """Intermediate results shared between the metrics computed by
+    :func:`evaluate`. Every intermediate result is computed on first use."""
+
+    def __init__(self, y_true, scores):
+        self.y_true = np.asarray(y_true)
+        self.scores = np.asarray(scores)
+        self._cache = dict()
+
+    def _cached(self, name, compute):
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    @property
+    def orderings(self):
+        """Objects sorted by increasing score."""
+        return self._cached("orderings", lambda: np.argsort(self.scores, axis=1))
+
+    @property
+    def sorted_scores(self):
+        return self._cached(
+            "sorted_scores",
+            lambda: np.take_along_axis(self.scores, self.orderings, axis=1),
+        )
+
+    @property
+    def rankings(self):
+        return self._cached(
+            "rankings",
+            lambda: rankings_for_sorted_scores(
+                self.scores, self.orderings, self.sorted_scores
+            ),
+        )
+
+    @property
+    def has_ties(self):
+        """Whether the predicted ranking of each instance contains ties."""
+
+        def compute():
+            sorted_scores = self.sorted_scores
+            if not np.any(np.equal(np.diff(sorted_scores, axis=1), 0)):
+                return np.zeros(sorted_scores.shape[0], dtype=bool)
+            return np.any(sorted_scores[:, 1:] == sorted_scores[:, :-1], axis=1)
+
+        return self._cached("has_ties", compute)
+
+    @property
+    def kendall_distance(self):
+        def compute():
+            n_objects = self.y_true.shape[1]
+            transpositions = _discordant_pairs_ties(
+                self.y_true, self.scores, self.orderings, self.sorted_scores
+            )
+            return transpositions / (n_objects * (n_objects - 1.0) / 2.0)
+
+        return self._cached("kendall_distance", compute)
+
+
+def _evaluate_spearman_correlation(stats):
+    return _spearman_per_instance(stats.y_true, stats.rankings, stats.has_ties)
+
+
+def _evaluate_kendalls_tau(stats):
+    return 1.0 - 2.0 * stats.kendall_distance
+
+
+def _evaluate_zero_one_rank_loss(stats):
+    return stats.kendall_distance
+
+
+def _evaluate_zero_one_accuracy(stats):
+    return np.all(np.equal(stats.y_true, stats.rankings), axis=1)
+
+
+def _evaluate_err(stats):
+    return _err_per_instance(stats.y_true, stats.orderings[:, ::-1])
+
+
+def _evaluate_categorical_accuracy(stats):
+    return np.equal(np.argmax(stats.y_true, axis=1), np.argmax(stats.scores, axis=1))
+
+
+def _evaluate_ndcg(stats, k):
+    top_p = stats.orderings[:, ::-1][:, :k]
+    return _ndcg_at_k(stats.y_true, top_p, k)[:, 0]
+
+
+def _evaluate_topk_categorical_accuracy(stats, k):
+    return _topk_hits(stats.y_true, stats.orderings[:, -k:])
+
+
+# Mapping from the metric names accepted by evaluate to the function computing
+# the per-instance values and the function aggregating them.
+_EVALUATION_METRICS = {
+    "spearman_correlation": (_evaluate_spearman_correlation, np.nanmean),
+    "kendalls_tau": (_evaluate_kendalls_tau, np.mean),
+    "zero_one_rank_loss": (_evaluate_zero_one_rank_loss, np.mean),
+    "zero_one_accuracy": (_evaluate_zero_one_accuracy, np.mean),
+    "err": (_evaluate_err, np.mean),
+    "categorical_accuracy": (_evaluate_categorical_accuracy, np.mean),
+    "ndcg": (_evaluate_ndcg, np.nanmean),
+    "topk_categorical_accuracy": (_evaluate_topk_categorical_accuracy, np.mean),
+}
+_PARAMETRIZED_EVALUATION_METRICS = {"ndcg", "topk_categorical_accuracy"}
+
+
+def _parse_evaluation_metric(metric):
+    """Split a metric name like ``"ndcg@5"`` into the functions and ``k``."""
+    name, _, k = metric.partition("@")
+    if name not in _EVALUATION_METRICS:
+        raise ValueError(
+            f"Unknown metric {metric}. Known metrics: {sorted(_EVALUATION_METRICS)}."
+        )
+    if (name in _PARAMETRIZED_EVALUATION_METRICS) != bool(k):
+        raise ValueError(
+            f"The metrics {sorted(_PARAMETRIZED_EVALUATION_METRICS)} need to be "
+            f"specified as name@k, all others without @k, got {metric}."
+        )
+    per_instance, aggregate = _EVALUATION_METRICS[name]
+    if k:
+        per_instance = partial(per_instance, k=int(k))
+    return per_instance, aggregate
+
+
+def _score_statistics_buckets(y_true, scores, lengths=None):
+    """Shared statistics of every bucket of variadic or fixed size input."""
+    if lengths is not None:
+        y_true, scores = _split_padded(y_true, scores, lengths)
+    if isinstance(y_true, dict):
+        return [_SharedScoreStatistics(y_true[n], scores[n]) for n in y_true]
+    return [_SharedScoreStatistics(y_true, scores)]
+
+
+def evaluate(
+    y_true,
+    scores,
+    metrics=(
+        "spearman_correlation",
+        "kendalls_tau",
+        "zero_one_rank_loss",
+        "zero_one_accuracy",
+        "ndcg@5",
+        "err",
+    ),
+    lengths=None,
+):
+    """Evaluate several metrics on the same predicted scores at once.
+
+    The scores are sorted only once and the resulting orderings, rankings
+    and tie information are shared between all requested metrics, which are
+    computed vectorized over the instances. The results agree with the
+    corresponding functions of this module:
+
+    ==============================  ==========================================
+    Metric                          Equivalent function
+    ==============================  ==========================================
+    ``spearman_correlation``        :func:`spearman_correlation_for_scores_np`
+    ``kendalls_tau``                :func:`kendalls_tau_for_scores_np`
+    ``zero_one_rank_loss``          :func:`zero_one_rank_loss_for_scores_ties_np`
+    ``zero_one_accuracy``           :func:`zero_one_accuracy_for_scores_np`
+    ``ndcg@k``                      :func:`make_ndcg_at_k_loss_np` ``(k)`` on
+                                    the predicted rankings
+    ``err``                         :func:`err_np` on the predicted orderings
+    ``categorical_accuracy``        :func:`categorical_accuracy_np`
+    ``topk_categorical_accuracy@k`` :func:`topk_categorical_accuracy_np`
+                                    ``(k)``
+    ==============================  ==========================================
+
+    As for those functions, ``y_true`` contains rankings for the ranking
+    metrics and one-hot encoded choices for the categorical accuracies.
+    Variadic data can be passed as dicts of buckets or as padded arrays with
+    ``lengths``, in which case the per-instance values of all buckets are
+    aggregated together.
+
+    Examples
+    --------
+    >>> y_true = np.array([[0, 1, 2], [2, 0, 1]])
+    >>> scores = np.array([[0.9, 0.5, 0.1], [0.3, 0.2, 0.8]])
+    >>> results = evaluate(y_true, scores, metrics=["kendalls_tau", "zero_one_accuracy"])
+    >>> print(round(results["kendalls_tau"], 3), results["zero_one_accuracy"])
+    0.333 0.5
+
+    Parameters
+    ----------
+    y_true : array-like, shape (n_instances, n_objects) or dict
+        The true rankings or choices
+    scores : array-like, shape (n_instances, n_objects) or dict
+        The predicted scores
+    metrics : list of str
+        Names of the metrics to compute
+    lengths : array-like, shape (n_instances,) or None
+        The number of objects of every instance if the arrays are padded
+
+    Returns
+    -------
+    results : dict
+        Mapping from the metric names to their values
+    """
+    buckets = _score_statistics_buckets(y_true, scores, lengths)
+    results = dict()
+    for metric in metrics:
+        per_instance, aggregate = _parse_evaluation_metric(metric)
+        values = np.concatenate([per_instance(stats) for stats in buckets])
+        results[metric] = aggregate(values)
+    return results
+
+
+class MetricAccumulator(metaclass=ABCMeta):
+    """Accumulates a metric over chunks of instances.
+
+    Instead of the predictions only the sufficient statistics of the metric
+    (the sum of the per-instance values and the number of instances on which
+    the metric is defined) are stored, so that arbitrarily many predictions
+    can be evaluated in chunks. Accumulators of chunks evaluated in different
+    processes can be combined with :meth:`merge`, see also
+    :func:`accumulate`. Subclasses implement :meth:`_per_instance`.
+
+    Examples
+    --------
+    >>> y_true = np.array([[0, 1, 2], [2, 0, 1]])
+    >>> scores = np.array([[0.9, 0.5, 0.1], [0.3, 0.2, 0.8]])
+    >>> accumulator = ZeroOneAccuracyAccumulator()
+    >>> accumulator.update(y_true[:1], scores[:1]).update(y_true[1:], scores[1:])
+    ZeroOneAccuracyAccumulator(total=1.0, count=2)
+    >>> accumulator.result()
+    0.5
+    """
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    @abstractmethod
+    def _per_instance(self, y_true, y_pred):
+        """Values of the metric for every instance, NaN where undefined."""
+
+    def _update_fixed(self, y_true, y_pred):
+        values = np.asarray(self._per_instance(y_true, y_pred), dtype=float)
+        defined = ~np.isnan(values)
+        self.total += float(np.sum(values[defined]))
+        self.count += int(np.sum(defined))
+
+    def update(self, y_true, y_pred, lengths=None):
+        """Add a chunk of instances.
+
+        Parameters
+        ----------
+        y_true : array-like, shape (n_instances, n_objects) or dict
+            The true rankings, choices or subsets
+        y_pred : array-like, shape (n_instances, n_objects) or dict
+            The predictions, as expected by the corresponding metric
+        lengths : array-like, shape (n_instances,) or None
+            The number of objects of every instance if the arrays are padded
+
+        Returns
+        -------
+        self : MetricAccumulator
+            The updated accumulator
+        """
+        if lengths is not None:
+            y_true, y_pred = _split_padded(y_true, y_pred, lengths)
+        if isinstance(y_true, dict):
+            for n_objects, y_true_bucket in y_true.items():
+                self._update_fixed(
+                    np.asarray(y_true_bucket), np.asarray(y_pred[n_objects])
+                )
+        else:
+            self._update_fixed(np.asarray(y_true), np.asarray(y_pred))
+        return self
+
+    def merge(self, other):
+        """Add the statistics of another accumulator of the same metric.
+
+        Returns
+        -------
+        self : MetricAccumulator
+            The updated accumulator
+        """
+        if type(other) is not type(self):
+            raise ValueError(f"Cannot merge {other} into {self}.")
+        self.total += other.total
+        self.count += other.count
+        return self
+
+    def result(self):
+        """The mean of the metric over all instances added so far."""
+        return self.total / self.count if self.count > 0 else np.nan
+
+    def _empty_copy(self):
+        other = copy.copy(self)
+        MetricAccumulator.__init__(other)
+        return other
+
+    def __repr__(self):
+        return f"{type(self).__name__}(total={self.total}, count={self.count})"
+
+
+class _ScoreMetricAccumulator(MetricAccumulator):
+    """Accumulator of one of the metrics of :func:`evaluate`."""
+
+    _metric = None
+
+    def _per_instance(self, y_true, y_pred):
+        per_instance, _ = _EVALUATION_METRICS[self._metric]
+        return per_instance(_SharedScoreStatistics(y_true, y_pred))
+
+
+class SpearmanCorrelationAccumulator(_ScoreMetricAccumulator):
+    """Accumulates :func:`spearman_correlation_for_scores_np`."""
+
+    _metric = "spearman_correlation"
+
+
+class KendallTauAccumulator(_ScoreMetricAccumulator):
+    """Accumulates :func:`kendalls_tau_for_scores_np`."""
+
+    _metric = "kendalls_tau"
+
+
+class ZeroOneRankLossAccumulator(_ScoreMetricAccumulator):
+    """Accumulates :func:`zero_one_rank_loss_for_scores_ties_np`."""
+
+    _metric = "zero_one_rank_loss"
+
+
+class ZeroOneAccuracyAccumulator(_ScoreMetricAccumulator):
+    """Accumulates :func:`zero_one_accuracy_for_scores_np`."""
+
+    _metric = "zero_one_accuracy"
+
+
+class ERRAccumulator(_ScoreMetricAccumulator):
+    """Accumulates :func:`err_np` of the orderings given by the scores."""
+
+    _metric = "err"
+
+
+class CategoricalAccuracyAccumulator(_ScoreMetricAccumulator):
+    """Accumulates :func:`categorical_accuracy_np`."""
+
+    _metric = "categorical_accuracy"
+
+
+class NDCGAccumulator(MetricAccumulator):
+    """Accumulates :func:`make_ndcg_at_k_loss_np` of the rankings given by the
+    scores."""
+
+    def __init__(self, k=5):
+        super().__init__()
+        self.k = k
+
+    def _per_instance(self, y_true, y_pred):
+        return _evaluate_ndcg(_SharedScoreStatistics(y_true, y_pred), k=self.k)
+
+    def merge(self, other):
+        if other.k != self.k:
+            raise ValueError(f"Cannot merge nDCG@{other.k} into nDCG@{self.k}.")
+        return super().merge(other)
+
+
+class TopKCategoricalAccuracyAccumulator(MetricAccumulator):
+    """Accumulates :func:`topk_categorical_accuracy_np`."""
+
+    def __init__(self, k=5):
+        super().__init__()
+        self.k = k
+
+    def _per_instance(self, y_true, y_pred):
+        return _evaluate_topk_categorical_accuracy(
+            _SharedScoreStatistics(y_true, y_pred), k=self.k
+        )
+
+    def merge(self, other):
+        if other.k != self.k:
+            raise ValueError(
+                f"Cannot merge the top-{other.k} into the top-{self.k} accuracy."
+            )
+        return super().merge(other)
+
+
+class F1MeasureAccumulator(MetricAccumulator):
+    """Accumulates :func:`f1_measure`."""
+
+    def _per_instance(self, y_true, y_pred):
+        return _f1_per_instance(y_true, y_pred)
+
+
+class PrecisionAccumulator(MetricAccumulator):
+    """Accumulates :func:`precision`."""
+
+    def _per_instance(self, y_true, y_pred):
+        return _precision_per_instance(y_true, y_pred)
+
+
+class RecallAccumulator(MetricAccumulator):
+    """Accumulates :func:`recall`."""
+
+    def _per_instance(self, y_true, y_pred):
+        return _recall_per_instance(y_true, y_pred)
+
+
+class SubsetZeroOneLossAccumulator(MetricAccumulator):
+    """Accumulates :func:`subset_01_loss`."""
+
+    def _per_instance(self, y_true, y_pred):
+        return _subset_01_loss_per_instance(y_true, y_pred)
+
+
+class HammingLossAccumulator(MetricAccumulator):
+    """Accumulates :func:`hamming`, i.e. the fraction of wrong labels of all
+    objects (rather than instances) added so far."""
+
+    def _per_instance(self, y_true, y_pred):
+        return np.mean(np.not_equal(y_true, y_pred), axis=1)
+
+    def _update_fixed(self, y_true, y_pred):
+        self.total += float(np.sum(np.not_equal(y_true, y_pred)))
+        self.count += int(np.size(y_true))
+
+
+class InstanceInformednessAccumulator(MetricAccumulator):
+    """Accumulates :func:`instance_informedness`."""
+
+    def _per_instance(self, y_true, y_pred):
+        return _informedness_per_instance(y_true, y_pred)
+
+
+class AUCAccumulator(MetricAccumulator):
+    """Accumulates :func:`auc_score`."""
+
+    def _per_instance(self, y_true, y_pred):
+        return _auc_per_instance(y_true, y_pred)
+
+
+class AveragePrecisionAccumulator(MetricAccumulator):
+    """Accumulates :func:`average_precision`."""
+
+    def _per_instance(self, y_true, y_pred):
+        return _average_precision_per_instance(y_true, y_pred)
+
+
+def _accumulate_chunk(accumulator, y_true, y_pred):
+    return accumulator.update(y_true, y_pred)
+
+
+def accumulate(accumulator, chunks, n_jobs=None):
+    """Update an accumulator with a stream of chunks.
+
+    Parameters
+    ----------
+    accumulator : MetricAccumulator
+        The accumulator to update
+    chunks : iterable of tuples (y_true, y_pred)
+        The chunks of instances, which may also be dicts of buckets. A
+        generator is consumed lazily, so that the chunks do not need to fit
+        into memory at once.
+    n_jobs : int or None
+        Number of jobs used to evaluate the chunks (see
+        :class:`joblib.Parallel`). Every chunk is evaluated on an empty copy
+        of the accumulator and the results are merged.
+
+    Returns
+    -------
+    accumulator : MetricAccumulator
+        The updated accumulator
+    """
+    if n_jobs is None or n_jobs == 1:
+        for y_true, y_pred in chunks:
+            accumulator.update(y_true, y_pred)
+    else:
+        empty = accumulator._empty_copy()
+        partial_results = Parallel(n_jobs=n_jobs)(
+            delayed(_accumulate_chunk)(copy.copy(empty), y_true, y_pred)
+            for y_true, y_pred in chunks
+        )
+        for partial_result in partial_results:
+            accumulator.merge(partial_result)
+    return accumulator
+
+
+_SAMPLES_PER_SEED = 16
+
+
+def _bootstrap_counts(seed, n_instances, probabilities=None):
+    """Multinomial counts of the instances in ``_SAMPLES_PER_SEED`` bootstrap
+    samples, or of the groups of instances with the given probabilities."""
+    random_state = np.random.RandomState(seed)
+    if probabilities is not None:
+        return random_state.multinomial(
+            n_instances, probabilities, size=_SAMPLES_PER_SEED
+        )
+    # Counting uniformly drawn indices is much faster than sampling from
+    # np.random.multinomial with many categories.
+    drawn = random_state.randint(n_instances, size=(_SAMPLES_PER_SEED, n_instances))
+    drawn += n_instances * np.arange(_SAMPLES_PER_SEED)[:, None]
+    counts = np.bincount(drawn.ravel(), minlength=_SAMPLES_PER_SEED * n_instances)
+    return counts.reshape(_SAMPLES_PER_SEED, n_instances)
+
+
+def _bootstrap_means(values, defined, seeds, n_samples, n_instances, probabilities):
+    """Means of the values in bootstrap samples given by multinomial counts.
+
+    Every seed draws a group of ``_SAMPLES_PER_SEED`` samples at once, so
+    that the samples do not depend on how the groups are split into blocks.
+    Only the first ``n_samples`` samples are used.
+    """
+    counts = np.concatenate(
+        [_bootstrap_counts(seed, n_instances, probabilities) for seed in seeds]
+    )[:n_samples]
+    sums = counts @ np.stack([values, defined], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return sums[:, 0] / sums[:, 1]
+
+
+def bootstrap(
+    metric,
+    y_true,
+    scores,
+    n_boot=1000,
+    random_state=None,
+    n_jobs=None,
+    confidence=0.95,
+    lengths=None,
+    block_size=10 ** 7,
+    **kwargs,
+):
+    """Percentile bootstrap confidence interval of a metric.
+
+    The per-instance values of the metric are computed only once. Every
+    bootstrap sample is then represented by the multinomial counts of the
+    instances, so that the metric of a block of samples is a single
+    matrix-vector product of the counts with the per-instance values. If the
+    metric takes only few distinct values, as most ranking and choice
+    metrics do, the counts of these values are drawn instead.
+
+    Examples
+    --------
+    >>> y_true = np.array([[0, 1, 2]] * 4)
+    >>> scores = np.array([[3, 2, 1], [3, 2, 1], [3, 1, 2], [1, 2, 3]])
+    >>> estimate, (lower, upper) = bootstrap(
+    ...     zero_one_accuracy_for_scores_np, y_true, scores, random_state=42
+    ... )
+    >>> print(estimate, lower <= estimate <= upper)
+    0.5 True
+
+    Parameters
+    ----------
+    metric : function or str
+        A metric of this module, or the name of a metric accepted by
+        :func:`evaluate`
+    y_true : array-like, shape (n_instances, n_objects) or dict
+        The true rankings, choices or subsets
+    scores : array-like, shape (n_instances, n_objects) or dict
+        The predictions, as expected by the metric
+    n_boot : int
+        Number of bootstrap samples
+    random_state : int, RandomState instance or None
+        Seed of the pseudo-random generator or a RandomState instance
+    n_jobs : int or None
+        Number of jobs used to draw the blocks of bootstrap samples (see
+        :class:`joblib.Parallel`)
+    confidence : float (range : [0,1])
+        Confidence level of the interval
+    lengths : array-like, shape (n_instances,) or None
+        The number of objects of every instance if the arrays are padded
+    block_size : int
+        Maximal number of entries of the count matrix of one block of
+        bootstrap samples, a block has at least 16 samples though. It only
+        bounds the memory and does not change the result.
+    **kwargs
+        Keyword arguments for the metric
+
+    Returns
+    -------
+    estimate : float
+        The value of the metric on all instances
+    interval : tuple (lower, upper)
+        The bootstrap confidence interval
+    """
+    if isinstance(metric, str):
+        per_instance, _ = _parse_evaluation_metric(metric)
+        values = np.concatenate(
+            [
+                per_instance(stats)
+                for stats in _score_statistics_buckets(y_true, scores, lengths)
+            ]
+        )
+    else:
+        values = metric(y_true, scores, per_instance=True, lengths=lengths, **kwargs)
+    values = np.asarray(values, dtype=float)
+    defined = ~np.isnan(values)
+    values = np.where(defined, values, 0.0)
+    estimate = np.sum(values) / np.sum(defined) if np.any(defined) else np.nan
+
+    # Instances with equal values are interchangeable. If there are only few
+    # distinct values, the counts of these values are drawn instead of the
+    # counts of all instances.
+    n_instances = len(values)
+    unique_values, value_counts = np.unique(values[defined], return_counts=True)
+    if 3 * (len(unique_values) + 1) < n_instances:
+        probabilities = np.append(value_counts, n_instances - np.sum(defined))
+        probabilities = probabilities / n_instances
+        values = np.append(unique_values, 0.0)
+        defined = np.append(np.ones_like(unique_values), 0.0)
+    else:
+        probabilities = None
+
+    # One seed per fixed group of bootstrap samples, so that the result only
+    # depends on the random state and not on block_size or n_jobs.
+    random_state = check_random_state(random_state)
+    n_groups = -(-n_boot // _SAMPLES_PER_SEED)
+    seeds = random_state.randint(np.iinfo(np.int32).max, size=n_groups)
+    samples_per_block = block_size // max(len(values), 1)
+    groups_per_block = max(1, samples_per_block // _SAMPLES_PER_SEED)
+    blocks = [
+        (
+            seeds[start : start + groups_per_block],
+            min(n_boot, (start + groups_per_block) * _SAMPLES_PER_SEED)
+            - start * _SAMPLES_PER_SEED,
+        )
+        for start in range(0, n_groups, groups_per_block)
+    ]
+    args = (n_instances, probabilities)
+    if n_jobs is None or n_jobs == 1:
+        means = [_bootstrap_means(values, defined, *block, *args) for block in blocks]
+    else:
+        means = Parallel(n_jobs=n_jobs)(
+            delayed(_bootstrap_means)(values, defined, *block, *args)
+            for block in blocks
+        )
+    means = np.concatenate(means)
+    alpha = (1.0 - confidence) / 2.0
+    lower, upper = np.nanpercentile(means, [100 * alpha, 100 * (1 - alpha)])
+    return estimate, (lower, upper)
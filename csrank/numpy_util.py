@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.stats import rankdata
 
 
 def replace_inf_np(x):
@@ -49,19 +48,105 @@ def normalize(x, axis=1):
 
 
 def scores_to_rankings(score_matrix):
-    mask3 = np.equal(score_matrix[:, None] - score_matrix[:, :, None], 0)
+    """Converts scores to rankings, where the highest score gets rank 0.
+
+    Tied scores get the average of the ranks they occupy. In this case (if
+    any row contains ties) the rankings have the dtype of the scores,
+    otherwise they are integers. A single sort per row is used to both
+    detect the ties and to compute the ranks.
+
+    Examples
+    --------
+    >>> scores_to_rankings(np.array([[0.1, 0.7, 0.3]])).tolist()
+    [[2, 0, 1]]
+    >>> scores_to_rankings(np.array([[0.1, 0.7, 0.1]])).tolist()
+    [[1.5, 0.0, 1.5]]
+
+    Parameters
+    ----------
+    score_matrix : array-like, shape (n_instances, n_objects)
+        The scores of the objects
+
+    Returns
+    -------
+    rankings : array-like, shape (n_instances, n_objects)
+        The rankings of the objects
+    """
+    score_matrix = np.asarray(score_matrix)
+    orderings = np.argsort(score_matrix, axis=1)
+    sorted_scores = np.take_along_axis(score_matrix, orderings, axis=1)
+    return rankings_for_sorted_scores(score_matrix, orderings, sorted_scores)
+
+
+def rankings_for_sorted_scores(score_matrix, orderings, sorted_scores):
+    """Computes :func:`scores_to_rankings` from already sorted scores.
+
+    Parameters
+    ----------
+    score_matrix : array-like, shape (n_instances, n_objects)
+        The scores of the objects
+    orderings : array-like, shape (n_instances, n_objects)
+        The result of ``np.argsort(score_matrix, axis=1)``
+    sorted_scores : array-like, shape (n_instances, n_objects)
+        The scores sorted along each row according to ``orderings``
+
+    Returns
+    -------
+    rankings : array-like, shape (n_instances, n_objects)
+        The rankings of the objects
+    """
     n_objects = score_matrix.shape[1]
-    ties = np.sum(np.sum(mask3, axis=(1, 2)) - n_objects)
-    rankings = np.empty_like(score_matrix)
-    if ties > 0:
-        for i, s in enumerate(score_matrix):
-            rankings[i] = len(s) - rankdata(s)
+    positions = np.broadcast_to(np.arange(n_objects), score_matrix.shape)
+    # Ties are detected by a zero difference, so equal infinite scores do not
+    # count as ties here.
+    if np.any(np.equal(np.diff(sorted_scores, axis=1), 0)):
+        # Average of the (1-based) positions of each run of equal scores, the
+        # same as scipy.stats.rankdata.
+        first, last = tied_run_bounds(sorted_scores)
+        average_rank = (first + last + 2) / 2.0
+        rankings = np.empty_like(score_matrix)
+        np.put_along_axis(rankings, orderings, n_objects - average_rank, axis=1)
     else:
-        orderings = np.argsort(score_matrix, axis=1)[:, ::-1]
-        rankings = np.argsort(orderings, axis=1)
+        rankings = np.empty(score_matrix.shape, dtype=np.intp)
+        np.put_along_axis(rankings, orderings, n_objects - 1 - positions, axis=1)
     return rankings
 
 
+def tied_run_bounds(sorted_scores):
+    """Finds the runs of equal scores in rows of sorted scores.
+
+    Examples
+    --------
+    >>> first, last = tied_run_bounds(np.array([[0.1, 0.3, 0.3, 0.7]]))
+    >>> first.tolist(), last.tolist()
+    ([[0, 1, 1, 3]], [[0, 2, 2, 3]])
+
+    Parameters
+    ----------
+    sorted_scores : array-like, shape (n_instances, n_objects)
+        The scores, sorted along each row
+
+    Returns
+    -------
+    first : array-like, shape (n_instances, n_objects)
+        The position of the first score of the run every score belongs to
+    last : array-like, shape (n_instances, n_objects)
+        The position of the last score of the run every score belongs to
+    """
+    n_objects = sorted_scores.shape[1]
+    positions = np.broadcast_to(np.arange(n_objects), sorted_scores.shape)
+    tied_with_next = np.equal(sorted_scores[:, 1:], sorted_scores[:, :-1])
+    run_start = np.ones(sorted_scores.shape, dtype=bool)
+    run_start[:, 1:] = ~tied_with_next
+    run_end = np.ones(sorted_scores.shape, dtype=bool)
+    run_end[:, :-1] = ~tied_with_next
+    first = np.maximum.accumulate(np.where(run_start, positions, 0), axis=1)
+    last = np.minimum.accumulate(
+        np.where(run_end, positions, n_objects - 1)[:, ::-1], axis=1
+    )[:, ::-1]
+    return first, last
+
+
 def ranking_ordering_conversion(input):
     """Converts a ranking to an ordering.
 
@@ -79,14 +79,17 @@ class ExpectedRankRegression(ObjectRanker, Learner):
     def fit(self, X, Y, **kwargs):
         """
             Fit an ExpectedRankRegression on the provided set of queries X and preferences Y of those objects.
-            The provided queries and corresponding preferences are of a fixed size (numpy arrays).
+            The provided queries and corresponding preferences can be of a fixed size (numpy arrays) or of variable
+            size (dictionaries mapping the query set size to numpy arrays).
 
             Parameters
             ----------
-            X : numpy array
+            X : dict or numpy array
+                Dictionary with a mapping from query set size to numpy arrays or a single numpy array of size:
                 (n_instances, n_objects, n_features)
                 Feature vectors of the objects
-            Y : numpy array
+            Y : dict or numpy array
+                Dictionary with a mapping from query set size to numpy arrays or a single numpy array of size:
                 (n_instances, n_objects)
                 Rankings of the given objects
             **kwargs
@@ -0,0 +1,185 @@
+import logging
+
+from keras import Input
+from keras import Model
+from keras.layers import Lambda
+from keras.optimizers import SGD
+from keras.regularizers import l2
+
+from csrank.core.ranknet_core import RankNetCore
+from csrank.losses import make_lambdarank_loss
+from csrank.metrics import zero_one_rank_loss_for_scores_ties
+from csrank.objectranking.object_ranker import ObjectRanker
+
+__all__ = ["LambdaRank"]
+logger = logging.getLogger(__name__)
+
+
+class LambdaRank(ObjectRanker, RankNetCore):
+    def __init__(
+        self,
+        k=None,
+        sigma=1.0,
+        n_hidden=2,
+        n_units=8,
+        batch_normalization=True,
+        kernel_regularizer=l2,
+        kernel_initializer="lecun_normal",
+        activation="relu",
+        optimizer=SGD,
+        metrics=(zero_one_rank_loss_for_scores_ties,),
+        batch_size=256,
+        random_state=None,
+        **kwargs,
+    ):
+        """ Create an instance of the LambdaRank architecture for learning a object ranking function, which directly
+            optimizes the normalized discounted cumulative gain at :math:`k` (nDCG@k). It uses the scoring network of
+            :class:`RankNet` to learn a latent utility score for each object in the given query set
+            :math:`Q = \\{x_1, \\ldots ,x_n\\}` using the equation :math:`U(x) = F(x, w)` where :math:`w` is the
+            weight vector. Instead of the gradient of the pairwise cross entropy, every pair of objects
+            :math:`x_i \\succ x_j` contributes the lambda gradient
+
+            .. math::
+
+                \\lambda_{ij} = -\\sigma \\lvert \\Delta \\mathrm{nDCG}_{ij} \\rvert \\frac{1}{1 + e^{\\sigma (U(x_i) - U(x_j))}}
+                \\enspace ,
+
+            where :math:`\\Delta \\mathrm{nDCG}_{ij}` is the change of the nDCG@k when swapping :math:`x_i` and
+            :math:`x_j` in the currently predicted ranking (see :func:`csrank.losses.make_lambdarank_loss`). The
+            ranking for the given query set :math:`Q` is defined as:
+
+            .. math::
+
+                ρ(Q)  = \\operatorname{argsort}_{x \\in Q}  \\; U(x)
+
+            Parameters
+            ----------
+            k : int or None
+                Truncation level of the optimized nDCG. If None, the complete ranking is used.
+            sigma : float
+                Steepness of the pairwise logistic function
+            n_hidden : int
+                Number of hidden layers used in the scoring network
+            n_units : int
+                Number of hidden units in each layer of the scoring network
+            batch_normalization : bool
+                Whether to use batch normalization in each hidden layer
+            kernel_regularizer : uninitialized keras regularizer
+                Regularizer function applied to all the hidden weight matrices.
+            kernel_initializer : function or string
+                Initialization function for the weights of each hidden layer
+            activation : function or string
+                Type of activation function to use in each hidden layer
+            optimizer: Class
+                Uninitialized optimizer class following the keras optimizer interface.
+            optimizer__{kwarg}
+                Arguments to be passed to the optimizer on initialization, such as optimizer__lr.
+            metrics : list
+                List of metrics to evaluate during training (can be non-differentiable)
+            batch_size : int
+                Batch size to use during training
+            random_state : int, RandomState instance or None
+                Seed of the pseudo-random generator or a RandomState instance
+            **kwargs
+                Keyword arguments for the algorithms
+
+            References
+            ----------
+                [1] Burges, C. J., Ragno, R., & Le, Q. V. (2007). "Learning to rank with nonsmooth cost functions.", In Advances in neural information processing systems (pp. 193-200).
+
+                [2] Burges, C. J. (2010). "From ranknet to lambdarank to lambdamart: An overview.", Learning, 11(23-581).
+        """
+        self.k = k
+        self.sigma = sigma
+        super().__init__(
+            n_hidden=n_hidden,
+            n_units=n_units,
+            batch_normalization=batch_normalization,
+            kernel_regularizer=kernel_regularizer,
+            kernel_initializer=kernel_initializer,
+            activation=activation,
+            optimizer=optimizer,
+            metrics=metrics,
+            batch_size=batch_size,
+            random_state=random_state,
+            **kwargs,
+        )
+        logger.info("Initializing network")
+
+    def construct_model(self):
+        """
+            Construct the LambdaRank network, which applies the scoring network of :class:`RankNet` to every object
+            of a query set at once and is trained with the lambda gradients of the nDCG@k.
+
+            Returns
+            -------
+            model: keras :class:`Model`
+                Neural network to learn the LambdaRank utility score
+        """
+        x = Input(shape=(None, self.n_object_features_fit_))
+        hid = x
+        for hidden_layer in self.hidden_layers:
+            hid = hidden_layer(hid)
+        scores = Lambda(lambda s: s[:, :, 0])(self.output_layer_score(hid))
+        model = Model(inputs=x, outputs=scores)
+        model.compile(
+            loss=make_lambdarank_loss(k=self.k, sigma=self.sigma),
+            optimizer=self.optimizer_,
+            metrics=list(self.metrics),
+        )
+        return model
+
+    def fit(
+        self, X, Y, epochs=10, callbacks=None, validation_split=0.1, verbose=0, **kwd
+    ):
+        """
+            Fit a LambdaRank model on a provided set of queries. The provided queries must be of a fixed size (numpy
+            arrays), dictionaries mapping the query set size to numpy arrays are rejected. Predictions can be made for
+            query sets of any size.
+
+            Parameters
+            ----------
+            X : numpy array (n_instances, n_objects, n_features)
+                Feature vectors of the objects
+            Y : numpy array (n_instances, n_objects)
+                Rankings of the given objects
+            epochs : int
+                Number of epochs to run if training for a fixed query size
+            callbacks : list
+                List of callbacks to be called during optimization
+            validation_split : float (range : [0,1])
+                Percentage of instances to split off to validate on
+            verbose : bool
+                Print verbose information
+            **kwd :
+                Keyword arguments for the fit function
+        """
+        if isinstance(X, dict):
+            raise ValueError(
+                "LambdaRank can only be fit on query sets of a fixed size, pass a single numpy array instead of a "
+                "dictionary mapping the query set size to numpy arrays."
+            )
+        self._pre_fit()
+        _n_instances, self.n_objects_fit_, self.n_object_features_fit_ = X.shape
+        logger.debug("Creating the model")
+        self._construct_layers()
+        self.model_ = self.construct_model()
+        logger.debug("Finished Creating the model, now fitting started")
+        self.model_.fit(
+            X,
+            Y,
+            batch_size=self.batch_size,
+            epochs=epochs,
+            callbacks=callbacks,
+            validation_split=validation_split,
+            verbose=verbose,
+            **kwd,
+        )
+        logger.debug("Fitting Complete")
+        return self
+
+    def _predict_scores_fixed(self, X, **kwargs):
+        logger.info("Test Set instances {} objects {} features {}".format(*X.shape))
+        scores = self.model_.predict(X, **kwargs)
+        logger.info("Done predicting scores")
+        return scores
@@ -3,14 +3,17 @@ import logging
 from keras import Input
 from keras.layers import concatenate
 from keras.layers import Dense
+from keras.layers import Lambda
 from keras.models import Model
 from keras.optimizers import SGD
 from keras.regularizers import l2
+import numpy as np
 from sklearn.utils import check_random_state
 
 from csrank.layers import create_input_lambda
 from csrank.layers import NormalizedDense
 from csrank.learner import Learner
+from csrank.losses import make_topk_plackett_luce_loss
 from csrank.losses import plackett_luce_loss
 from csrank.metrics import zero_one_rank_loss_for_scores_ties
 from csrank.objectranking.object_ranker import ObjectRanker
@@ -23,15 +26,16 @@ class ListNet(ObjectRanker, Learner):
     def __init__(
         self,
         n_top=1,
+        full_list=False,
         n_hidden=2,
         n_units=8,
-        loss_function=plackett_luce_loss,
+        loss_function=None,
         batch_normalization=False,
         kernel_regularizer=l2,
         activation="selu",
         kernel_initializer="lecun_normal",
         optimizer=SGD,
-        metrics=(zero_one_rank_loss_for_scores_ties,),
+        metrics=None,
         batch_size=256,
         random_state=None,
         **kwargs,
@@ -50,12 +54,21 @@ class ListNet(ObjectRanker, Learner):
             ----------
             n_top : int
                 Size of the top-k-subrankings to consider for training
+            full_list : bool
+                If True, every object of a query set is scored once by the shared network and the top-k
+                Plackett-Luce likelihood is normalized over the complete list, so that the objects outside of the
+                top-k are used as well. In this mode the number of objects may vary, the model can be fit on
+                dictionaries mapping the query set size to numpy arrays or on padded arrays (padded objects have
+                rank -1).
             n_hidden : int
                 Number of hidden layers used in the scoring network
             n_units : int
                 Number of hidden units in each layer of the scoring network
-            loss_function : function or string
-                Listwise loss function which is applied on the top-k objects
+            loss_function : function, string or None
+                Listwise loss function which is applied on the top-k objects, or on the complete padded lists if
+                ``full_list`` is True (it then has to ignore padded objects with rank -1). If None, the negative
+                Plackett-Luce likelihood is used: :func:`csrank.losses.plackett_luce_loss` on the top-k objects, or
+                :func:`csrank.losses.make_topk_plackett_luce_loss` with ``k=n_top`` on the complete lists.
             batch_normalization : bool
                 Whether to use batch normalization in each hidden layer
             kernel_regularizer : uninitialized keras regularizer
@@ -70,9 +83,11 @@ class ListNet(ObjectRanker, Learner):
                 Uninitialized optimizer class following the keras optimizer interface.
             optimizer__{kwarg}
                 Arguments to be passed to the optimizer on initialization, such as optimizer__lr.
-            metrics : list
+            metrics : list or None
                 List of metrics to evaluate during training (can be
-                non-differentiable)
+                non-differentiable). If ``full_list`` is True, they get the padded rankings, in which padded
+                objects have rank -1. If None, :func:`csrank.metrics.zero_one_rank_loss_for_scores_ties` is used
+                on the top-k objects and no metric on the complete lists, since it does not ignore padded objects.
             batch_size : int
                 Batch size to use during training
             random_state : int, RandomState instance or None
@@ -91,6 +106,7 @@ class ListNet(ObjectRanker, Learner):
                 [1] Z. Cao, T. Qin, T. Liu, M. Tsai and H. Li. "Learning to Rank: From Pairwise Approach to Listwise Approach." ICML, 2007.
         """
         self.n_top = n_top
+        self.full_list = full_list
         self.batch_normalization = batch_normalization
         self.activation = activation
         self.metrics = metrics
@@ -108,7 +124,10 @@ class ListNet(ObjectRanker, Learner):
         )
 
     def _construct_layers(self):
-        self.input_layer = Input(shape=(self.n_top, self.n_object_features_fit_))
+        if self.full_list:
+            self.input_layer = Input(shape=(None, self.n_object_features_fit_))
+        else:
+            self.input_layer = Input(shape=(self.n_top, self.n_object_features_fit_))
         self.output_node = Dense(
             1, activation="linear", kernel_regularizer=self.kernel_regularizer_
         )
@@ -139,6 +158,26 @@ class ListNet(ObjectRanker, Learner):
         Y_topk = Y[mask].reshape(n_inst, self.n_top)
         return X_topk, Y_topk
 
+    def _pad_buckets(self, X, Y):
+        """Merge a dictionary of query set sizes into one padded dataset.
+
+        Padded objects have all features set to zero and rank -1, which is
+        ignored by the full-list loss.
+        """
+        n_instances = sum(x.shape[0] for x in X.values())
+        n_objects = max(X.keys())
+        X_pad = np.zeros(
+            (n_instances, n_objects, self.n_object_features_fit_), dtype=float
+        )
+        Y_pad = np.full((n_instances, n_objects), -1, dtype=int)
+        start = 0
+        for n, x in X.items():
+            stop = start + x.shape[0]
+            X_pad[start:stop, :n] = x
+            Y_pad[start:stop, :n] = Y[n]
+            start = stop
+        return X_pad, Y_pad
+
     def _pre_fit(self):
         super()._pre_fit()
         self.random_state_ = check_random_state(self.random_state)
@@ -161,11 +200,13 @@ class ListNet(ObjectRanker, Learner):
 
             Parameters
             ----------
-            X : numpy array
-                (n_instances, n_objects, n_features)
+            X : dict or numpy array
+                Dictionary with a mapping from query set size to numpy arrays (only if ``full_list`` is True) or a
+                single numpy array of size: (n_instances, n_objects, n_features)
                 Feature vectors of the objects
-            Y : numpy array
-                (n_instances, n_objects)
+            Y : dict or numpy array
+                Dictionary with a mapping from query set size to numpy arrays (only if ``full_list`` is True) or a
+                single numpy array of size: (n_instances, n_objects)
                 Rankings of the given objects
             epochs : int
                 Number of epochs to run if training for a fixed query size
@@ -179,11 +220,23 @@ class ListNet(ObjectRanker, Learner):
                 Keyword arguments for the fit function
         """
         self._pre_fit()
-        _n_instances, _n_objects, self.n_object_features_fit_ = X.shape
-        self._construct_layers()
-        logger.debug("Creating top-k dataset")
-        X, Y = self._create_topk(X, Y)
-        logger.debug("Finished creating the dataset")
+        if isinstance(X, dict):
+            if not self.full_list:
+                raise ValueError(
+                    "Variadic training requires ListNet to be created with full_list=True."
+                )
+            self.n_object_features_fit_ = next(iter(X.values())).shape[-1]
+            self._construct_layers()
+            logger.debug("Creating padded dataset")
+            X, Y = self._pad_buckets(X, Y)
+            logger.debug("Finished creating the dataset")
+        else:
+            _n_instances, _n_objects, self.n_object_features_fit_ = X.shape
+            self._construct_layers()
+            if not self.full_list:
+                logger.debug("Creating top-k dataset")
+                X, Y = self._create_topk(X, Y)
+                logger.debug("Finished creating the dataset")
 
         logger.debug("Creating the model")
         self.model_ = self.construct_model()
@@ -212,17 +265,33 @@ class ListNet(ObjectRanker, Learner):
             model: keras model :class:`Model`
                 ListNet model used to learn the utiliy function using the top-k-subrankings in the provided set of queries.
         """
-        hid = [create_input_lambda(i)(self.input_layer) for i in range(self.n_top)]
-        for hidden_layer in self.hidden_layers:
-            hid = [hidden_layer(x) for x in hid]
-        outputs = [self.output_node(x) for x in hid]
-        merged = concatenate(outputs) if len(outputs) > 1 else outputs[0]
+        if self.full_list:
+            # The dense layers act on the last axis, so every object of the
+            # (padded) list is scored by the same weights in one batched op.
+            hid = self.input_layer
+            for hidden_layer in self.hidden_layers:
+                hid = hidden_layer(hid)
+            merged = Lambda(lambda x: x[:, :, 0])(self.output_node(hid))
+            default_loss = make_topk_plackett_luce_loss(k=self.n_top)
+            default_metrics = []
+        else:
+            hid = [create_input_lambda(i)(self.input_layer) for i in range(self.n_top)]
+            for hidden_layer in self.hidden_layers:
+                hid = [hidden_layer(x) for x in hid]
+            outputs = [self.output_node(x) for x in hid]
+            merged = concatenate(outputs) if len(outputs) > 1 else outputs[0]
+            default_loss = plackett_luce_loss
+            default_metrics = [zero_one_rank_loss_for_scores_ties]
+        if self.loss_function is None:
+            loss_function = default_loss
+        else:
+            loss_function = self.loss_function
+        if self.metrics is None:
+            metrics = default_metrics
+        else:
+            metrics = list(self.metrics)
         model = Model(inputs=self.input_layer, outputs=merged)
-        model.compile(
-            loss=self.loss_function,
-            optimizer=self.optimizer_,
-            metrics=list(self.metrics),
-        )
+        model.compile(loss=loss_function, optimizer=self.optimizer_, metrics=metrics)
         return model
 
     @property
@@ -250,6 +319,8 @@ class ListNet(ObjectRanker, Learner):
     def _predict_scores_fixed(self, X, **kwargs):
         n_inst, n_obj, n_feat = X.shape
         logger.info("For Test instances {} objects {} features {}".format(*X.shape))
+        if self.full_list:
+            return self.model_.predict(X)
         inp = Input(shape=(n_obj, n_feat))
         lambdas = [create_input_lambda(i)(inp) for i in range(n_obj)]
         scores = concatenate([self.scoring_model(lam) for lam in lambdas])
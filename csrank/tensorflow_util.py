@@ -1,6 +1,7 @@
 import logging
 import multiprocessing
 import os
+import weakref
 
 from keras import backend as K
 import numpy as np
@@ -68,6 +69,16 @@ def configure_numpy_keras(seed=42):
 
 
 def get_mean_loss(metric, y_true, y_pred):
+    """Evaluate a metric on arrays or on dictionaries of buckets.
+
+    For dictionaries, the mean of every bucket is weighted by its number of
+    instances and buckets with an undefined (nan or inf) value are skipped.
+
+    If the metric has a NumPy implementation (recorded as its ``numpy_twin``
+    attribute), that is used. Otherwise the metric is evaluated by a function
+    which is compiled once for every shape of the inputs, so that repeated
+    evaluations do not add any nodes to the graph.
+    """
     if isinstance(y_pred, dict) and isinstance(y_true, dict):
         losses = []
         total_instances = 0
@@ -84,7 +95,36 @@ def get_mean_loss(metric, y_true, y_pred):
     return mean_loss
 
 
+# Compiled metric functions, per graph so that they are discarded together
+# with a cleared session.
+_compiled_metrics = weakref.WeakKeyDictionary()
+
+
+def _compiled_metric(metric, y_true, y_pred):
+    """Return a keras function evaluating ``metric`` for arrays like the given.
+
+    The function is built on placeholders the first time a metric is
+    evaluated for some shapes and dtypes and reused afterwards.
+    """
+    graph = tf.get_default_graph()
+    functions = _compiled_metrics.setdefault(graph, dict())
+    key = (metric, y_true.shape, y_true.dtype, y_pred.shape, y_pred.dtype)
+    if key not in functions:
+        inputs = [
+            K.placeholder(shape=y.shape, dtype=K.floatx()) for y in (y_true, y_pred)
+        ]
+        functions[key] = K.function(inputs, [metric(*inputs)])
+    return functions[key]
+
+
 def eval_loss(metric, y_true, y_pred):
-    x = metric(y_true, y_pred)
-    x = get_tensor_value(x)
+    if isinstance(y_true, (tf.Tensor, tf.Variable)) or isinstance(
+        y_pred, (tf.Tensor, tf.Variable)
+    ):
+        x = get_tensor_value(metric(y_true, y_pred))
+    elif getattr(metric, "numpy_twin", None) is not None:
+        x = metric.numpy_twin(np.asarray(y_true), np.asarray(y_pred))
+    else:
+        y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+        (x,) = _compiled_metric(metric, y_true, y_pred)([y_true, y_pred])
     return np.nanmean(x)
@@ -7,6 +7,8 @@ import pytest
 import tensorflow as tf
 
 from csrank.choicefunction import *
+from csrank.choicefunction.choice_functions import _sample_f1_for_thresholds
+from csrank.choicefunction.choice_functions import ChoiceFunctions
 from csrank.constants import CMPNET_CHOICE
 from csrank.constants import FATE_CHOICE
 from csrank.constants import FATELINEAR_CHOICE
@@ -126,3 +128,60 @@ def test_choice_function_fixed(trivial_choice_problem, name):
         else:
             pred_loss = metric(y, s_pred)
         assert np.isclose(value, pred_loss, rtol=rtol, atol=atol, equal_nan=False)
+
+
+def test_sample_f1_for_thresholds():
+    random_state = np.random.RandomState(0)
+    y_true = random_state.rand(50, 6) > 0.6
+    # Scores with ties within and between instances:
+    scores = np.round(random_state.rand(50, 6) * 10) / 10
+    thresholds = np.concatenate([[-1.0, 0.0], np.unique(scores)])
+    expected = [f1_measure(y_true, scores > t) for t in thresholds]
+    actual = _sample_f1_for_thresholds(y_true, scores, thresholds)
+    assert np.allclose(expected, actual)
+
+
+def test_tune_thresholds_per_segment():
+    class Stateless:
+        def _pre_fit(self):
+            pass
+
+    class ScoresAsFeatures(ChoiceFunctions, Stateless):
+        def predict_scores(self, X, **kwargs):
+            return X
+
+    random_state = np.random.RandomState(0)
+    scores = random_state.rand(400, 5)
+    segments = random_state.randint(3, size=400)
+    y_true = scores > np.array([0.2, 0.5, 0.8])[segments, None]
+    learner = ScoresAsFeatures()
+    learner.tune_thresholds(scores, y_true, segments=segments, min_instances=10)
+    assert learner.thresholds_ == pytest.approx({0: 0.2, 1: 0.5, 2: 0.8}, abs=0.02)
+    assert np.all(learner.predict(scores, segments=segments) == y_true)
+    # Unknown segments use the global threshold:
+    y_pred = learner.predict(scores[:1], segments=np.array([5]))
+    assert np.all(y_pred == (scores[:1] > learner.threshold_))
+
+    learner.tune_thresholds({5: scores}, {5: y_true}, min_instances=10)
+    assert learner.thresholds_by_ == "size"
+    assert learner.thresholds_[5] == learner.threshold_
+    # Refitting discards the tuned thresholds:
+    learner._pre_fit()
+    assert learner.thresholds_by_ is None
+    learner.threshold_ = 0.5
+    assert np.all(learner.predict(scores) == (scores > 0.5))
+
+
+def test_tune_threshold_reports_progress(capsys):
+    class ScoresAsFeatures(ChoiceFunctions):
+        def predict_scores(self, X, **kwargs):
+            return X
+
+    random_state = np.random.RandomState(0)
+    scores = random_state.rand(50, 5)
+    y_true = scores > 0.5
+    learner = ScoresAsFeatures()
+    threshold = learner._tune_threshold(scores, y_true, verbose=1)
+    assert "Tuning threshold" in capsys.readouterr().out
+    assert threshold == learner._tune_threshold(scores, y_true)
+    assert capsys.readouterr().out == ""
@@ -1,3 +1,4 @@
+from itertools import combinations
 import os
 
 from keras.optimizers import SGD
@@ -5,6 +6,8 @@ import numpy as np
 from pymc3.variational.callbacks import CheckParametersConvergence
 import pytest
 import tensorflow as tf
+import theano
+from theano import tensor as tt
 
 from csrank.constants import CMPNET_DC
 from csrank.constants import FATE_DC
@@ -134,3 +137,292 @@ def test_discrete_choice_function_fixed(trivial_discrete_choice_problem, name):
         else:
             pred_loss = metric(y, s_pred)
         assert np.isclose(value, pred_loss, rtol=rtol, atol=atol, equal_nan=False)
+
+
+def test_posterior_is_extracted_after_fit(trivial_discrete_choice_problem):
+    np.random.seed(123)
+    x, y = trivial_discrete_choice_problem
+    learner = MultinomialLogitModel()
+    learner.fit(
+        x,
+        y,
+        vi_params={
+            "n": 100,
+            "method": "advi",
+            "callbacks": [CheckParametersConvergence()],
+        },
+        store_draws=True,
+    )
+    weights = learner.posterior_means_["weights"]
+    intercept = learner.posterior_means_["intercept"]
+    np.testing.assert_allclose(weights, learner.trace_["weights"].mean(axis=0))
+    assert learner.posterior_draws_["weights"].dtype == np.float32
+    assert learner.posterior_draws_["weights"].shape == learner.trace_["weights"].shape
+    np.testing.assert_allclose(
+        learner.predict_scores(x), np.dot(x, weights) + intercept
+    )
+
+
+def test_vi_params_are_not_modified(trivial_discrete_choice_problem):
+    x, y = trivial_discrete_choice_problem
+    callback = CheckParametersConvergence()
+    vi_params = {"n": 100, "method": "advi", "callbacks": [callback]}
+    learner = MultinomialLogitModel()
+    learner.fit(x, y, vi_params=vi_params, chains=2, cores=1, vi_restarts=2)
+    assert vi_params == {"n": 100, "method": "advi", "callbacks": [callback]}
+    assert vi_params["callbacks"][0] is callback
+    assert callback.prev is None
+    assert learner.trace_vi_ is not None
+
+
+@pytest.mark.parametrize("sampler", ["map", "mle"])
+def test_point_estimate(trivial_discrete_choice_problem, sampler):
+    x, y = trivial_discrete_choice_problem
+    learner = MultinomialLogitModel()
+    learner.fit(x, y, sampler=sampler, store_draws=True, maxiter=200)
+    assert learner.posterior_draws_["weights"].shape == (1, 2)
+    s_pred = learner.predict_scores(x)
+    assert categorical_accuracy_np(y, s_pred) > 0.95
+
+
+def test_minibatch_fit(trivial_discrete_choice_problem):
+    np.random.seed(123)
+    x, y = trivial_discrete_choice_problem
+    learner = MultinomialLogitModel()
+    with pytest.raises(ValueError):
+        learner.fit(x, y, sampler="map", minibatch_size=50)
+    learner.fit(
+        x, y, vi_params={"n": 2000, "method": "advi"}, minibatch_size=50, float32=True,
+    )
+    assert learner.total_size_ == 500
+    s_pred = learner.predict_scores(x)
+    assert categorical_accuracy_np(y, s_pred) > 0.9
+
+
+def test_mixed_logit_em(trivial_discrete_choice_problem):
+    x, y = trivial_discrete_choice_problem
+    learner = MixedLogitModel(n_mixtures=2)
+    learner.fit(
+        x, y, sampler="em", em_params={"n_restarts": 2, "max_iter": 50, "tol": 1e-6}
+    )
+    assert learner.posterior_means_["weights"].shape == (2, 2)
+    np.testing.assert_allclose(
+        np.sum(learner.posterior_means_["class_probabilities"]), 1.0
+    )
+    s_pred = learner.predict_scores(x)
+    np.testing.assert_allclose(np.sum(s_pred, axis=1), 1.0)
+    assert categorical_accuracy_np(y, s_pred) > 0.95
+
+
+def test_mixed_logit_em_random_state(trivial_discrete_choice_problem):
+    x, y = trivial_discrete_choice_problem
+    em_params = {"n_restarts": 3, "max_iter": 5}
+    weights = [
+        MixedLogitModel(n_mixtures=2, random_state=random_state)
+        .fit(x, y, sampler="em", em_params=em_params)
+        .posterior_means_["weights"]
+        for random_state in [7, 7, 8]
+    ]
+    np.testing.assert_array_equal(weights[0], weights[1])
+    assert not np.allclose(weights[0], weights[2])
+
+
+def test_mixed_logit_refit_discards_draws(trivial_discrete_choice_problem):
+    x, y = trivial_discrete_choice_problem
+    learner = MixedLogitModel(n_mixtures=2)
+    learner.fit(x, y, sampler="em", store_draws=True)
+    assert learner.predict_scores(x, n_draws=1).shape == (500, 5)
+    learner.fit(np.concatenate([x, x], axis=2), y, sampler="em")
+    assert learner.posterior_draws_ is None
+    with pytest.raises(ValueError):
+        learner.predict_scores(x, n_draws=1)
+
+
+def test_nested_logit_probabilities():
+    random_state = np.random.RandomState(42)
+    x = random_state.randn(20, 5, 2)
+    y_nests = random_state.randint(3, size=(20, 5))
+    weights = random_state.randn(3, 2)
+    lambda_k = random_state.uniform(0.5, 1.0, size=3)
+    utility_k = random_state.randn(3)
+    learner = NestedLogitModel(n_nests=3)
+    learner.Xt_ = theano.shared(x)
+    learner.y_nests_ = theano.shared(y_nests)
+
+    utility = learner._eval_utility_np(x, y_nests, weights)
+    expected = np.array(
+        [[np.dot(o, weights[k]) for o, k in zip(*q)] for q in zip(x, y_nests)]
+    )
+    np.testing.assert_allclose(utility, expected)
+    np.testing.assert_allclose(
+        learner._eval_utility(tt.constant(weights)).eval(), utility
+    )
+
+    p = learner._get_probabilities_np(y_nests, utility, lambda_k, utility_k)
+    for u, nests, p_instance in zip(utility, y_nests, p):
+        inclusive = {k: np.log(np.sum(np.exp(u[nests == k]))) for k in set(nests)}
+        nest_values = {
+            k: np.exp(utility_k[k] + lambda_k[k] * v) for k, v in inclusive.items()
+        }
+        total = sum(nest_values.values())
+        for i, k in enumerate(nests):
+            p_nest = nest_values[k] / total
+            assert np.isclose(p_instance[i], np.exp(u[i] - inclusive[k]) * p_nest)
+    p_graph = learner.get_probabilities(
+        tt.constant(utility), tt.constant(lambda_k), tt.constant(utility_k)
+    )
+    np.testing.assert_allclose(p_graph.eval(), p)
+
+
+def test_paired_combinatorial_logit_probabilities():
+    random_state = np.random.RandomState(42)
+    n_objects = 4
+    learner = PairedCombinatorialLogit()
+    learner.n_objects_fit_ = n_objects
+    learner.nests_indices = np.array(list(combinations(range(n_objects), 2)))
+    learner.n_nests = len(learner.nests_indices)
+    utility = random_state.randn(10, n_objects)
+    lambda_k = random_state.uniform(0.5, 1.0, size=learner.n_nests)
+
+    p = learner._get_probabilities_np(utility, lambda_k)
+    for u, p_instance in zip(utility, p):
+        nest_sums = [
+            np.exp(u[i] / lam) + np.exp(u[j] / lam)
+            for (i, j), lam in zip(learner.nests_indices, lambda_k)
+        ]
+        total = sum(s ** lam for s, lam in zip(nest_sums, lambda_k))
+        expected = np.zeros(n_objects)
+        for (i, j), lam, s in zip(learner.nests_indices, lambda_k, nest_sums):
+            expected[i] += np.exp(u[i] / lam) / s * s ** lam / total
+            expected[j] += np.exp(u[j] / lam) / s * s ** lam / total
+        np.testing.assert_allclose(p_instance, expected)
+    p_graph = learner.get_probabilities(tt.constant(utility), tt.constant(lambda_k))
+    np.testing.assert_allclose(p_graph.eval(), p)
+
+
+def test_generalized_nested_logit_probabilities():
+    random_state = np.random.RandomState(42)
+    learner = GeneralizedNestedLogitModel(n_nests=3)
+    utility = random_state.randn(10, 4)
+    lambda_k = random_state.uniform(0.5, 1.0, size=3)
+    alpha_ik = random_state.dirichlet(np.ones(3), size=(10, 4))
+
+    p = learner._get_probabilities_np(utility, lambda_k, alpha_ik)
+    for u, alpha, p_instance in zip(utility, alpha_ik, p):
+        terms = (alpha * np.exp(u)[:, None]) ** (1 / lambda_k)
+        nest_values = terms.sum(axis=0) ** lambda_k
+        expected = np.sum(
+            terms / terms.sum(axis=0) * nest_values / nest_values.sum(), axis=1
+        )
+        np.testing.assert_allclose(p_instance, expected)
+    p_graph = learner.get_probabilities(
+        tt.constant(utility), tt.constant(lambda_k), tt.constant(alpha_ik)
+    )
+    np.testing.assert_allclose(p_graph.eval(), p)
+
+
+def test_mixed_logit_draw_scores():
+    random_state = np.random.RandomState(42)
+    x = random_state.randn(30, 5, 2)
+    learner = MixedLogitModel(n_mixtures=3)
+    learner.posterior_draws_ = {"weights": random_state.randn(8, 2, 3)}
+    learner.posterior_means_ = {
+        "weights": learner.posterior_draws_["weights"].mean(axis=0)
+    }
+
+    utility = np.dot(x, learner.posterior_means_["weights"])
+    expected = np.mean(np.exp(utility) / np.exp(utility).sum(axis=1)[:, None], axis=2)
+    np.testing.assert_allclose(learner.predict_scores(x), expected)
+
+    expected = np.mean(
+        [
+            learner._predict_scores_fixed(x, weights=w[None])
+            for w in learner.posterior_draws_["weights"]
+        ],
+        axis=0,
+    )
+    for n_jobs, block_size in [(None, 10 ** 7), (None, 100), (2, 100)]:
+        scores = learner.predict_scores(
+            x, n_draws=8, n_jobs=n_jobs, block_size=block_size
+        )
+        np.testing.assert_allclose(scores, expected)
+    assert learner.predict_scores(x, n_draws=2, random_state=0).shape == (30, 5)
+
+
+class _PriorRecordingLearner:
+    fitted = []
+    failing_args = None
+
+    def __init__(self, model_args=None, **kwargs):
+        self.model_args = model_args
+
+    def fit(self, X, Y):
+        _PriorRecordingLearner.fitted.append(self.model_args)
+        if self.model_args == _PriorRecordingLearner.failing_args:
+            raise FloatingPointError("NaN occurred in optimization.")
+        self.posterior_means_ = {"weights": np.zeros(X.shape[-1])}
+        self.trace_ = None
+        self.trace_vi_ = None
+        return self
+
+
+def test_model_selector_resumes(trivial_discrete_choice_problem, tmp_path):
+    x, y = trivial_discrete_choice_problem
+    model_path = str(tmp_path / "priors")
+    selector = ModelSelector(_PriorRecordingLearner, ["weights"], {}, {}, model_path)
+    n_keys = len(selector.grid())
+    _PriorRecordingLearner.fitted = []
+    selector.fit(x, y)
+    assert len(_PriorRecordingLearner.fitted) == n_keys
+    assert sorted(os.listdir(model_path)) == sorted(
+        os.path.basename(selector.result_path(key)) for key, _ in selector.grid()
+    )
+    assert "weights_uniform_prior.pkl" in os.listdir(model_path)
+    assert selector.models["['weights']_uniform_prior"]["elbo"] is None
+
+    key = "weights_1_mu_0_sd_1"
+    os.remove(selector.result_path(key))
+    _PriorRecordingLearner.fitted = []
+    selector.fit(x, y)
+    assert _PriorRecordingLearner.fitted == [dict(selector.grid())[key]]
+    assert len(selector.models) == n_keys
+
+    # The results used to be pickled to a single file:
+    with pytest.raises(ValueError):
+        ModelSelector(
+            _PriorRecordingLearner, ["weights"], {}, {}, selector.result_path(key)
+        ).fit(x, y)
+
+
+def test_model_selector_records_failures(trivial_discrete_choice_problem, tmp_path):
+    x, y = trivial_discrete_choice_problem
+    selector = ModelSelector(
+        _PriorRecordingLearner, ["weights"], {}, {}, str(tmp_path / "priors")
+    )
+    n_keys = len(selector.grid())
+    key = "weights_0_mu_1_sd_2"
+    _PriorRecordingLearner.fitted = []
+    _PriorRecordingLearner.failing_args = dict(selector.grid())[key]
+    try:
+        selector.fit(x, y)
+        assert len(_PriorRecordingLearner.fitted) == n_keys
+        assert len(selector.models) == n_keys
+        assert selector.models[key]["error"] == (
+            "FloatingPointError: NaN occurred in optimization."
+        )
+        assert selector.models[key]["posterior_means"] is None
+        failed = [k for k, m in selector.models.items() if m["error"] is not None]
+        assert failed == [key]
+
+        # Failed combinations are fitted again on resume, unless skipped:
+        _PriorRecordingLearner.fitted = []
+        selector.fit(x, y, skip_failed=True)
+        assert _PriorRecordingLearner.fitted == []
+        assert selector.models[key]["error"] is not None
+        _PriorRecordingLearner.failing_args = None
+        selector.fit(x, y)
+        assert _PriorRecordingLearner.fitted == [dict(selector.grid())[key]]
+        assert selector.models[key]["error"] is None
+        assert len(selector.models) == n_keys
+    finally:
+        _PriorRecordingLearner.failing_args = None
@@ -1,10 +1,15 @@
 from keras import backend as K
 import numpy as np
 from numpy.testing import assert_almost_equal
+import pytest
+import tensorflow as tf
 
 from csrank.losses import hinged_rank_loss
+from csrank.losses import hinged_rank_loss_tiled
+from csrank.losses import make_topk_plackett_luce_loss
 from csrank.losses import plackett_luce_loss
 from csrank.losses import smooth_rank_loss
+from csrank.losses import smooth_rank_loss_tiled
 
 decimal = 3
 
@@ -51,6 +56,139 @@ def test_plackett_luce_loss():
     )
 
 
+def _plackett_luce_loss_masked(y_true, s_pred):
+    """The original O(n^2) formulation using one mask per rank."""
+    y_true = tf.cast(y_true, dtype="int32")
+    s_pred = tf.cast(s_pred, dtype="float32")
+    m = tf.shape(y_true)[1]
+    raw_max = tf.reduce_max(s_pred, axis=1, keepdims=True)
+    max_elem = tf.stop_gradient(
+        tf.where(tf.is_finite(raw_max), raw_max, tf.zeros_like(raw_max))
+    )
+    exped = tf.exp(tf.subtract(s_pred, max_elem))
+    masks = tf.greater_equal(y_true, tf.range(m)[:, None, None])
+    tri = exped * tf.cast(masks, tf.float32)
+    lse = tf.reduce_sum(tf.log(tf.reduce_sum(tri, axis=2)), axis=0)
+    return lse - tf.reduce_sum(s_pred, axis=1)
+
+
+def test_plackett_luce_loss_equivalent_to_masked():
+    random_state = np.random.RandomState(42)
+    y_true = np.array([random_state.permutation(7) for _ in range(6)])
+    scores = random_state.randn(6, 7)
+    s_pred = K.constant(scores)
+    new = plackett_luce_loss(K.constant(y_true), s_pred)
+    old = _plackett_luce_loss_masked(K.constant(y_true), s_pred)
+    assert_almost_equal(actual=K.eval(new), desired=K.eval(old), decimal=decimal)
+    assert_almost_equal(
+        actual=K.eval(K.gradients(K.sum(new), s_pred)[0]),
+        desired=K.eval(K.gradients(K.sum(old), s_pred)[0]),
+        decimal=decimal,
+    )
+
+
+@pytest.mark.parametrize("n_objects", [10, 100, 1000])
+def test_plackett_luce_loss_long_lists(n_objects):
+    random_state = np.random.RandomState(n_objects)
+    y_true = np.array([random_state.permutation(n_objects) for _ in range(4)])
+    scores = random_state.randn(4, n_objects)
+    actual = K.eval(plackett_luce_loss(K.constant(y_true), K.constant(scores)))
+
+    ordered = np.take_along_axis(scores, np.argsort(y_true, axis=1), axis=1)
+    shifted = np.exp(ordered - scores.max(axis=1, keepdims=True))
+    remaining = np.cumsum(shifted[:, ::-1], axis=1)[:, ::-1]
+    desired = np.log(remaining).sum(axis=1) - scores.sum(axis=1)
+    assert_almost_equal(
+        actual=actual / n_objects, desired=desired / n_objects, decimal=decimal
+    )
+
+
+def _largest_allocation(loss, n_objects, n_instances=2):
+    """The size in bytes of the largest tensor allocated while computing the
+    loss and its gradient."""
+    random_state = np.random.RandomState(n_objects)
+    y_true = np.array([random_state.permutation(n_objects) for _ in range(n_instances)])
+    scores = random_state.randn(n_instances, n_objects)
+    # Placeholders keep the graph from being folded into constants.
+    y_true_tensor = K.placeholder(shape=y_true.shape)
+    s_pred = K.placeholder(shape=scores.shape)
+    loss_value = loss(y_true_tensor, s_pred)
+    gradient = K.gradients(K.sum(loss_value), s_pred)[0]
+    run_metadata = tf.RunMetadata()
+    K.get_session().run(
+        [loss_value, gradient],
+        feed_dict={y_true_tensor: y_true, s_pred: scores},
+        options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+        run_metadata=run_metadata,
+    )
+    return max(
+        output.tensor_description.allocation_description.requested_bytes
+        for device in run_metadata.step_stats.dev_stats
+        for node in device.node_stats
+        for output in node.output
+    )
+
+
+def test_plackett_luce_loss_memory_is_linear():
+    # Four times as many objects need four times the memory, while the
+    # masks of the original formulation need sixteen times the memory.
+    small, large = 250, 1000
+    ratio = _largest_allocation(plackett_luce_loss, large) / _largest_allocation(
+        plackett_luce_loss, small
+    )
+    assert ratio <= 4.5
+    masked_ratio = _largest_allocation(
+        _plackett_luce_loss_masked, large
+    ) / _largest_allocation(_plackett_luce_loss_masked, small)
+    assert masked_ratio >= 15
+
+
+def test_topk_plackett_luce_loss():
+    y_true = np.arange(5)[None, :]
+    scores = np.array([[0.0, 0.0, 0.0, 0.0, 0.0]])
+
+    # The top-5 likelihood of a 5 object list is the full Plackett-Luce
+    # likelihood:
+    assert_almost_equal(
+        actual=K.eval(make_topk_plackett_luce_loss(k=5)(y_true, scores)),
+        desired=np.array([4.78749]),
+        decimal=decimal,
+    )
+    # Only the top-2 positions: log(5) + log(4)
+    assert_almost_equal(
+        actual=K.eval(make_topk_plackett_luce_loss(k=2)(y_true, scores)),
+        desired=np.array([np.log(5) + np.log(4)]),
+        decimal=decimal,
+    )
+
+    # Padded objects (rank -1) do not change the loss, regardless of their
+    # scores:
+    y_true = np.array([[2, 0, 1, 3], [1, 0, -1, -1]])
+    scores = np.array([[0.5, 1.5, -0.3, 2.0], [0.1, 0.4, 10.0, -3.0]])
+    loss = make_topk_plackett_luce_loss(k=3)
+    actual = K.eval(loss(y_true, scores))
+    expected_short = K.eval(loss(y_true[1:, :2], scores[1:, :2]))
+    assert_almost_equal(actual=actual[1:], desired=expected_short, decimal=decimal)
+    s = scores[0]
+    expected_full = (
+        np.log(np.exp(s).sum())
+        - s[1]
+        + np.log(np.exp(s[[0, 2, 3]]).sum())
+        - s[2]
+        + np.log(np.exp(s[[0, 3]]).sum())
+        - s[0]
+    )
+    assert_almost_equal(actual=actual[0], desired=expected_full, decimal=decimal)
+
+    # The identifiability penalty is opt-in and only covers unpadded objects:
+    penalized = K.eval(make_topk_plackett_luce_loss(k=3, alpha=0.1)(y_true, scores))
+    assert_almost_equal(
+        actual=penalized - actual,
+        desired=0.1 * np.sum(np.where(y_true >= 0, scores, 0.0) ** 2, axis=1),
+        decimal=decimal,
+    )
+
+
 def test_smooth_rank_loss():
     y_true = np.arange(5)[None, :]
     y_true_tensor = K.constant(y_true)
@@ -76,3 +214,27 @@ def test_smooth_rank_loss():
         ),
         desired=np.array([0.82275984]),
     )
+
+
+@pytest.mark.parametrize(
+    "loss, tiled_loss",
+    [
+        (hinged_rank_loss, hinged_rank_loss_tiled),
+        (smooth_rank_loss, smooth_rank_loss_tiled),
+    ],
+    ids=["hinged", "smooth"],
+)
+@pytest.mark.parametrize("tile", [1, 3, 64])
+def test_tiled_rank_losses(loss, tiled_loss, tile):
+    random_state = np.random.RandomState(tile)
+    y_true = K.constant(np.array([random_state.permutation(7) for _ in range(3)]))
+    s_pred = K.constant(random_state.randn(3, 7))
+    expected = loss(y_true, s_pred)
+    actual = tiled_loss(tile=tile)(y_true, s_pred)
+    # Equal up to the float32 summation order:
+    assert_almost_equal(actual=K.eval(actual), desired=K.eval(expected), decimal=5)
+    assert_almost_equal(
+        actual=K.eval(K.gradients(K.sum(actual), s_pred)[0]),
+        desired=K.eval(K.gradients(K.sum(expected), s_pred)[0]),
+        decimal=5,
+    )
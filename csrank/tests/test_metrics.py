@@ -5,6 +5,8 @@ import numpy as np
 from numpy.testing import assert_almost_equal
 import pytest
 from pytest import approx
+from sklearn.metrics import average_precision_score
+from sklearn.metrics import roc_auc_score
 
 from csrank.metrics import err
 from csrank.metrics import kendalls_tau_for_scores
@@ -15,14 +17,27 @@ from csrank.metrics import zero_one_accuracy_for_scores
 from csrank.metrics import zero_one_rank_loss
 from csrank.metrics import zero_one_rank_loss_for_scores
 from csrank.metrics import zero_one_rank_loss_for_scores_ties
+from csrank.metrics_np import accumulate
+from csrank.metrics_np import auc_score
+from csrank.metrics_np import average_precision
+from csrank.metrics_np import bootstrap
 from csrank.metrics_np import err_np
+from csrank.metrics_np import evaluate
+from csrank.metrics_np import f1_measure
+from csrank.metrics_np import F1MeasureAccumulator
+from csrank.metrics_np import hamming
+from csrank.metrics_np import HammingLossAccumulator
 from csrank.metrics_np import kendalls_tau_for_scores_np
+from csrank.metrics_np import KendallTauAccumulator
+from csrank.metrics_np import make_ndcg_at_k_loss_np
+from csrank.metrics_np import MetricAccumulator
 from csrank.metrics_np import spearman_correlation_for_scores_np
 from csrank.metrics_np import spearman_correlation_for_scores_scipy
 from csrank.metrics_np import zero_one_accuracy_for_scores_np
 from csrank.metrics_np import zero_one_rank_loss_for_scores_np
 from csrank.metrics_np import zero_one_rank_loss_for_scores_ties_np
 from csrank.numpy_util import ranking_ordering_conversion
+from csrank.numpy_util import scores_to_rankings
 
 
 @pytest.fixture(scope="module", params=[(False), (True)], ids=["NoTies", "Ties"])
@@ -89,6 +104,30 @@ def test_zero_one_rank_loss_for_scores(problem_for_scores):
         assert_almost_equal(actual=real_score, desired=np.array([0.1]))
 
 
+def _zero_one_rank_loss_for_scores_ties_masked(y_true, s_pred):
+    """The original O(n^2) formulation using pairwise masks."""
+    n_objects = y_true.shape[1]
+    mask = np.greater(y_true[:, None] - y_true[:, :, None], 0)
+    mask2 = np.greater(s_pred[:, None] - s_pred[:, :, None], 0)
+    mask3 = np.equal(s_pred[:, None] - s_pred[:, :, None], 0)
+    transpositions = np.sum(np.logical_and(mask, mask2), axis=(1, 2)).astype(float)
+    transpositions += (np.sum(mask3, axis=(1, 2)) - n_objects) / 4.0
+    return np.mean(transpositions / (n_objects * (n_objects - 1.0) / 2.0))
+
+
+@pytest.mark.parametrize("n_objects", [2, 5, 17, 64])
+def test_zero_one_rank_loss_for_scores_ties_np_equivalent(n_objects):
+    random_state = np.random.RandomState(n_objects)
+    y_true = np.array([random_state.permutation(n_objects) for _ in range(25)])
+    # Include ties in the scores as well as in the true ranks:
+    y_true[:5] = random_state.randint(3, size=(5, n_objects))
+    s_pred = random_state.randint(4, size=(25, n_objects)).astype(float)
+    s_pred[10:] = random_state.randn(15, n_objects)
+    expected = _zero_one_rank_loss_for_scores_ties_masked(y_true, s_pred)
+    actual = zero_one_rank_loss_for_scores_ties_np(y_true, s_pred, chunk_size=4)
+    assert actual == expected
+
+
 def test_zero_one_accuracy(problem_for_pred):
     y_true, y_pred, ties = problem_for_pred
 
@@ -263,3 +302,154 @@ def test_err_implementations_equivalent():
     for perm in list(itertools.permutations(elems))[::20]:
         perm = np.reshape(perm, (1, -1))
         assert K.eval(err(y_true, perm)) == approx(err_np(y_true, perm))
+
+
+@pytest.mark.parametrize("ties", [False, True], ids=["NoTies", "Ties"])
+def test_evaluate_equivalent(ties):
+    random_state = np.random.RandomState(42)
+    y_true = np.array([random_state.permutation(7) for _ in range(50)])
+    s_pred = random_state.rand(50, 7)
+    if ties:
+        s_pred[:25] = np.round(s_pred[:25] * 3)
+    expected = {
+        "spearman_correlation": spearman_correlation_for_scores_np(y_true, s_pred),
+        "kendalls_tau": kendalls_tau_for_scores_np(y_true, s_pred),
+        "zero_one_rank_loss": zero_one_rank_loss_for_scores_ties_np(y_true, s_pred),
+        "zero_one_accuracy": zero_one_accuracy_for_scores_np(y_true, s_pred),
+        "ndcg@3": make_ndcg_at_k_loss_np(k=3)(y_true, scores_to_rankings(s_pred)),
+        "err": err_np(y_true, np.argsort(s_pred, axis=1)[:, ::-1]),
+    }
+    actual = evaluate(y_true, s_pred, metrics=list(expected))
+    assert actual == approx(expected)
+    with pytest.raises(ValueError):
+        evaluate(y_true, s_pred, metrics=["ndcg"])
+
+
+def test_metrics_accept_buckets():
+    random_state = np.random.RandomState(7)
+    y_true, s_pred = dict(), dict()
+    for n_objects, n_instances in [(3, 20), (6, 10)]:
+        y_true[n_objects] = np.array(
+            [random_state.permutation(n_objects) for _ in range(n_instances)]
+        )
+        s_pred[n_objects] = np.round(random_state.rand(n_instances, n_objects) * 3)
+    lengths = np.array([3] * 20 + [6] * 10)
+    y_true_padded = np.full((30, 6), -1)
+    s_pred_padded = np.zeros((30, 6))
+    y_true_padded[:20, :3], y_true_padded[20:] = y_true[3], y_true[6]
+    s_pred_padded[:20, :3], s_pred_padded[20:] = s_pred[3], s_pred[6]
+    for metric in [spearman_correlation_for_scores_np, kendalls_tau_for_scores_np]:
+        per_instance = [
+            metric(y_true[n][i : i + 1], s_pred[n][i : i + 1])
+            for n in y_true
+            for i in range(len(y_true[n]))
+        ]
+        expected = np.nanmean(per_instance)
+        assert metric(y_true, s_pred) == approx(expected)
+        assert metric(y_true_padded, s_pred_padded, lengths=lengths) == approx(expected)
+    assert evaluate(y_true, s_pred, metrics=["kendalls_tau"])["kendalls_tau"] == approx(
+        kendalls_tau_for_scores_np(y_true, s_pred)
+    )
+
+    # Fixed size and bucketed inputs both give the mean, or the values of every
+    # instance with per_instance=True:
+    ndcg = make_ndcg_at_k_loss_np(k=3)
+    y_pred = {n: scores_to_rankings(s_pred[n]) for n in s_pred}
+    y_pred_padded = np.full((30, 6), -1)
+    y_pred_padded[:20, :3], y_pred_padded[20:] = y_pred[3], y_pred[6]
+    values = np.concatenate(
+        [ndcg(y_true[n], y_pred[n], per_instance=True) for n in y_true]
+    )
+    assert values.shape == (30,)
+    assert np.ndim(ndcg(y_true[6], y_pred[6])) == 0
+    assert ndcg(y_true[6], y_pred[6]) == approx(np.mean(values[20:]))
+    assert ndcg(y_true, y_pred) == approx(np.mean(values))
+    assert ndcg(y_true_padded, y_pred_padded, lengths=lengths) == approx(
+        np.mean(values)
+    )
+    assert ndcg(y_true, y_pred, per_instance=True) == approx(values)
+
+
+def test_accumulators_equivalent():
+    random_state = np.random.RandomState(3)
+    y_true = np.array([random_state.permutation(6) for _ in range(100)])
+    s_pred = np.round(random_state.rand(100, 6) * 4)
+    chunks = [(y_true[i : i + 17], s_pred[i : i + 17]) for i in range(0, 100, 17)]
+    accumulator = accumulate(KendallTauAccumulator(), chunks[:3])
+    accumulator.merge(accumulate(KendallTauAccumulator(), chunks[3:]))
+    assert accumulator.count == 100
+    assert accumulator.result() == approx(kendalls_tau_for_scores_np(y_true, s_pred))
+
+    subsets = random_state.rand(100, 6) > 0.5
+    predictions = random_state.rand(100, 6) > 0.6
+    accumulator = F1MeasureAccumulator()
+    for i in range(0, 100, 17):
+        accumulator.update(subsets[i : i + 17], predictions[i : i + 17])
+    assert accumulator.result() == approx(f1_measure(subsets, predictions))
+    chunks = [(subsets[i : i + 17], predictions[i : i + 17]) for i in range(0, 100, 17)]
+    accumulator = accumulate(HammingLossAccumulator(), chunks)
+    assert accumulator.result() == approx(hamming(subsets, predictions))
+    with pytest.raises(ValueError):
+        accumulator.merge(KendallTauAccumulator())
+
+    class IncompleteAccumulator(MetricAccumulator):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteAccumulator()
+
+
+def test_auc_and_average_precision_against_sklearn():
+    random_state = np.random.RandomState(0)
+    y_true = (random_state.rand(200, 7) > 0.5).astype(int)
+    y_true[0] = 1
+    # Scores with many ties:
+    s_pred = np.round(random_state.rand(200, 7) * 3)
+    defined = (y_true.sum(axis=1) > 1) & (y_true.sum(axis=1) < 6)
+    expected_auc = roc_auc_score(y_true[defined], s_pred[defined], average="samples")
+    assert auc_score(y_true, s_pred) == approx(expected_auc)
+    expected_ap = np.mean(
+        [average_precision_score(y, s) for y, s in zip(y_true, s_pred) if y.any()]
+    )
+    has_positives = y_true.any(axis=1)
+    assert average_precision(y_true[has_positives], s_pred[has_positives]) == approx(
+        expected_ap
+    )
+    # As with scikit-learn, instances without positives are undefined:
+    assert np.isnan(average_precision(y_true, s_pred)) == (not has_positives.all())
+    per_instance = average_precision(y_true, s_pred, per_instance=True)
+    assert np.array_equal(np.isnan(per_instance), ~has_positives)
+
+
+def test_bootstrap():
+    random_state = np.random.RandomState(5)
+    y_true = np.array([random_state.permutation(6) for _ in range(500)])
+    s_pred = random_state.rand(500, 6)
+    per_instance = kendalls_tau_for_scores_np(y_true, s_pred, per_instance=True)
+    assert per_instance.shape == (500,)
+    estimate, (lower, upper) = bootstrap(
+        kendalls_tau_for_scores_np, y_true, s_pred, random_state=1
+    )
+    assert estimate == approx(np.mean(per_instance))
+    assert lower < estimate < upper
+    # The interval has roughly the width of the normal approximation:
+    standard_error = np.std(per_instance) / np.sqrt(500)
+    assert upper - lower == approx(2 * 1.96 * standard_error, rel=0.2)
+    by_name = bootstrap("kendalls_tau", y_true, s_pred, random_state=1)
+    assert by_name[0] == approx(estimate)
+    assert by_name[1] == approx((lower, upper))
+    # The block size only bounds the memory, it does not change the result:
+    blocked = bootstrap(
+        kendalls_tau_for_scores_np, y_true, s_pred, random_state=1, block_size=2000
+    )
+    assert blocked[1] == approx((lower, upper), rel=1e-12)
+
+    # Continuous values are resampled instance by instance:
+    def first_score(y_true, s_pred, per_instance=True, lengths=None):
+        return s_pred[:, 0]
+
+    estimate, (lower, upper) = bootstrap(first_score, y_true, s_pred, random_state=1)
+    standard_error = np.std(s_pred[:, 0]) / np.sqrt(500)
+    assert upper - lower == approx(2 * 1.96 * standard_error, rel=0.2)
+    blocked = bootstrap(first_score, y_true, s_pred, random_state=1, block_size=2000)
+    assert blocked[1] == approx((lower, upper), rel=1e-12)
@@ -11,9 +11,11 @@ from csrank.constants import FATE_RANKER
 from csrank.constants import FATELINEAR_RANKER
 from csrank.constants import FETA_RANKER
 from csrank.constants import FETALINEAR_RANKER
+from csrank.constants import LAMBDARANK
 from csrank.constants import LISTNET
 from csrank.constants import RANKNET
 from csrank.constants import RANKSVM
+from csrank.dataset_reader.objectranking.util import complete_linear_regression_dataset
 from csrank.metrics_np import zero_one_accuracy_np
 from csrank.metrics_np import zero_one_rank_loss_for_scores_ties_np
 from csrank.objectranking import *
@@ -41,6 +43,7 @@ object_rankers = {
     RANKNET: (RankNet, optimizer_common_args.copy(), (0.0, 1.0)),
     CMPNET: (CmpNet, optimizer_common_args.copy(), (0.0, 1.0),),
     LISTNET: (ListNet, {"n_top": 3, **optimizer_common_args}, (0.0, 1.0)),
+    LAMBDARANK: (LambdaRank, {"k": 3, **optimizer_common_args}, (0.0, 1.0)),
     ERR: (ExpectedRankRegression, {}, (0.0, 1.0)),
     RANKSVM: (RankSVM, {}, (0.0, 1.0)),
     FATE_RANKER: (
@@ -87,3 +90,66 @@ def test_object_ranker_fixed(trivial_ranking_problem, ranker_name):
     assert np.isclose(1.0, pred_acc, rtol=rtol, atol=atol, equal_nan=False)
     pred_acc = zero_one_accuracy_np(pred, y)
     assert np.isclose(acc, pred_acc, rtol=rtol, atol=atol, equal_nan=False)
+
+
+def test_lambda_rank_rejects_variadic_input(trivial_ranking_problem):
+    x, y = trivial_ranking_problem
+    with pytest.raises(ValueError):
+        LambdaRank(k=3).fit({5: x}, {5: y})
+
+
+def test_list_net_full_list():
+    tf.set_random_seed(0)
+    random_state = np.random.RandomState(42)
+    x = random_state.randn(200, 5, 2)
+    y = (-np.dot(x, [1.0, -0.5])).argsort(axis=1).argsort(axis=1)
+    # The same query sets with only the first three objects, the rankings of
+    # which are the ranks of these objects amongst each other.
+    x_3 = x[:, :3]
+    y_3 = (-np.dot(x_3, [1.0, -0.5])).argsort(axis=1).argsort(axis=1)
+    x_pad = np.concatenate([x, np.zeros_like(x)])
+    x_pad[200:, :3] = x_3
+    y_pad = np.concatenate([y, np.full_like(y, -1)])
+    y_pad[200:, :3] = y_3
+    for X, Y in [(x, y), ({5: x, 3: x_3}, {5: y, 3: y_3}), (x_pad, y_pad)]:
+        ranker = ListNet(n_top=2, full_list=True, **optimizer_common_args)
+        ranker.fit(X, Y, epochs=50, validation_split=0, verbose=False)
+        scores = ranker.predict_scores({5: x, 3: x_3})
+        assert scores[5].shape == (200, 5) and scores[3].shape == (200, 3)
+        assert zero_one_rank_loss_for_scores_ties_np(y, scores[5]) < 0.1
+        assert zero_one_rank_loss_for_scores_ties_np(y_3, scores[3]) < 0.1
+
+
+def test_complete_linear_regression_dataset():
+    random_state = np.random.RandomState(0)
+    X = {3: random_state.randn(4, 3, 2), 5: random_state.randn(6, 5, 2)}
+    Y = {n: np.array([random_state.permutation(n) for _ in x]) for n, x in X.items()}
+    Y[5][0] += 2
+    x_expected, y_expected = [], []
+    for n in X:
+        for features, rank in zip(X[n], Y[n]):
+            x_expected.extend(features)
+            min_rank, max_rank = np.min(rank), np.max(rank)
+            y_expected.extend((rank - min_rank + 1) / (max_rank - min_rank + 1))
+    x_train, y_train = complete_linear_regression_dataset(X, Y)
+    np.testing.assert_allclose(x_train, x_expected)
+    np.testing.assert_allclose(y_train, y_expected)
+    x_train, y_train = complete_linear_regression_dataset(X[5], Y[5])
+    np.testing.assert_allclose(x_train, x_expected[12:])
+    np.testing.assert_allclose(y_train, y_expected[12:])
+
+
+def test_expected_rank_regression_buckets():
+    random_state = np.random.RandomState(42)
+    X, Y = dict(), dict()
+    for n_objects in [3, 5]:
+        X[n_objects] = random_state.randn(100, n_objects, 2)
+        utility = np.dot(X[n_objects], [1.0, -0.5])
+        Y[n_objects] = (-utility).argsort(axis=1).argsort(axis=1)
+    ranker = ExpectedRankRegression()
+    ranker.fit(X, Y)
+    scores = ranker.predict_scores(X)
+    for n_objects in [3, 5]:
+        assert scores[n_objects].shape == (100, n_objects)
+        loss = zero_one_rank_loss_for_scores_ties_np(Y[n_objects], scores[n_objects])
+        assert loss < 0.1
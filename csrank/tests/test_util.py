@@ -1,9 +1,19 @@
+import os
+
 from keras import backend as K
 import numpy as np
+from scipy.stats import rankdata
 import tensorflow as tf
 
 from csrank import SyntheticIterator
+from csrank.metrics import kendalls_tau_for_scores
+from csrank.metrics import make_ndcg_at_k_loss
+from csrank.metrics import zero_one_rank_loss_for_scores
+from csrank.metrics import zero_one_rank_loss_for_scores_ties
+from csrank.numpy_util import scores_to_rankings
+from csrank.tensorflow_util import get_mean_loss
 from csrank.tensorflow_util import tensorify
+from csrank.util import available_cpus
 
 
 def test_tensorify():
@@ -26,3 +36,55 @@ def test_synthetic_iterator():
             break
         assert x == 2
         assert y == 41
+
+
+def test_scores_to_rankings():
+    random_state = np.random.RandomState(42)
+    scores = random_state.randn(10, 6)
+    rankings = scores_to_rankings(scores)
+    expected = np.argsort(np.argsort(scores, axis=1)[:, ::-1], axis=1)
+    assert rankings.dtype == expected.dtype
+    np.testing.assert_array_equal(rankings, expected)
+
+    # Tied scores get the average of their ranks:
+    scores = random_state.randint(3, size=(10, 6)).astype(float)
+    rankings = scores_to_rankings(scores)
+    expected = np.array([len(s) - rankdata(s) for s in scores])
+    np.testing.assert_array_equal(rankings, expected)
+
+
+def test_get_mean_loss_does_not_grow_graph():
+    random_state = np.random.RandomState(42)
+    y_true = np.argsort(random_state.rand(20, 5), axis=1)
+    y_pred = np.argsort(random_state.rand(20, 5), axis=1)
+    scores = random_state.randint(3, size=(20, 5)).astype(float)
+
+    # Arrays and tensors give the same values, also for tied rankings in
+    # which the largest rank is smaller than the number of objects.
+    tied_true = np.array([[0, 0, 1], [1, 0, 0], [0, 1, 1]] * 5)
+    tied_scores = random_state.rand(15, 3)
+    for metric in (
+        zero_one_rank_loss_for_scores,
+        zero_one_rank_loss_for_scores_ties,
+        kendalls_tau_for_scores,
+    ):
+        expected = K.eval(metric(tied_true, tied_scores))
+        actual = get_mean_loss(metric, tied_true, tied_scores)
+        assert np.isclose(actual, expected, atol=1e-6)
+    expected = K.eval(kendalls_tau_for_scores(y_true, scores))
+    actual = get_mean_loss(kendalls_tau_for_scores, y_true, scores)
+    assert np.isclose(actual, expected, atol=1e-6)
+
+    ndcg = make_ndcg_at_k_loss(k=3)
+    expected = np.nanmean(K.eval(ndcg(y_true, y_pred)))
+    assert np.isclose(get_mean_loss(ndcg, y_true, y_pred), expected)
+    n_operations = len(tf.get_default_graph().get_operations())
+    for _ in range(3):
+        assert np.isclose(get_mean_loss(ndcg, y_true, y_pred), expected)
+    assert len(tf.get_default_graph().get_operations()) == n_operations
+
+
+def test_available_cpus():
+    n_cpus = available_cpus()
+    assert isinstance(n_cpus, int)
+    assert 1 <= n_cpus <= os.cpu_count()
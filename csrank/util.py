@@ -19,6 +19,7 @@ from csrank.metrics_np import subset_01_loss
 from csrank.metrics_np import zero_one_accuracy_np
 
 __all__ = [
+    "available_cpus",
     "create_dir_recursively",
     "duration_till_now",
     "print_dictionary",
@@ -55,6 +56,52 @@ class MissingExtraError(ImportError):
         )
 
 
+def _cgroup_cpu_limit():
+    """The CPU limit of the cgroup of this process, or None if it is not limited."""
+    # cgroup v2 stores "<quota> <period>" (quota "max" if unlimited), cgroup v1
+    # stores both in separate files (quota -1 if unlimited).
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+    try:
+        quota, period = int(quota), int(period)
+    except ValueError:
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return max(1, quota // period)
+
+
+def available_cpus():
+    """The number of CPUs this process can actually use.
+
+    This is the number of CPUs in the affinity mask of the process (or the
+    number of CPUs of the machine if that is not available), further bounded
+    by the CPU quota of its cgroup, e.g. inside a container or a batch job.
+
+    Returns
+    -------
+    n_cpus : int
+        The number of usable CPUs, at least 1
+    """
+    try:
+        n_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n_cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        n_cpus = min(n_cpus, limit)
+    return max(1, n_cpus)
+
+
 def progress_bar(count, total, status=""):
     bar_len = 60
     filled_len = int(round(bar_len * count / float(total)))